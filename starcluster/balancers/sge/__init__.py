@@ -23,30 +23,67 @@ import os
 import re
 import time
 import datetime
-import xml.dom.minidom
+
+import six
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 from starcluster import utils
 from starcluster import static
 from starcluster import exception
 from starcluster.balancers import LoadBalancer
+from starcluster.balancers.sge import jobstats
 from starcluster.logger import log
 
 
 SGE_STATS_DIR = os.path.join(static.STARCLUSTER_CFG_DIR, 'sge')
 DEFAULT_STATS_DIR = os.path.join(SGE_STATS_DIR, '%s')
 DEFAULT_STATS_FILE = os.path.join(DEFAULT_STATS_DIR, 'sge-stats.csv')
+SGE_ACCOUNTING_FILE = '/opt/sge6/default/common/accounting'
+# Prints the inode of the accounting file and the offset the data starts at
+# followed by the bytes appended since the given offset. Reads at most the
+# last seed bytes if the offset is unknown or the file has been rotated.
+SGE_ACCOUNTING_CMD = """f=%(path)s
+[ -f "$f" ] || exit 0
+st=$(stat -c '%%i %%s' "$f") || exit 1
+set -- $st
+inode=$1 size=$2 off=%(offset)d
+if [ "$inode" != "%(inode)s" ] || [ "$size" -lt "$off" ]; then
+    off=-1
+fi
+if [ "$off" -lt 0 ]; then
+    off=$((size > %(seed)d ? size - %(seed)d : 0))
+    echo "$inode $off seed"
+else
+    echo "$inode $off"
+fi
+tail -c +$((off + 1)) "$f" | head -c $((size - off))"""
 
 
 class SGEStats(object):
     """
     SunGridEngine stats parser
+
+    Each job is stored once in self.jobs. Task array jobs carry the number
+    of tasks they represent in 'num_tasks' which the count_* methods take
+    into account. After parsing, the jobs are also indexed by state, job id
+    and host so that the load balancer's queries don't need to scan every
+    job.
+
+    The queued, start and end times of the last jobstat_cachesize finished
+    jobs are kept in a jobstats.JobStats ring buffer.
     """
-    def __init__(self, remote_tzinfo=None):
-        self.jobstat_cachesize = 200
+    _task_range_re = re.compile(r"(\d+)-?(\d+)?:?(\d+)?")
+
+    def __init__(self, remote_tzinfo=None, jobstat_cachesize=200):
+        self.jobstat_cachesize = jobstat_cachesize
         self.hosts = []
         self.jobs = []
         self.queues = {}
-        self.jobstats = self.jobstat_cachesize * [None]
+        self._index_jobs()
+        self.jobstats = jobstats.JobStats(jobstat_cachesize)
         self.max_job_id = 0
         self.remote_tzinfo = remote_tzinfo or utils.get_utc_now().tzinfo
 
@@ -60,77 +97,166 @@ class SGEStats(object):
         if self.jobs:
             return int(self.jobs[-1]['JB_job_number'])
 
+    def _iterparse(self, xml_out, events=('end',)):
+        """
+        Returns an iterator over the events of the XML in xml_out which can
+        be a string or a file-like object
+        """
+        if isinstance(xml_out, six.string_types + (bytes,)):
+            if isinstance(xml_out, six.text_type):
+                xml_out = xml_out.encode('utf-8')
+            xml_out = six.BytesIO(xml_out)
+        # cElementTree on python 2 only accepts a tuple of native strings
+        return ElementTree.iterparse(xml_out,
+                                     events=tuple([str(e) for e in events]))
+
+    def _iterelements(self, xml_out):
+        """
+        Returns an iterator over (element, parent) for each element of the
+        XML in xml_out once the element has been parsed completely. Callers
+        remove the elements they're done with from their parent so that the
+        tree doesn't keep them.
+        """
+        stack = []
+        for event, elem in self._iterparse(xml_out, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            yield elem, stack[-1] if stack else None
+
     def parse_qhost(self, qhost_out):
         """
         this function parses qhost -xml output and makes a neat array
         takes in a string, so we can pipe in output from ssh.exec('qhost -xml')
         """
         self.hosts = []  # clear the old hosts
-        doc = xml.dom.minidom.parseString(qhost_out)
-        for h in doc.getElementsByTagName("host"):
-            name = h.getAttribute("name")
-            hash = {"name": name}
-            for stat in h.getElementsByTagName("hostvalue"):
-                for hvalue in stat.childNodes:
-                    attr = stat.attributes['name'].value
-                    val = ""
-                    if hvalue.nodeType == xml.dom.minidom.Node.TEXT_NODE:
-                        val = hvalue.data
-                    hash[attr] = val
+        for elem, parent in self._iterelements(qhost_out):
+            if elem.tag != 'host':
+                continue
+            hash = {"name": elem.get("name")}
+            for stat in elem.iter("hostvalue"):
+                if stat.text is not None:
+                    hash[stat.get('name')] = stat.text
             if hash['name'] != u'global':
                 self.hosts.append(hash)
+            parent.remove(elem)
         return self.hosts
 
     def parse_qstat(self, qstat_out):
         """
         This method parses qstat -xml output and makes a neat array
+
+        The XML is parsed incrementally and each job and queue element is
+        removed from the tree as soon as it has been parsed, so the tree never
+        holds more than one of them.
         """
         self.jobs = []  # clear the old jobs
         self.queues = {}  # clear the old queues
-        doc = xml.dom.minidom.parseString(qstat_out)
-        for q in doc.getElementsByTagName("Queue-List"):
-            name = q.getElementsByTagName("name")[0].childNodes[0].data
-            slots = q.getElementsByTagName("slots_total")[0].childNodes[0].data
-            self.queues[name] = dict(slots=int(slots))
-            for job in q.getElementsByTagName("job_list"):
-                self.jobs.extend(self._parse_job(job, queue_name=name))
-        for job in doc.getElementsByTagName("job_list"):
-            if job.parentNode.nodeName == 'job_info':
-                self.jobs.extend(self._parse_job(job))
+        pending_jobs = []
+        # set while inside of a Queue-List element
+        queue_name = None
+        for elem, parent in self._iterelements(qstat_out):
+            tag = elem.tag
+            if tag == 'job_list':
+                if queue_name is not None:
+                    self.jobs.append(self._parse_job(elem,
+                                                     queue_name=queue_name))
+                else:
+                    pending_jobs.append(self._parse_job(elem))
+                parent.remove(elem)
+            elif tag == 'name' and queue_name is None:
+                queue_name = elem.text
+            elif tag == 'Queue-List':
+                slots = elem.findtext('slots_total')
+                self.queues[queue_name] = dict(slots=int(slots))
+                queue_name = None
+                parent.remove(elem)
+        self.jobs.extend(pending_jobs)
+        self._index_jobs()
         return self.jobs
 
+    def _index_jobs(self):
+        """
+        Builds the lookup tables for the parsed jobs:
+
+        running_jobs/queued_jobs - jobs by state in qstat order
+        queued_jobs_by_age - queued jobs sorted by submission time
+        jobs_by_id - first job record for each job number
+        jobs_by_host - jobs by the exact host (and short host) name of the
+        queue instance they're running in
+        slots_by_state - total slots of 'running' and 'queued' tasks
+        slots_by_queue - total slots used in each queue instance
+        """
+        self.running_jobs = []
+        self.queued_jobs = []
+        self.jobs_by_id = {}
+        self.jobs_by_host = {}
+        self.slots_by_state = dict(running=0, queued=0)
+        self.slots_by_queue = {}
+        for j in self.jobs:
+            self.jobs_by_id.setdefault(j['JB_job_number'], j)
+            slots = int(j['slots']) * j['num_tasks']
+            if j['job_state'] == u'running':
+                self.running_jobs.append(j)
+                self.slots_by_state['running'] += slots
+            elif j['job_state'] == u'pending' and j['state'] == u'qw':
+                self.queued_jobs.append(j)
+                self.slots_by_state['queued'] += slots
+            qname = j.get('queue_name')
+            if not qname:
+                continue
+            used = self.slots_by_queue.get(qname, 0)
+            self.slots_by_queue[qname] = used + slots
+            host = qname.partition('@')[2]
+            for name in set([host, host.split('.')[0]]):
+                self.jobs_by_host.setdefault(name, []).append(j)
+        queued = [j for j in self.queued_jobs if 'JB_submission_time' in j]
+        self.queued_jobs_by_age = sorted(
+            queued, key=lambda j: j['JB_submission_time'])
+
     def _parse_job(self, job, queue_name=None):
-        jstate = job.getAttribute("state")
+        """
+        Returns a dictionary for the job element. A task array job is stored
+        once with its task ranges and the number of tasks it represents.
+        """
+        jstate = job.get("state", "")
         jdict = dict(job_state=jstate, queue_name=queue_name)
-        for node in job.childNodes:
-            if node.nodeType == xml.dom.minidom.Node.ELEMENT_NODE:
-                for child in node.childNodes:
-                    jdict[node.nodeName] = child.data
-        num_tasks = self._count_tasks(jdict)
-        log.debug("Job contains %d tasks" % num_tasks)
-        return [jdict] * num_tasks
+        for node in job:
+            if node.text is not None:
+                jdict[node.tag] = node.text
+        jdict['task_ranges'] = self._parse_task_ranges(jdict)
+        jdict['num_tasks'] = self._count_tasks(jdict)
+        return jdict
+
+    def _parse_task_ranges(self, jdict):
+        """
+        Returns the (start, end, step) task ranges of a task array job. For
+        example, 'qsub -t 1-20:2' returns [(1, 20, 2)]. Returns an empty list
+        if the job is not a task array job.
+        """
+        if 'tasks' not in jdict:
+            return []
+        ranges = []
+        for task in jdict['tasks'].split(','):
+            start, end, step = self._task_range_re.match(task).groups()
+            start = int(start)
+            end = int(end) if end else start
+            step = int(step) if step else 1
+            ranges.append((start, end, step))
+        return ranges
 
     def _count_tasks(self, jdict):
         """
         This function returns the number of tasks in a task array job. For
         example, 'qsub -t 1-20:1' returns 20.
         """
-        tasks = jdict.get('tasks', '').split(',')
-        num_tasks = 0
-        for task in tasks:
-            if '-' in task:
-                regex = "(\d+)-?(\d+)?:?(\d+)?"
-                r = re.compile(regex)
-                start, end, step = r.match(task).groups()
-                start = int(start)
-                end = int(end)
-                step = int(step) if step else 1
-                num_tasks += (end - start) / step + 1
-            else:
-                num_tasks += 1
-        log.debug("task array job has %s tasks (tasks: %s)" %
-                  (num_tasks, tasks))
-        return num_tasks
+        ranges = jdict.get('task_ranges')
+        if ranges is None:
+            ranges = self._parse_task_ranges(jdict)
+        if not ranges:
+            return 1
+        return sum([(end - start) // step + 1 for start, end, step in ranges])
 
     def qacct_to_datetime_tuple(self, qacct):
         """
@@ -173,8 +299,9 @@ class SGEStats(object):
             if l.find('==========') != -1:
                 if qd is not None:
                     self.max_job_id = job_id
-                    hash = {'queued': qd, 'start': start, 'end': end}
-                    self.jobstats[job_id % self.jobstat_cachesize] = hash
+                    self.jobstats.append(
+                        *[utils.datetime_tuple_to_unix_time(t)
+                          for t in (qd, start, end)])
                 qd = None
                 start = None
                 end = None
@@ -184,6 +311,50 @@ class SGEStats(object):
                   len(self.jobstats))
         return self.jobstats
 
+    def accounting_to_unix_time(self, value):
+        """
+        Converts a time from the SGE accounting file (seconds or, on newer
+        SGE versions, milliseconds since the epoch) to seconds since the
+        epoch. Returns 0 for times that were never set.
+        """
+        secs = int(value)
+        if secs > 10 ** 11:
+            secs //= 1000
+        return secs
+
+    def parse_accounting(self, string, since=None):
+        """
+        This method parses records from the SGE accounting file and adds them
+        to the jobstats window. Each record is a line of colon-delimited
+        fields (see accounting(5)). Records of jobs that never started and, if
+        since is given, jobs that finished before since are skipped.
+        """
+        if since is not None:
+            since = utils.datetime_tuple_to_unix_time(since)
+        counter = 0
+        for l in string.splitlines():
+            if not l or l.startswith('#'):
+                continue
+            fields = l.split(':')
+            if len(fields) < 11:
+                continue
+            try:
+                job_id = int(fields[5])
+                qd, start, end = [self.accounting_to_unix_time(f)
+                                  for f in fields[8:11]]
+            except ValueError:
+                log.debug("skipping invalid accounting record: %s" % l)
+                continue
+            if not (qd and start and end):
+                continue
+            if since is not None and end < since:
+                continue
+            self.max_job_id = job_id
+            self.jobstats.append(qd, start, end)
+            counter += 1
+        log.debug("added %d new jobs" % counter)
+        return self.jobstats
+
     def is_jobstats_empty(self):
         """
         This function will return True if half of the queue is empty, False if
@@ -195,21 +366,50 @@ class SGEStats(object):
         """
         returns an array of the running jobs, values stored in dictionary
         """
-        running = []
-        for j in self.jobs:
-            if j['job_state'] == u'running':
-                running.append(j)
-        return running
+        return self.running_jobs
 
     def get_queued_jobs(self):
         """
         returns an array of the queued jobs, values stored in dictionary
         """
-        queued = []
-        for j in self.jobs:
-            if j['job_state'] == u'pending' and j['state'] == u'qw':
-                queued.append(j)
-        return queued
+        return self.queued_jobs
+
+    def count_tasks(self, jobs):
+        """
+        returns the total number of tasks for the given jobs
+        """
+        return sum([j['num_tasks'] for j in jobs])
+
+    def count_slots(self, jobs):
+        """
+        returns the total number of slots requested by all tasks of the given
+        jobs
+        """
+        return sum([int(j['slots']) * j['num_tasks'] for j in jobs])
+
+    def count_running_jobs(self):
+        """
+        returns the number of running tasks
+        """
+        return self.count_tasks(self.get_running_jobs())
+
+    def count_queued_jobs(self):
+        """
+        returns the number of queued tasks
+        """
+        return self.count_tasks(self.get_queued_jobs())
+
+    def count_used_slots(self):
+        """
+        returns the number of slots used by running tasks
+        """
+        return self.slots_by_state['running']
+
+    def count_queued_slots(self):
+        """
+        returns the number of slots requested by queued tasks
+        """
+        return self.slots_by_state['queued']
 
     def count_hosts(self):
         """
@@ -252,11 +452,10 @@ class SGEStats(object):
         This returns the age of the oldest job in the queue in normal waiting
         state
         """
-        for j in self.jobs:
-            if 'JB_submission_time' in j and j['state'] == 'qw':
-                st = j['JB_submission_time']
-                dt = utils.iso_to_datetime_tuple(st)
-                return dt.replace(tzinfo=self.remote_tzinfo)
+        if self.queued_jobs_by_age:
+            st = self.queued_jobs_by_age[0]['JB_submission_time']
+            dt = utils.iso_to_datetime_tuple(st)
+            return dt.replace(tzinfo=self.remote_tzinfo)
         # todo: throw a "no queued jobs" exception
 
     def is_node_working(self, node):
@@ -264,12 +463,9 @@ class SGEStats(object):
         This function returns true if the node is currently working on a task,
         or false if the node is currently idle.
         """
-        nodename = node.alias
-        for j in self.jobs:
-            qn = j.get('queue_name', '')
-            if nodename in qn:
-                log.debug("Node %s is working" % node.alias)
-                return True
+        if node.alias in self.jobs_by_host:
+            log.debug("Node %s is working" % node.alias)
+            return True
         log.debug("Node %s is IDLE" % node.id)
         return False
 
@@ -278,36 +474,29 @@ class SGEStats(object):
         returns the number of slots requested for the given job id
         returns None if job_id is invalid
         """
-        ujid = unicode(job_id)
-        for j in self.jobs:
-            if j['JB_job_number'] == ujid:
-                return int(j['slots'])
+        job = self.jobs_by_id.get(six.text_type(job_id))
+        if job is not None:
+            return int(job['slots'])
 
     def avg_job_duration(self):
-        count = 0
-        total_seconds = 0
-        for job in self.jobstats:
-            if job is not None:
-                delta = job['end'] - job['start']
-                total_seconds += delta.seconds
-                count += 1
-        if count == 0:
-            return count
-        else:
-            return total_seconds / count
+        return jobstats.mean(self.jobstats.durations())
 
     def avg_wait_time(self):
-        count = 0
-        total_seconds = 0
-        for job in self.jobstats:
-            if job is not None:
-                delta = job['start'] - job['queued']
-                total_seconds += delta.seconds
-                count += 1
-        if count == 0:
-            return count
-        else:
-            return total_seconds / count
+        return jobstats.mean(self.jobstats.wait_times())
+
+    def wait_time_percentile(self, q=90):
+        """
+        Returns the q-th percentile of the wait times of the recently
+        finished jobs
+        """
+        return jobstats.percentile(self.jobstats.wait_times(), q)
+
+    def ewma_wait_time(self, alpha=0.1):
+        """
+        Returns the exponentially weighted moving average of the wait times
+        of the recently finished jobs which favors the most recent jobs
+        """
+        return jobstats.ewma(self.jobstats.wait_times(), alpha)
 
     def get_loads(self):
         """
@@ -338,9 +527,9 @@ class SGEStats(object):
         # second field is the number of hosts
         bits.append(self.count_hosts())
         # third field is # of running jobs
-        bits.append(len(self.get_running_jobs()))
+        bits.append(self.count_running_jobs())
         # fourth field is # of queued jobs
-        bits.append(len(self.get_queued_jobs()))
+        bits.append(self.count_queued_jobs())
         # fifth field is total # slots
         bits.append(self.count_total_slots())
         # sixth field is average job duration
@@ -414,19 +603,35 @@ class SGELoadBalancer(LoadBalancer):
     Visualizer off by default. Start it with "starcluster loadbalance -p tag"
     plot_stats = False
 
-    How many hours qacct should look back to gather past job data. lower
-    values minimize data transfer
+    How many hours of past job data to load from the SGE accounting file on
+    the first poll. After that only records appended since the previous poll
+    are read.
     lookback_window = 3
+
+    How many bytes at the end of the accounting file to read on the first
+    poll or after the file has been rotated.
+    accounting_seed_bytes = 1048576
+
+    How many of the most recently finished jobs to keep statistics for. Note
+    that only the jobs found in the last accounting_seed_bytes of the
+    accounting file (a few thousand with the default) are loaded on the first
+    poll.
+    jobstats_capacity = 200
     """
+    accounting_seed_bytes = 1024 * 1024
 
     def __init__(self, interval=60, max_nodes=None, wait_time=900,
                  add_pi=1, kill_after=45, stab=180, lookback_win=3,
                  min_nodes=None, kill_cluster=False, plot_stats=False,
-                 plot_output_dir=None, dump_stats=False, stats_file=None):
+                 plot_output_dir=None, dump_stats=False, stats_file=None,
+                 jobstats_capacity=200):
         self._cluster = None
         self._keep_polling = True
         self._visualizer = None
         self._stat = None
+        self._accounting_inode = None
+        self._accounting_offset = 0
+        self.accounting_file = SGE_ACCOUNTING_FILE
         self.__last_cluster_mod_time = utils.get_utc_now()
         self.polling_interval = interval
         self.kill_after = kill_after
@@ -434,6 +639,7 @@ class SGELoadBalancer(LoadBalancer):
         self.add_nodes_per_iteration = add_pi
         self.stabilization_time = stab
         self.lookback_window = lookback_win
+        self.jobstats_capacity = jobstats_capacity
         self.kill_cluster = kill_cluster
         self.max_nodes = max_nodes
         self.min_nodes = min_nodes
@@ -448,7 +654,8 @@ class SGELoadBalancer(LoadBalancer):
     def stat(self):
         if not self._stat:
             rtime = self.get_remote_time()
-            self._stat = SGEStats(remote_tzinfo=rtime.tzinfo)
+            self._stat = SGEStats(remote_tzinfo=rtime.tzinfo,
+                                  jobstat_cachesize=self.jobstats_capacity)
         return self._stat
 
     @property
@@ -509,43 +716,65 @@ class SGELoadBalancer(LoadBalancer):
             self._stat.remote_tzinfo = d.tzinfo
         return d
 
-    def get_qatime(self, now):
+    def _read_accounting(self, master):
         """
-        This function takes the lookback window and creates a string
-        representation of the past few hours, to feed to qacct to
-        limit the dataset qacct returns.
+        Returns the complete records appended to the SGE accounting file
+        since the last call and whether they were read from the end of the
+        file instead (on the first call or after the file was rotated). The
+        byte offset after the last complete record is remembered for the
+        next call.
         """
-        if self.stat.is_jobstats_empty():
-            log.info("Loading full job history")
-            temp_lookback_window = self.lookback_window * 60 * 60
-        else:
-            temp_lookback_window = self.polling_interval
-        log.debug("getting past %d seconds worth of job history" %
-                  temp_lookback_window)
-        now = now - datetime.timedelta(seconds=temp_lookback_window + 1)
-        return now.strftime("%Y%m%d%H%M")
+        cmd = SGE_ACCOUNTING_CMD % dict(path=self.accounting_file,
+                                        inode=self._accounting_inode or '',
+                                        offset=self._accounting_offset,
+                                        seed=self.accounting_seed_bytes)
+        channel = master.ssh.exec_channel(cmd)
+        try:
+            data = channel.makefile('rb').read()
+            status = channel.recv_exit_status()
+            if status != 0:
+                err = channel.makefile_stderr('rb').read()
+                raise exception.RemoteCommandFailed(
+                    "failed to read %s" % self.accounting_file, cmd, status,
+                    [utils.to_str(err)])
+        finally:
+            channel.close()
+        if not data:
+            return '', True
+        header, _, data = data.partition(b'\n')
+        header = utils.to_str(header).split()
+        offset = int(header[1])
+        seeded = len(header) > 2
+        if seeded and offset > 0:
+            # skip the partial record at the start of the seed
+            partial, _, data = data.partition(b'\n')
+            offset += len(partial) + 1
+        # leave a partial record at the end for the next call
+        end = data.rfind(b'\n') + 1
+        self._accounting_inode = header[0]
+        self._accounting_offset = offset + end
+        log.debug("read %d bytes of accounting data (offset: %d)" %
+                  (end, self._accounting_offset))
+        return data[:end].decode('utf-8', 'replace'), seeded
 
     def _get_stats(self):
         master = self._cluster.master_node
         now = self.get_remote_time()
-        qatime = self.get_qatime(now)
-        qacct_cmd = 'qacct -j -b ' + qatime
         qstat_cmd = 'qstat -u \* -xml -f -r'
         qhostxml = '\n'.join(master.ssh.execute('qhost -xml'))
         qstatxml = '\n'.join(master.ssh.execute(qstat_cmd))
-        try:
-            qacct = '\n'.join(master.ssh.execute(qacct_cmd))
-        except exception.RemoteCommandFailed:
-            if master.ssh.isfile('/opt/sge6/default/common/accounting'):
-                raise
-            else:
-                log.info("No jobs have completed yet!")
-                qacct = ''
+        acct, seeded = self._read_accounting(master)
+        if seeded and not acct:
+            log.info("No jobs have completed yet!")
+        since = None
+        if seeded:
+            log.info("Loading %d hours of job history" % self.lookback_window)
+            since = now - datetime.timedelta(hours=self.lookback_window)
         self.stat.parse_qhost(qhostxml)
         self.stat.parse_qstat(qstatxml)
-        self.stat.parse_qacct(qacct, now)
-        log.debug("sizes: qhost: %d, qstat: %d, qacct: %d" %
-                  (len(qhostxml), len(qstatxml), len(qacct)))
+        self.stat.parse_accounting(acct, since=since)
+        log.debug("sizes: qhost: %d, qstat: %d, accounting: %d" %
+                  (len(qhostxml), len(qstatxml), len(acct)))
         return self.stat
 
     @utils.print_timing("Fetching SGE stats", debug=True)
@@ -630,7 +859,7 @@ class SGELoadBalancer(LoadBalancer):
                 continue
             self.get_stats()
             log.info("Execution hosts: %d" % len(self.stat.hosts), extra=raw)
-            log.info("Queued jobs: %d" % len(self.stat.get_queued_jobs()),
+            log.info("Queued jobs: %d" % self.stat.count_queued_jobs(),
                      extra=raw)
             oldest_queued_job_age = self.stat.oldest_queued_job_age()
             if oldest_queued_job_age:
@@ -640,6 +869,8 @@ class SGELoadBalancer(LoadBalancer):
                      self.stat.avg_job_duration(), extra=raw)
             log.info("Avg job wait time: %d secs" % self.stat.avg_wait_time(),
                      extra=raw)
+            log.info("P90 job wait time: %d secs" %
+                     self.stat.wait_time_percentile(90), extra=raw)
             log.info("Last cluster modification time: %s" %
                      self.__last_cluster_mod_time.strftime("%Y-%m-%d %X%z"),
                      extra=dict(__raw__=True))
@@ -693,9 +924,8 @@ class SGELoadBalancer(LoadBalancer):
         total_slots = self.stat.count_total_slots()
         if not self.has_cluster_stabilized() and total_slots > 0:
             return
-        running_jobs = self.stat.get_running_jobs()
-        used_slots = sum([int(j['slots']) for j in running_jobs])
-        qw_slots = sum([int(j['slots']) for j in queued_jobs])
+        used_slots = self.stat.count_used_slots()
+        qw_slots = self.stat.count_queued_slots()
         slots_per_host = self.stat.slots_per_host()
         avail_slots = total_slots - used_slots
         need_to_add = 0
@@ -740,8 +970,7 @@ class SGELoadBalancer(LoadBalancer):
         This function uses the sge stats to decide whether or not to
         remove a node from the cluster.
         """
-        qlen = len(self.stat.get_queued_jobs())
-        if qlen != 0:
+        if self.stat.get_queued_jobs():
             return
         if not self.has_cluster_stabilized():
             return
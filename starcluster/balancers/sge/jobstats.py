@@ -0,0 +1,151 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import math
+import array
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+from starcluster import exception
+
+
+def mean(values):
+    """
+    Returns the mean of values or 0 if values is empty
+    """
+    if not len(values):
+        return 0
+    if HAS_NUMPY:
+        return float(np.mean(values))
+    return math.fsum(values) / len(values)
+
+
+def percentile(values, q):
+    """
+    Returns the q-th percentile (0-100) of values using linear interpolation
+    between the closest ranks (like numpy.percentile) or 0 if values is empty
+    """
+    if not len(values):
+        return 0
+    if HAS_NUMPY:
+        return float(np.percentile(values, q))
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lo = int(math.floor(k))
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def ewma(values, alpha=0.1):
+    """
+    Returns the exponentially weighted moving average of values (oldest
+    first) where the weight of each value decays by (1 - alpha) with every
+    newer value. Returns 0 if values is empty.
+    """
+    if not len(values):
+        return 0
+    if HAS_NUMPY:
+        weights = (1 - alpha) ** np.arange(len(values) - 1, -1, -1)
+        return float(np.dot(weights, values) / weights.sum())
+    total = weight = 0
+    for value in values:
+        total = total * (1 - alpha) + value
+        weight = weight * (1 - alpha) + 1
+    return total / weight
+
+
+class JobStats(object):
+    """
+    Fixed-capacity ring buffer of the queued, start and end times (in seconds
+    since the epoch) of the most recently finished jobs. Once the buffer is
+    full each new job replaces the oldest one.
+
+    The times are stored in flat arrays of doubles. If numpy is installed
+    durations() and wait_times() return numpy arrays computed from zero-copy
+    views of these arrays, so the statistics stay fast even with a capacity
+    of millions of jobs.
+    """
+    def __init__(self, capacity=200):
+        if capacity < 1:
+            raise exception.BaseException(
+                "job stats capacity must be at least 1")
+        self.capacity = capacity
+        self._queued = array.array(str('d'), [0.0]) * capacity
+        self._start = array.array(str('d'), [0.0]) * capacity
+        self._end = array.array(str('d'), [0.0]) * capacity
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return '<JobStats: %d/%d jobs>' % (self._count, self.capacity)
+
+    def append(self, queued, start, end):
+        """
+        Adds a finished job's queued, start and end times
+        """
+        i = self._next
+        self._queued[i] = queued
+        self._start[i] = start
+        self._end[i] = end
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def _ordered(self, times):
+        """
+        Returns the stored times in times, oldest job first
+        """
+        if HAS_NUMPY:
+            times = np.frombuffer(times, dtype=np.float64)
+        if self._count < self.capacity:
+            return times[:self._count]
+        if HAS_NUMPY:
+            return np.concatenate((times[self._next:], times[:self._next]))
+        return times[self._next:] + times[:self._next]
+
+    def _diff(self, a, b):
+        a, b = self._ordered(a), self._ordered(b)
+        if HAS_NUMPY:
+            return a - b
+        return [x - y for x, y in zip(a, b)]
+
+    def durations(self):
+        """
+        Returns the run times of the stored jobs, oldest job first
+        """
+        return self._diff(self._end, self._start)
+
+    def wait_times(self):
+        """
+        Returns the times the stored jobs waited in the queue, oldest job
+        first
+        """
+        return self._diff(self._start, self._queued)
@@ -36,6 +36,7 @@ from boto.exception import BotoServerError, EC2ResponseError, S3ResponseError
 
 from starcluster import config
 from starcluster import static
+from starcluster import sshutils
 from starcluster import logger
 from starcluster import commands
 from starcluster import exception
@@ -102,6 +103,7 @@ class StarClusterCLI(object):
             log.error(e.msg)
             sys.exit(1)
         gopts.CONFIG = cfg
+        sshutils.SSHClient.cache_profile = cfg.globals.cache_profile_env
         # Parse command arguments and invoke command.
         subcmdname, subargs = args[0], args[1:]
         try:
@@ -26,6 +26,7 @@ import string
 import pprint
 import warnings
 import datetime
+import collections
 
 import iptools
 
@@ -40,7 +41,7 @@ from starcluster import threadpool
 from starcluster import validators
 from starcluster import progressbar
 from starcluster import clustersetup
-from starcluster.node import Node
+from starcluster.node import Node, InstanceStateRefresher, execute_on_nodes
 from starcluster.plugins import sge
 from starcluster.utils import print_timing
 from starcluster.templates import user_msgs
@@ -414,6 +415,8 @@ class Cluster(object):
                  cluster_group=None,
                  force_spot_master=False,
                  disable_cloudinit=False,
+                 streaming_setup=False,
+                 nfs_subnet_exports=False,
                  subnet_id=None,
                  public_ips=None,
                  **kwargs):
@@ -444,6 +447,7 @@ class Cluster(object):
         self._nodes = []
         self._pool = None
         self._progress_bar = None
+        self._state_refresher = None
         self.__default_plugin = None
         self.__sge_plugin = None
 
@@ -508,7 +512,8 @@ class Cluster(object):
         if not self.__default_plugin:
             self.__default_plugin = clustersetup.DefaultClusterSetup(
                 disable_threads=self.disable_threads,
-                num_threads=self.num_threads)
+                num_threads=self.num_threads,
+                nfs_subnet_exports=self.nfs_subnet_exports)
         return self.__default_plugin
 
     @property
@@ -516,7 +521,8 @@ class Cluster(object):
         if not self.__sge_plugin:
             self.__sge_plugin = sge.SGEPlugin(
                 disable_threads=self.disable_threads,
-                num_threads=self.num_threads)
+                num_threads=self.num_threads,
+                nfs_subnet_exports=self.nfs_subnet_exports)
         return self.__sge_plugin
 
     def load_volumes(self, vols):
@@ -705,7 +711,8 @@ class Cluster(object):
                              subnet_id=self.subnet_id,
                              public_ips=self.public_ips,
                              disable_queue=self.disable_queue,
-                             disable_cloudinit=self.disable_cloudinit)
+                             disable_cloudinit=self.disable_cloudinit,
+                             nfs_subnet_exports=self.nfs_subnet_exports)
         user_settings = dict(cluster_user=self.cluster_user,
                              cluster_shell=self.cluster_shell,
                              keyname=self.keyname, spot_bid=self.spot_bid)
@@ -749,6 +756,17 @@ class Cluster(object):
         self._master.key_location = self.key_location
         return self._master
 
+    @property
+    def state_refresher(self):
+        """
+        Shared InstanceStateRefresher used by Node.update() for all of this
+        cluster's nodes
+        """
+        if not self._state_refresher:
+            self._state_refresher = InstanceStateRefresher(
+                self.ec2, max_age=self.refresh_interval)
+        return self._state_refresher
+
     @property
     def nodes(self):
         states = ['pending', 'running', 'stopping', 'stopped']
@@ -760,6 +778,7 @@ class Cluster(object):
         remove_nodes = [n for n in self._nodes if n.id not in current_ids]
         for node in remove_nodes:
             self._nodes.remove(node)
+        self.state_refresher.unregister(remove_nodes)
         # update node cache with latest instance data from EC2
         existing_nodes = dict([(n.id, n) for n in self._nodes])
         log.debug('existing nodes: %s' % existing_nodes)
@@ -778,6 +797,8 @@ class Cluster(object):
                 else:
                     self._nodes.append(n)
         self._nodes.sort(key=lambda n: n.alias)
+        self.state_refresher.register(self._nodes)
+        self.state_refresher.mark_fresh()
         log.debug('returning self._nodes = %s' % self._nodes)
         return self._nodes
 
@@ -1660,8 +1681,11 @@ class Cluster(object):
         """
         Waits for all nodes to come up and then runs the default
         StarCluster setup routines followed by any additional plugin setup
-        routines
+        routines. If streaming_setup is enabled nodes are configured as they
+        come up instead (see _setup_cluster_streaming)
         """
+        if self.streaming_setup:
+            return self._setup_cluster_streaming()
         self.wait_for_cluster()
         self._setup_cluster()
 
@@ -1677,6 +1701,115 @@ class Cluster(object):
             self.attach_volumes_to_master()
         self.run_plugins()
 
+    def _wait_for_master(self):
+        while True:
+            try:
+                master = self.master_node
+                break
+            except exception.MasterDoesNotExist:
+                time.sleep(self.refresh_interval)
+        master.wait(interval=self.refresh_interval)
+        return master
+
+    def _submit_streamed_nodes(self, plugins, master,
+                               kill_pending_after_mins=15):
+        """
+        Submits the setup of each worker node to the thread pool as soon as
+        it's running and returns a dictionary mapping instance ids to the
+        setup futures once all workers have been submitted.
+
+        Raises WorkerNodesNotRunning if a worker is stopped or terminated or
+        its spot request is cancelled or fails before it's running, or if the
+        workers aren't all running after kill_pending_after_mins minutes.
+        """
+        num_workers = self.cluster_size - 1
+        timeout = datetime.datetime.utcnow() + datetime.timedelta(
+            minutes=kill_pending_after_mins)
+        futures = {}
+        seen = {}
+        while True:
+            current = []
+            pending = []
+            for node in self.nodes:
+                current.append(node.id)
+                if node.is_master() or node.id in futures:
+                    continue
+                seen[node.id] = node.alias
+                if node.state == 'running':
+                    futures[node.id] = self.pool.submit(
+                        self._setup_streamed_node, (node, plugins, [master]),
+                        jobid=node.alias)
+                elif node.state == 'pending':
+                    pending.append(node.id)
+            if len(futures) >= num_workers:
+                return futures
+            waiting = ['%s (%s)' % (seen[id], id) for id in pending]
+            if self.spot_bid:
+                # open spot requests and active ones whose instance isn't
+                # visible yet will still bring up a worker
+                waiting += ['%s (spot request)' % spot.id
+                            for spot in self.spot_requests
+                            if spot.instance_id not in current]
+            if len(futures) + len(waiting) < num_workers:
+                lost = ['%s (%s)' % (alias, id) for id, alias in seen.items()
+                        if id not in futures and id not in pending]
+                raise exception.WorkerNodesNotRunning(
+                    self.cluster_tag, "%d of %d worker nodes were terminated, "
+                    "stopped or had their spot request cancelled before "
+                    "reaching the 'running' state" %
+                    (num_workers - len(futures) - len(waiting), num_workers),
+                    sorted(lost))
+            if datetime.datetime.utcnow() > timeout:
+                raise exception.WorkerNodesNotRunning(
+                    self.cluster_tag, "%d worker nodes were not running after "
+                    "%d mins" % (num_workers - len(futures),
+                                 kill_pending_after_mins), waiting)
+            time.sleep(self.refresh_interval)
+
+    def _setup_streamed_node(self, node, plugins, nodes):
+        node.wait(interval=self.refresh_interval)
+        log.info("%s is up" % node.alias)
+        for plug in plugins:
+            self.run_plugin(plug, method_name="setup_node", node=node,
+                            nodes=nodes)
+
+    @print_timing("Configuring cluster")
+    def _setup_cluster_streaming(self):
+        """
+        Configures the cluster while it's coming up rather than waiting for
+        all nodes first. The master is configured as soon as it's reachable
+        and each worker node is configured (node-local steps only) as soon as
+        its SSH daemon answers. Once all nodes are up the cluster-wide steps
+        (/etc/hosts, passwordless ssh, SGE parallel environment) are applied
+        and the user plugins are run.
+        """
+        log.info("Waiting for master node to come up... (updating every "
+                 "%ds)" % self.refresh_interval)
+        master = self._wait_for_master()
+        log.info("The master node is %s" % master.private_ip_address)
+        log.info("Configuring cluster...")
+        if self.volumes:
+            self.attach_volumes_to_master()
+        plugs = [self._default_plugin]
+        if not self.disable_queue:
+            plugs.append(self._sge_plugin)
+        for plug in plugs:
+            self.run_plugin(plug, nodes=[master])
+        futures = self._submit_streamed_nodes(plugs, master)
+        for future in futures.values():
+            future.wait()
+        excs = [[f.exception(), f.traceback, f.jobid]
+                for f in futures.values() if f.exception() is not None]
+        if excs:
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", excs)
+        self.pool.log_stragglers(list(futures.values()))
+        nodes = self.nodes
+        for plug in plugs:
+            self.run_plugin(plug, method_name="finalize_setup", nodes=nodes)
+        for plug in self.plugins:
+            self.run_plugin(plug, nodes=nodes)
+
     def run_plugins(self, plugins=None, method_name="run", node=None,
                     reverse=False):
         """
@@ -1695,7 +1828,8 @@ class Cluster(object):
         for plug in plugs:
             self.run_plugin(plug, method_name=method_name, node=node)
 
-    def run_plugin(self, plugin, name='', method_name='run', node=None):
+    def run_plugin(self, plugin, name='', method_name='run', node=None,
+                   nodes=None):
         """
         Run a StarCluster plugin.
 
@@ -1704,6 +1838,7 @@ class Cluster(object):
         method_name - the method to run within the plugin (default: "run")
         node - optional node to pass as first argument to plugin method (used
         for on_add_node/on_remove_node)
+        nodes - list of nodes to pass to the plugin (default: all nodes)
         """
         plugin_name = name or getattr(plugin, '__name__',
                                       utils.get_fq_class_name(plugin))
@@ -1713,7 +1848,7 @@ class Cluster(object):
                 log.warn("Plugin %s has no %s method...skipping" %
                          (plugin_name, method_name))
                 return
-            args = [self.nodes, self.master_node, self.cluster_user,
+            args = [nodes or self.nodes, self.master_node, self.cluster_user,
                     self.cluster_shell, self.volumes]
             if node:
                 args.insert(0, node)
@@ -1730,6 +1865,33 @@ class Cluster(object):
             log.error("Error occured while running plugin '%s':" % plugin_name)
             raise
 
+    def execute_all(self, command, nodes=None, max_concurrency=None,
+                    fail_fast=False, ignore_exit_status=False,
+                    source_profile=True):
+        """
+        Run command on every node at once and return an ordered dictionary
+        mapping each node's alias to a sshutils.RemoteCommandResult holding
+        that node's stdout, stderr and exit status.
+
+        nodes - nodes to run the command on (default: all running nodes)
+        max_concurrency - maximum number of nodes running the command at any
+                          time (default: all)
+        fail_fast - stop at the first node that fails and raise
+                    exception.RemoteCommandsFailed
+        ignore_exit_status - return the results without raising if the
+                             command fails on any node (collect-all mode)
+        """
+        if nodes is None:
+            nodes = self.running_nodes
+        nodes = list(nodes)
+        if not nodes:
+            return collections.OrderedDict()
+        return execute_on_nodes(
+            nodes, command, pool=self.pool, max_concurrency=max_concurrency,
+            fail_fast=fail_fast, ignore_exit_status=ignore_exit_status,
+            source_profile=source_profile,
+            progress_bar=self.progress_bar.reset())
+
     def ssh_to_master(self, user='root', command=None, forward_x11=False,
                       forward_agent=False, pseudo_tty=False):
         return self.master_node.shell(user=user, command=command,
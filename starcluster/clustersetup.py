@@ -24,10 +24,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import time
+import collections
 
 import posixpath
+import threading
 
 from starcluster import utils
+from starcluster import node as node_module
 from starcluster import threadpool
 from starcluster.utils import print_timing
 from starcluster.logger import log
@@ -95,7 +98,12 @@ class DefaultClusterSetup(ClusterSetup):
     """
     Default ClusterSetup implementation for StarCluster
     """
-    def __init__(self, disable_threads=False, num_threads=20):
+    # serializes changes to the master node when several nodes are being
+    # configured at the same time (see setup_node)
+    _master_lock = threading.RLock()
+
+    def __init__(self, disable_threads=False, num_threads=20,
+                 nfs_subnet_exports=False):
         self._nodes = None
         self._master = None
         self._user = None
@@ -103,6 +111,7 @@ class DefaultClusterSetup(ClusterSetup):
         self._volumes = None
         self._disable_threads = disable_threads
         self._num_threads = num_threads
+        self._nfs_subnet_exports = nfs_subnet_exports
         self._pool = None
 
     @property
@@ -120,6 +129,23 @@ class DefaultClusterSetup(ClusterSetup):
     def running_nodes(self):
         return filter(lambda x: x.state in ['running'], self._nodes)
 
+    def _execute_all(self, command, nodes=None, **kwargs):
+        """
+        Run command concurrently on nodes (default: all nodes) over one
+        channel per node and return the per-node results. See
+        node.execute_on_nodes for the available keyword arguments.
+        """
+        if nodes is None:
+            nodes = self._nodes
+        nodes = list(nodes)
+        if not nodes:
+            return collections.OrderedDict()
+        pbar = None
+        if not self._disable_threads:
+            pbar = self.pool.progress_bar.reset()
+        return node_module.execute_on_nodes(nodes, command, pool=self.pool,
+                                            progress_bar=pbar, **kwargs)
+
     def _setup_hostnames(self, nodes=None):
         """
         Set each node's hostname to their alias.
@@ -134,7 +160,6 @@ class DefaultClusterSetup(ClusterSetup):
         first_uid = 1000
         uid, gid = first_uid, first_uid
         mconn = self._master.ssh
-        umap = self._master.get_user_map(key_by_uid=True)
         uid_db = {}
         files = mconn.ls('/home')
         for file in files:
@@ -149,7 +174,7 @@ class DefaultClusterSetup(ClusterSetup):
             uid = max(uid, first_uid)
             gid = max(gid, first_uid)
         # make sure newly selected uid is not already in /etc/passwd
-        while umap.get(uid):
+        while self._master.getpwuid(uid):
             uid += 1
             gid += 1
         return uid, gid
@@ -176,16 +201,10 @@ class DefaultClusterSetup(ClusterSetup):
             uid, gid = self._get_max_unused_user_id()
         return uid, gid
 
-    def _setup_cluster_user(self, user=None):
+    def _get_cluster_user_id(self, user=None):
         """
-        Create cluster user on all StarCluster nodes
-
-        This command takes care to examine existing folders in /home
-        and set the new cluster_user's uid/gid accordingly. This is necessary
-        for the case of EBS volumes containing /home with large amounts of data
-        in them. It's much less expensive in this case to set the uid/gid of
-        the new user to be the existing uid/gid of the dir in EBS rather than
-        chowning potentially terabytes of data.
+        Returns the uid/gid to use for the cluster user (see
+        _setup_cluster_user)
         """
         user = user or self._user
         uid, gid = self._get_new_user_id(user)
@@ -197,6 +216,20 @@ class DefaultClusterSetup(ClusterSetup):
                 "instance is still up.".format(user, uid, gid))
         log.info("Creating cluster user: %s (uid: %d, gid: %d)" %
                  (user, uid, gid))
+        return uid, gid
+
+    def _setup_cluster_user(self, user=None):
+        """
+        Create cluster user on all StarCluster nodes
+
+        This command takes care to examine existing folders in /home
+        and set the new cluster_user's uid/gid accordingly. This is necessary
+        for the case of EBS volumes containing /home with large amounts of data
+        in them. It's much less expensive in this case to set the uid/gid of
+        the new user to be the existing uid/gid of the dir in EBS rather than
+        chowning potentially terabytes of data.
+        """
+        uid, gid = self._get_cluster_user_id(user)
         self._add_user_to_nodes(uid, gid, self._nodes)
 
     def _add_user_to_node(self, uid, gid, node):
@@ -253,11 +286,27 @@ class DefaultClusterSetup(ClusterSetup):
         """ Configure /etc/hosts on all StarCluster nodes"""
         log.info("Configuring /etc/hosts on each node")
         nodes = nodes or self._nodes
+        entries = node_module.render_etc_hosts(nodes)
         for node in nodes:
-            self.pool.simple_job(node.add_to_etc_hosts, (nodes, ),
+            self.pool.simple_job(node.set_etc_hosts, (entries, ),
                                  jobid=node.alias)
         self.pool.wait(numtasks=len(nodes))
 
+    def _add_to_etc_hosts(self, new_node, nodes):
+        """
+        Write the full /etc/hosts block on new_node and send only new_node's
+        entry to the other nodes
+        """
+        log.info("Configuring /etc/hosts on each node")
+        self.pool.simple_job(new_node.set_etc_hosts,
+                             (node_module.render_etc_hosts(nodes), ),
+                             jobid=new_node.alias)
+        others = [n for n in nodes if n.id != new_node.id]
+        for node in others:
+            self.pool.simple_job(node.add_to_etc_hosts, ([new_node], ),
+                                 jobid=node.alias)
+        self.pool.wait(numtasks=len(others) + 1)
+
     def _setup_passwordless_ssh(self, nodes=None):
         """
         Properly configure passwordless ssh for root and CLUSTER_USER on all
@@ -268,13 +317,17 @@ class DefaultClusterSetup(ClusterSetup):
         nodes = nodes or self.nodes
         master.generate_key_for_user('root', auth_new_key=True,
                                      auth_conn_key=True)
-        master.enable_passwordless_ssh('root', nodes)
+        pbar = None
+        if not self._disable_threads:
+            pbar = self.pool.progress_bar.reset()
+        master.enable_passwordless_ssh('root', nodes, pool=self.pool,
+                                       progress_bar=pbar)
         # generate public/private keys, authorized_keys, and known_hosts files
         # for cluster_user once on master node...NFS takes care of the rest
         log.info("Configuring passwordless ssh for %s" % self._user)
         master.generate_key_for_user(self._user, auth_new_key=True,
                                      auth_conn_key=True)
-        master.add_to_known_hosts(self._user, nodes)
+        master.add_to_known_hosts(self._user, nodes, pool=self.pool)
 
     def _setup_ebs_volumes(self):
         """
@@ -282,6 +335,9 @@ class DefaultClusterSetup(ClusterSetup):
         """
         # setup /etc/fstab on master to use block device if specified
         master = self._master
+        # volumes are attached after boot, don't trust previously gathered
+        # device and partition facts
+        master.invalidate_facts()
         devices = master.get_device_map()
         for vol in self._volumes:
             vol = self._volumes[vol]
@@ -375,10 +431,65 @@ class DefaultClusterSetup(ClusterSetup):
         if start_server:
             master.start_nfs_server()
         if len(nodes) > 0:
-            master.export_fs_to_nodes(nodes, export_paths)
+            master.export_fs_to_nodes(nodes, export_paths,
+                                      by_subnet=self._nfs_subnet_exports)
             self._mount_nfs_shares(nodes, export_paths=export_paths)
 
 
+    def _get_setup_graph(self):
+        """
+        Returns a TaskGraph containing the default setup steps for all nodes.
+
+        Node-local steps are separate tasks for each node so that every node
+        moves through the setup independently. Steps on the master that other
+        steps depend on (EBS volumes, cluster user id, NFS server and exports)
+        are single tasks. Tasks are grouped by the node whose SSH connection
+        they use so that no connection is used by two tasks at once.
+        """
+        master = self._master
+        nodes = self._nodes
+        workers = self.nodes
+        export_paths = self._get_nfs_export_paths()
+        hosts_entries = node_module.render_etc_hosts(nodes)
+        graph = threadpool.TaskGraph(self.pool, name='setup tasks')
+
+        def add_user(node):
+            uid, gid = graph.result('user_id')
+            self._add_user_to_node(uid, gid, node)
+
+        mgroup = master.alias
+        graph.add_task('ebs_volumes', self._setup_ebs_volumes, group=mgroup)
+        graph.add_task('user_id', self._get_cluster_user_id,
+                       deps=['ebs_volumes'], group=mgroup)
+        graph.add_task('nfs_server', master.start_nfs_server,
+                       deps=['ebs_volumes'], group=mgroup)
+        for node in nodes:
+            alias = node.alias
+            graph.add_task('hostname:' + alias, node.set_hostname,
+                           group=alias)
+            graph.add_task('etc_hosts:' + alias, node.set_etc_hosts,
+                           (hosts_entries,), group=alias)
+            graph.add_task('user:' + alias, add_user, (node,),
+                           deps=['user_id'], group=alias)
+            graph.add_task('scratch:' + alias, self._setup_scratch_on_node,
+                           (node,), deps=['user:' + alias], group=alias)
+        if workers:
+            graph.add_task('export', master.export_fs_to_nodes,
+                           (workers, export_paths),
+                           dict(by_subnet=self._nfs_subnet_exports),
+                           deps=['nfs_server', 'etc_hosts:' + mgroup],
+                           group=mgroup)
+        for node in workers:
+            alias = node.alias
+            graph.add_task('mount:' + alias, node.mount_nfs_shares,
+                           (master, export_paths),
+                           deps=['export', 'etc_hosts:' + alias,
+                                 'user:' + alias], group=alias)
+        # copies keys to every node's filesystem so it must run last
+        graph.add_task('passwordless_ssh', self._setup_passwordless_ssh,
+                       deps=list(graph.tasks), group=mgroup)
+        return graph
+
     def run(self, nodes, master, user, user_shell, volumes):
         """Start cluster configuration"""
         self._nodes = nodes
@@ -386,12 +497,46 @@ class DefaultClusterSetup(ClusterSetup):
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        self._setup_hostnames()
-        self._setup_ebs_volumes()
-        self._setup_cluster_user()
-        self._setup_scratch()
+        graph = self._get_setup_graph()
+        log.info("Configuring %d node(s)..." % len(nodes))
+        graph.run()
+
+    def setup_node(self, node, nodes, master, user, user_shell, volumes):
+        """
+        Configure a single worker node as soon as it comes up during a
+        streaming cluster start. Only the steps that concern this node are
+        performed, the cluster-wide steps are left to finalize_setup. May be
+        called concurrently for different nodes.
+        """
+        self._nodes = nodes
+        self._master = master
+        self._user = user
+        self._user_shell = user_shell
+        self._volumes = volumes
+        log.info("Configuring %s..." % node.alias)
+        node.set_hostname()
+        export_paths = self._get_nfs_export_paths()
+        with self._master_lock:
+            master.add_to_etc_hosts([node])
+            master.export_fs_to_nodes([node], export_paths,
+                                      by_subnet=self._nfs_subnet_exports)
+        node.add_to_etc_hosts([master, node])
+        node.mount_nfs_shares(master, export_paths)
+        cluster_user = master.getpwnam(user)
+        self._add_user_to_node(cluster_user.pw_uid, cluster_user.pw_gid, node)
+        self._setup_scratch_on_node(node)
+
+    def finalize_setup(self, nodes, master, user, user_shell, volumes):
+        """
+        Perform the cluster-wide setup steps of a streaming cluster start
+        once all nodes have been configured with setup_node
+        """
+        self._nodes = nodes
+        self._master = master
+        self._user = user
+        self._user_shell = user_shell
+        self._volumes = volumes
         self._setup_etc_hosts()
-        self._setup_nfs()
         self._setup_passwordless_ssh()
 
     def _remove_from_etc_hosts(self, node):
@@ -405,8 +550,7 @@ class DefaultClusterSetup(ClusterSetup):
     def _remove_from_known_hosts(self, node):
         nodes = filter(lambda x: x.id != node.id, self.running_nodes)
         for n in nodes:
-            n.remove_from_known_hosts('root', [node])
-            n.remove_from_known_hosts(self._user, [node])
+            n.remove_from_known_hosts(['root', self._user], [node])
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
         self._nodes = nodes
@@ -434,7 +578,7 @@ class DefaultClusterSetup(ClusterSetup):
         self._user_shell = user_shell
         self._volumes = volumes
         self._setup_hostnames(nodes=[node])
-        self._setup_etc_hosts(nodes)
+        self._add_to_etc_hosts(node, nodes)
         self._setup_nfs(nodes=[node], start_server=False)
         self._create_user(node)
         self._setup_scratch(nodes=[node])
@@ -17,6 +17,7 @@
 
 import glob
 
+from starcluster import sshutils
 from starcluster import exception
 from starcluster.commands.completers import ClusterCompleter
 
@@ -41,6 +42,10 @@ class CmdGet(ClusterCompleter):
         # Copy a file or dir from a node (node001 in this example)
         $ starcluster get mycluster --node node001 /remote/path /local/path
 
+        # Copy a large dataset over 8 parallel streams and resume it later
+        # if the transfer is interrupted
+        $ starcluster get mycluster -j 8 --resume /remote/data /local/data
+
     """
     names = ['get']
 
@@ -49,6 +54,34 @@ class CmdGet(ClusterCompleter):
                           help="Transfer files as USER ")
         parser.add_option("-n", "--node", dest="node", default="master",
                           help="Transfer files from NODE (defaults to master)")
+        parser.add_option("-j", "--streams", dest="streams", type="int",
+                          default=1, help="Transfer files over STREAMS "
+                          "parallel SFTP sessions instead of a single scp "
+                          "stream. Files larger than --chunk-size are split "
+                          "into chunks that are sent concurrently")
+        parser.add_option("--chunk-size", dest="chunk_size",
+                          type="int", default=64,
+                          help="Size in MB of the chunks large files are "
+                          "split into (default: 64)")
+        parser.add_option("--resume", dest="resume",
+                          action="store_true", default=False,
+                          help="Only transfer the chunks whose md5 checksum "
+                          "differs at the destination (e.g. to resume an "
+                          "interrupted transfer)")
+        parser.add_option("-C", "--compress", dest="compress",
+                          action="store_true", default=None,
+                          help="Compress the data on the wire")
+        parser.add_option("-t", "--tar", dest="tar", action="store_true",
+                          default=None,
+                          help="Stream all files as a single tar archive "
+                          "(default: only for directories with more than "
+                          "%d files)" % sshutils.SSHClient.tar_threshold)
+        parser.add_option("-T", "--no-tar", dest="tar", action="store_false",
+                          help="Never stream files as a tar archive")
+        parser.add_option("--tar-compression", dest="tar_compression",
+                          action="store", choices=["gzip", "bzip2"],
+                          default=None,
+                          help="Compress the tar archive with gzip or bzip2")
 
     def execute(self, args):
         if len(args) < 3:
@@ -65,4 +98,8 @@ class CmdGet(ClusterCompleter):
             if not glob.has_magic(rpath) and not node.ssh.path_exists(rpath):
                 raise exception.BaseException(
                     "Remote file or directory does not exist: %s" % rpath)
-        node.ssh.get(rpaths, lpath)
+        node.ssh.get(rpaths, lpath, streams=self.opts.streams,
+                     resume=self.opts.resume, compress=self.opts.compress,
+                     chunk_size=self.opts.chunk_size * 1024 ** 2,
+                     tar=self.opts.tar,
+                     tar_compression=self.opts.tar_compression)
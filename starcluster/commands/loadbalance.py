@@ -96,6 +96,12 @@ class CmdLoadBalance(ClusterCompleter):
                           action="callback", type="int", default=None,
                           callback=self._positive_int,
                           help="Minutes to look back for past job history")
+        parser.add_option("-j", "--jobstats_capacity",
+                          dest="jobstats_capacity", action="callback",
+                          type="int", default=None,
+                          callback=self._positive_int,
+                          help="Number of finished jobs to keep statistics "
+                          "for (default: 200)")
         parser.add_option("-n", "--min_nodes", dest="min_nodes",
                           action="callback", type="int", default=None,
                           callback=self._positive_int,
@@ -17,6 +17,7 @@
 
 import os
 
+from starcluster import sshutils
 from starcluster import exception
 from starcluster.commands.completers import ClusterCompleter
 
@@ -41,6 +42,14 @@ class CmdPut(ClusterCompleter):
         # Copy a file or dir to a node (node001 in this example)
         $ starcluster put mycluster --node node001 /local/path /remote/path
 
+        # Copy a large dataset over 8 parallel streams and resume it later
+        # if the transfer is interrupted
+        $ starcluster put mycluster -j 8 --resume /local/data /remote/data
+
+        # Push only what changed since the last sync of a source tree and
+        # remove remote files that were deleted locally
+        $ starcluster put mycluster --sync --delete ~/src/myapp /opt
+
 
     This will copy a file or directory to the remote server
     """
@@ -51,11 +60,50 @@ class CmdPut(ClusterCompleter):
                           help="Transfer files as USER ")
         parser.add_option("-n", "--node", dest="node", default="master",
                           help="Transfer files to NODE (defaults to master)")
+        parser.add_option("-j", "--streams", dest="streams", type="int",
+                          default=1, help="Transfer files over STREAMS "
+                          "parallel SFTP sessions instead of a single scp "
+                          "stream. Files larger than --chunk-size are split "
+                          "into chunks that are sent concurrently")
+        parser.add_option("--chunk-size", dest="chunk_size",
+                          type="int", default=64,
+                          help="Size in MB of the chunks large files are "
+                          "split into (default: 64)")
+        parser.add_option("--resume", dest="resume",
+                          action="store_true", default=False,
+                          help="Only transfer the chunks whose md5 checksum "
+                          "differs at the destination (e.g. to resume an "
+                          "interrupted transfer)")
+        parser.add_option("-C", "--compress", dest="compress",
+                          action="store_true", default=None,
+                          help="Compress the data on the wire")
+        parser.add_option("-t", "--tar", dest="tar", action="store_true",
+                          default=None,
+                          help="Stream all files as a single tar archive "
+                          "(default: only for directories with more than "
+                          "%d files)" % sshutils.SSHClient.tar_threshold)
+        parser.add_option("-T", "--no-tar", dest="tar", action="store_false",
+                          help="Never stream files as a tar archive")
+        parser.add_option("--tar-compression", dest="tar_compression",
+                          action="store", choices=["gzip", "bzip2"],
+                          default=None,
+                          help="Compress the tar archive with gzip or bzip2")
+        parser.add_option("-s", "--sync", dest="sync",
+                          action="store_true", default=False,
+                          help="Only transfer new files and the changed "
+                          "chunks of modified files (compared by size, mtime "
+                          "and md5 checksums)")
+        parser.add_option("--delete", dest="delete",
+                          action="store_true", default=False,
+                          help="With --sync, delete remote files that don't "
+                          "exist locally")
 
     def execute(self, args):
         if len(args) < 3:
             self.parser.error("please specify a cluster, local files or " +
                               "directories, and a remote destination path")
+        if self.opts.delete and not self.opts.sync:
+            self.parser.error("--delete requires --sync")
         ctag = args[0]
         rpath = args[-1]
         lpaths = args[1:-1]
@@ -70,4 +118,9 @@ class CmdPut(ClusterCompleter):
         if len(lpaths) > 1 and not node.ssh.isdir(rpath):
             raise exception.BaseException("Remote path does not exist: %s" %
                                           rpath)
-        node.ssh.put(lpaths, rpath)
+        node.ssh.put(lpaths, rpath, streams=self.opts.streams,
+                     resume=self.opts.resume, compress=self.opts.compress,
+                     chunk_size=self.opts.chunk_size * 1024 ** 2,
+                     tar=self.opts.tar,
+                     tar_compression=self.opts.tar_compression,
+                     sync=self.opts.sync, delete=self.opts.delete)
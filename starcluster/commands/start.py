@@ -101,6 +101,14 @@ class CmdStart(ClusterCompleter):
                           default=None, action='store_false',
                           help="Do NOT assign public ips to all VPC nodes "
                           "(VPC clusters only) (default)"),
+        parser.add_option("--streaming-setup", dest="streaming_setup",
+                          default=None, action='store_true',
+                          help="configure each node as soon as it comes up "
+                          "instead of waiting for all nodes first")
+        parser.add_option("--no-streaming-setup", dest="streaming_setup",
+                          default=None, action='store_false',
+                          help="wait for all nodes to come up before "
+                          "configuring the cluster (default)")
         opt = parser.add_option("-c", "--cluster-template", action="store",
                                 dest="cluster_template", choices=templates,
                                 default=None, help="cluster template to use "
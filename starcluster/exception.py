@@ -85,6 +85,21 @@ class RemoteCommandFailed(SSHError):
         self.output = output
 
 
+class RemoteCommandsFailed(SSHError):
+    """
+    Raised when a command run concurrently on several hosts fails on one or
+    more of them
+    """
+    def __init__(self, command, results):
+        self.command = command
+        self.results = results
+        failed = [r for r in results.values() if r.failed]
+        self.msg = "remote command '%s' failed on %d host(s): %s" % (
+            command, len(failed),
+            ', '.join(['%s (status %s)' % (r.host, r.exit_status)
+                       for r in failed]))
+
+
 class SSHAccessDeniedViaAuthKeys(BaseException):
     """
     Raised when SSH access for a given user has been restricted via
@@ -443,6 +458,25 @@ class ClusterExists(BaseException):
             self.msg = user_msgs.cluster_exists % ctx
 
 
+class WorkerNodesNotRunning(BaseException):
+    """
+    Raised when worker nodes will never reach, or did not reach in time, the
+    'running' state during a streaming cluster setup
+    """
+    def __init__(self, cluster_name, reason, nodes):
+        self.msg = "Cluster '%s' was not fully configured: %s" % (cluster_name,
+                                                                  reason)
+        if nodes:
+            self.msg += "\n\nAffected nodes and spot requests:\n\n"
+            self.msg += "\n".join(nodes)
+        self.msg += "\n\nThe cluster-wide setup steps and plugins were not "
+        self.msg += "run. To configure\nthe nodes that are running rerun "
+        self.msg += "the same start command with the\n-x (--no-create) and "
+        self.msg += "--no-streaming-setup options. You can then add the\n"
+        self.msg += "missing nodes with:\n\n   $ starcluster addnode "
+        self.msg += cluster_name
+
+
 class CancelledStartRequest(BaseException):
     def __init__(self, tag):
         self.msg = "Request to start cluster '%s' was cancelled!!!" % tag
@@ -537,6 +571,12 @@ class ThreadPoolException(BaseException):
         return '\n'.join(excs)
 
 
+class ThreadPoolTimeout(BaseException):
+    def __init__(self, jobid, timeout):
+        self.msg = "job %s did not finish within %s seconds" % (jobid,
+                                                                timeout)
+
+
 class IncompatibleCluster(BaseException):
     default_msg = """\
 INCOMPATIBLE CLUSTER: %(tag)s
@@ -325,10 +325,9 @@ class EBSImageCreator(ImageCreator):
         log.info("Mounting %s on %s" % (dev, mount_point))
         host_ssh.execute('mount %s %s' % (dev, mount_point))
         log.info("Configuring /etc/fstab")
-        host_ssh.remove_lines_from_file('/etc/fstab', '/mnt')
-        fstab = host_ssh.remote_file('/etc/fstab', 'a')
-        fstab.write('/dev/sdb1 /mnt auto defaults,nobootwait 0 0\n')
-        fstab.close()
+        with host_ssh.edit_file('/etc/fstab') as fstab:
+            fstab.remove_lines('/mnt')
+            fstab.append('/dev/sdb1 /mnt auto defaults,nobootwait 0 0')
         log.info("Syncing root filesystem to new volume (%s)" % vol.id)
         host_ssh.execute(
             'rsync -aqx --exclude %(mpt)s --exclude /root/.ssh / %(mpt)s' %
@@ -20,13 +20,19 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import re
+import json
 import time
+import uuid
 import stat
 import base64
 import socket
+import threading
 import posixpath
 import subprocess
 
+import six
+from six.moves import shlex_quote
+
 from starcluster import utils
 from starcluster import static
 from starcluster import sshutils
@@ -34,8 +40,137 @@ from starcluster import awsutils
 from starcluster import managers
 from starcluster import userdata
 from starcluster import exception
+from starcluster import threadpool
 from starcluster.logger import log
 
+# Gathers everything Node.facts exposes in a single round-trip. Runs under
+# either python 2 or 3 on the remote host and prints one line of JSON.
+FACTS_SCRIPT = """
+import json, os, subprocess
+
+def read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return ''
+
+def run(cmd):
+    try:
+        devnull = open(os.devnull, 'w')
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=devnull)
+        out = proc.communicate()[0]
+        devnull.close()
+        return out.decode('utf-8', 'replace')
+    except OSError:
+        return ''
+
+cpuinfo = read('/proc/cpuinfo').splitlines()
+meminfo = dict([l.split(':', 1) for l in read('/proc/meminfo').splitlines()
+                if ':' in l])
+print(json.dumps(dict(
+    arch=os.uname()[4],
+    cpus=len([l for l in cpuinfo if l.startswith('processor')]),
+    memory=int(meminfo.get('MemTotal', '0 kB').split()[0]) // 1024,
+    fdisk=run('fdisk -l'),
+    partitions=read('/proc/partitions'),
+    mounts=run('mount'),
+    passwd=read('/etc/passwd'),
+    group=read('/etc/group'))))
+"""
+
+# Fallback for images without python: prints the same facts as sections
+# that each start with a FACTS_MARKER line
+FACTS_MARKER = '__starcluster_fact__'
+FACTS_SHELL_SCRIPT = """
+fact() { echo "%s $1"; }
+fact arch; uname -m
+fact cpus; grep -c ^processor /proc/cpuinfo
+fact memory; awk '/^MemTotal:/ {print int($2 / 1024)}' /proc/meminfo
+fact fdisk; fdisk -l 2>/dev/null
+fact partitions; cat /proc/partitions
+fact mounts; mount
+fact passwd; cat /etc/passwd
+fact group; cat /etc/group
+""" % FACTS_MARKER
+
+
+def render_etc_hosts(nodes):
+    """
+    Returns the /etc/hosts entries for nodes sorted by alias
+    """
+    return [n.get_hosts_entry() for n in sorted(nodes, key=lambda n: n.alias)]
+
+
+class PasswdIndex(object):
+    """
+    Index of a node's passwd and group databases by name and by id
+
+    Built once from the contents of /etc/passwd and /etc/group and updated
+    in place by Node.add_user() and friends so that lookups never need to
+    read the remote files again. Like the standard pwd/grp modules the
+    lookup methods return utils.struct_passwd and utils.struct_group
+    objects. Unlike the standard modules they return None for unknown
+    names and ids instead of raising KeyError.
+    """
+    def __init__(self, users=[], groups=[]):
+        self.users = {}
+        self.uids = {}
+        self.groups = {}
+        self.gids = {}
+        for user in users:
+            self.add_user(user)
+        for group in groups:
+            self.add_group(group)
+
+    def getpwnam(self, name):
+        return self.users.get(name)
+
+    def getpwuid(self, uid):
+        return self.uids.get(uid)
+
+    def getgrnam(self, name):
+        return self.groups.get(name)
+
+    def getgrgid(self, gid):
+        return self.gids.get(gid)
+
+    def add_user(self, user):
+        self.remove_user(user.pw_name)
+        self.users[user.pw_name] = user
+        self.uids[user.pw_uid] = user
+
+    def remove_user(self, name):
+        user = self.users.pop(name, None)
+        if user and self.uids.get(user.pw_uid) is user:
+            del self.uids[user.pw_uid]
+            # other users may share the uid (useradd -o)
+            for other in self.users.values():
+                if other.pw_uid == user.pw_uid:
+                    self.uids[user.pw_uid] = other
+
+    def add_group(self, group):
+        self.remove_group(group.gr_name)
+        self.groups[group.gr_name] = group
+        self.gids[group.gr_gid] = group
+
+    def remove_group(self, name):
+        group = self.groups.pop(name, None)
+        if group and self.gids.get(group.gr_gid) is group:
+            del self.gids[group.gr_gid]
+            for other in self.groups.values():
+                if other.gr_gid == group.gr_gid:
+                    self.gids[group.gr_gid] = other
+
+    def add_group_member(self, groupname, username):
+        group = self.groups.get(groupname)
+        if group and username not in group.gr_mem:
+            members = [m for m in group.gr_mem if m] + [username]
+            self.add_group(utils.struct_group([group.gr_name,
+                                               group.gr_passwd,
+                                               group.gr_gid, members]))
+
 
 class NodeManager(managers.Manager):
     """
@@ -65,6 +200,93 @@ class NodeManager(managers.Manager):
         return node
 
 
+def execute_on_nodes(nodes, command, pool=None, max_concurrency=None,
+                     fail_fast=False, ignore_exit_status=False,
+                     source_profile=True, progress_bar=None):
+    """
+    Run command on all nodes concurrently and return an ordered dictionary
+    mapping each node's alias to a sshutils.RemoteCommandResult.
+
+    Any missing SSH connections are established first (in parallel if a
+    threadpool is given), after which one channel per node is opened and all
+    output is collected from a single thread. See sshutils.execute_parallel
+    for the remaining options.
+    """
+    nodes = list(nodes)
+    unconnected = [n for n in nodes if not n.ssh.is_active()]
+    if pool and len(unconnected) > 1:
+        pool.map(lambda n: n.ssh.transport, unconnected,
+                 jobid_fn=lambda n: n.alias)
+    clients = [(n.alias, n.ssh) for n in nodes]
+    return sshutils.execute_parallel(clients, command,
+                                     max_concurrency=max_concurrency,
+                                     fail_fast=fail_fast,
+                                     ignore_exit_status=ignore_exit_status,
+                                     source_profile=source_profile,
+                                     progress_bar=progress_bar)
+
+
+class InstanceStateRefresher(object):
+    """
+    Refreshes the EC2 instance data of a group of nodes using a single
+    DescribeInstances call for all of them.
+
+    Nodes registered with the refresher call refresh() from Node.update()
+    instead of querying EC2 individually. The actual API call is only made if
+    the cached data is older than max_age seconds, so any number of threads
+    polling node states results in at most one API call per max_age seconds.
+    """
+    def __init__(self, ec2, max_age=30):
+        self.ec2 = ec2
+        self.max_age = max_age
+        self._nodes = {}
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+
+    def register(self, nodes):
+        """Registers nodes to be refreshed by this refresher"""
+        with self._lock:
+            for node in nodes:
+                self._nodes[node.id] = node
+                node.state_refresher = self
+
+    def unregister(self, nodes):
+        with self._lock:
+            for node in nodes:
+                self._nodes.pop(node.id, None)
+                if node.state_refresher is self:
+                    node.state_refresher = None
+
+    def mark_fresh(self):
+        """
+        Marks the instance data as fresh, e.g. after the caller has just
+        fetched it for all registered nodes
+        """
+        self._last_refresh = time.time()
+
+    def refresh(self, force=False):
+        """
+        Fetches the latest instance data for all registered nodes in a single
+        API call and updates each Node.instance in place unless the data is
+        less than max_age seconds old (or force=True)
+        """
+        with self._lock:
+            age = time.time() - self._last_refresh
+            if not force and age < self.max_age:
+                return
+            ids = list(self._nodes.keys())
+            if ids:
+                log.debug("refreshing instance state for %d nodes" %
+                          len(ids))
+                instances = self.ec2.get_all_instances(
+                    filters={'instance-id': ids})
+                for instance in instances:
+                    node = self._nodes.get(instance.id)
+                    if node is not None:
+                        node.instance = instance
+            self._last_refresh = time.time()
+
+
 class Node(object):
     """
     This class represents a single compute node in a StarCluster.
@@ -84,6 +306,11 @@ class Node(object):
 
     'user' keyword optionally specifies user to ssh as (defaults to root)
     """
+    NFS_EXPORT_OPTIONS = "async,no_root_squash,no_subtree_check,rw"
+    # apply up to this many export changes to the running NFS server one by
+    # one instead of reloading all exports with 'exportfs -ra'
+    EXPORTFS_INCREMENTAL_MAX = 16
+
     def __init__(self, instance, key_location, alias=None, user='root'):
         self.instance = instance
         self.ec2 = awsutils.EasyEC2(instance.connection.aws_access_key_id,
@@ -94,9 +321,13 @@ class Node(object):
         self._alias = alias
         self._groups = None
         self._ssh = None
-        self._num_procs = None
-        self._memory = None
+        self._facts = None
+        self._facts_lock = threading.Lock()
+        self._host_key = None
+        self._subnet_cidr = None
+        self._subnet_exports = set()
         self._user_data = None
+        self.state_refresher = None
 
     def __repr__(self):
         return '<Node: %s (%s)>' % (self.alias, self.id)
@@ -226,23 +457,80 @@ class Node(object):
         except IndexError:
             pass
 
+    @property
+    def facts(self):
+        """
+        Returns a dictionary of facts about the remote host gathered with a
+        single remote command: arch, cpus, memory (MB), devices, partitions,
+        mounts and accounts (a PasswdIndex of the node's users and groups).
+        The result is cached until invalidate_facts() is called.
+        """
+        with self._facts_lock:
+            if self._facts is None:
+                self._facts = self._gather_facts()
+            return self._facts
+
+    def invalidate_facts(self):
+        """
+        Discards the cached facts so that they're gathered again on next
+        access. Call this after adding users/groups, mounting filesystems or
+        partitioning devices by means other than the methods of this class.
+        """
+        self._facts = None
+
+    def _gather_facts(self):
+        cmd = ("if py=$(command -v python3 || command -v python); then\n"
+               "\"$py\" - <<'EOF'\n%s\nEOF\nelse\n%s\nfi" %
+               (FACTS_SCRIPT.strip(), FACTS_SHELL_SCRIPT.strip()))
+        output = self.ssh.execute(cmd, log_output=False)
+        raw = self._parse_facts(output)
+        log.debug("gathered facts for %s" % self.alias)
+        return dict(
+            arch=raw['arch'],
+            cpus=int(raw['cpus']),
+            memory=float(raw['memory']),
+            devices=self._parse_device_map(raw['fdisk'], raw['partitions']),
+            partitions=self._parse_partition_map(raw['fdisk']),
+            mounts=self._parse_mount_map(raw['mounts'].splitlines()),
+            accounts=PasswdIndex(
+                users=self._parse_passwd(raw['passwd'].splitlines()),
+                groups=self._parse_group(raw['group'].splitlines())))
+
+    def _parse_facts(self, output):
+        """
+        Returns the raw facts printed by either FACTS_SCRIPT (one line of
+        JSON) or FACTS_SHELL_SCRIPT (sections of lines)
+        """
+        if output and output[0].startswith(FACTS_MARKER):
+            sections = {}
+            for line in output:
+                if line.startswith(FACTS_MARKER):
+                    lines = sections.setdefault(line.split()[1], [])
+                else:
+                    lines.append(line)
+            raw = dict([(k, '\n'.join(v)) for k, v in sections.items()])
+        else:
+            try:
+                # stderr output, if any, follows the single line of JSON
+                raw = json.loads(output[0])
+            except (IndexError, ValueError):
+                raw = {}
+        keys = ['arch', 'cpus', 'memory', 'fdisk', 'partitions', 'mounts',
+                'passwd', 'group']
+        missing = [k for k in keys if k not in raw]
+        if missing:
+            raise exception.BaseException(
+                "unable to gather facts (%s) from %s. Output was:\n%s" %
+                (', '.join(missing), self.alias, utils.join(output, '\n')))
+        return raw
+
     @property
     def num_processors(self):
-        if not self._num_procs:
-                results = list(self.ssh.execute(
-                    'cat /proc/cpuinfo | grep processor | wc -l'))
-                if len(results) > 0:
-                    self._num_procs = int(results[0])
-        return self._num_procs
+        return self.facts['cpus']
 
     @property
     def memory(self):
-        if not self._memory:
-            results = list(self.ssh.execute(
-                "free -m | grep -i mem | awk '{print $2}'"))
-            if len(results) > 0:
-                self._memory = float(results[0])
-        return self._memory
+        return self.facts['memory']
 
     @property
     def ip_address(self):
@@ -379,13 +667,35 @@ class Node(object):
         """
         Add user (if exists) to group (if exists)
         """
-        if user not in self.get_user_map():
+        accounts = self.facts['accounts']
+        if not accounts.getpwnam(user):
             raise exception.BaseException("user %s does not exist" % user)
-        if group in self.get_group_map():
-            self.ssh.execute('gpasswd -a %s %s' % (user, 'utmp'))
+        if accounts.getgrnam(group):
+            self.ssh.execute('gpasswd -a %s %s' % (user, group))
+            accounts.add_group_member(group, user)
         else:
             raise exception.BaseException("group %s does not exist" % group)
 
+    def _parse_group(self, lines):
+        groups = []
+        for line in lines:
+            if not line.strip():
+                continue
+            name, passwd, gid, mems = line.strip().split(':')
+            groups.append(utils.struct_group([name, passwd, int(gid),
+                                              mems.split(',')]))
+        return groups
+
+    def _parse_passwd(self, lines):
+        users = []
+        for line in lines:
+            if not line.strip():
+                continue
+            name, passwd, uid, gid, gecos, home, shell = line.split(':')
+            users.append(utils.struct_passwd([name, passwd, int(uid), int(gid),
+                                              gecos, home, shell.strip()]))
+        return users
+
     def get_group_map(self, key_by_gid=False):
         """
         Returns dictionary where keys are remote group names and values are
@@ -394,19 +704,10 @@ class Node(object):
         key_by_gid=True will use the integer gid as the returned dictionary's
         keys instead of the group's name
         """
-        grp_file = self.ssh.remote_file('/etc/group', 'r')
-        groups = [l.strip().split(':') for l in grp_file.readlines()]
-        grp_file.close()
-        grp_map = {}
-        for group in groups:
-            name, passwd, gid, mems = group
-            gid = int(gid)
-            mems = mems.split(',')
-            key = name
-            if key_by_gid:
-                key = gid
-            grp_map[key] = utils.struct_group([name, passwd, gid, mems])
-        return grp_map
+        accounts = self.facts['accounts']
+        if key_by_gid:
+            return dict(accounts.gids)
+        return dict(accounts.groups)
 
     def get_user_map(self, key_by_uid=False):
         """
@@ -416,20 +717,10 @@ class Node(object):
         key_by_uid=True will use the integer uid as the returned dictionary's
         keys instead of the user's login name
         """
-        etc_passwd = self.ssh.remote_file('/etc/passwd', 'r')
-        users = [l.strip().split(':') for l in etc_passwd.readlines()]
-        etc_passwd.close()
-        user_map = {}
-        for user in users:
-            name, passwd, uid, gid, gecos, home, shell = user
-            uid = int(uid)
-            gid = int(gid)
-            key = name
-            if key_by_uid:
-                key = uid
-            user_map[key] = utils.struct_passwd([name, passwd, uid, gid, gecos,
-                                                 home, shell])
-        return user_map
+        accounts = self.facts['accounts']
+        if key_by_uid:
+            return dict(accounts.uids)
+        return dict(accounts.users)
 
     def getgrgid(self, gid):
         """
@@ -437,8 +728,7 @@ class Node(object):
 
         returns a grp.struct_group
         """
-        gmap = self.get_group_map(key_by_gid=True)
-        return gmap.get(gid)
+        return self.facts['accounts'].getgrgid(gid)
 
     def getgrnam(self, groupname):
         """
@@ -446,8 +736,7 @@ class Node(object):
 
         returns a grp.struct_group
         """
-        gmap = self.get_group_map()
-        return gmap.get(groupname)
+        return self.facts['accounts'].getgrnam(groupname)
 
     def getpwuid(self, uid):
         """
@@ -455,8 +744,7 @@ class Node(object):
 
         returns a pwd.struct_passwd
         """
-        umap = self.get_user_map(key_by_uid=True)
-        return umap.get(uid)
+        return self.facts['accounts'].getpwuid(uid)
 
     def getpwnam(self, username):
         """
@@ -464,8 +752,7 @@ class Node(object):
 
         returns a pwd.struct_passwd
         """
-        umap = self.get_user_map()
-        return umap.get(username)
+        return self.facts['accounts'].getpwnam(username)
 
     def add_user(self, name, uid=None, gid=None, shell="bash"):
         """
@@ -476,8 +763,6 @@ class Node(object):
         gid - optional group id to use when creating new user
         shell - optional shell assign to new user (default: bash)
         """
-        if gid:
-            self.ssh.execute('groupadd -o -g %s %s' % (gid, name))
         user_add_cmd = 'useradd -o '
         if uid:
             user_add_cmd += '-u %s ' % uid
@@ -486,7 +771,22 @@ class Node(object):
         if shell:
             user_add_cmd += '-s `which %s` ' % shell
         user_add_cmd += "-m %s" % name
-        self.ssh.execute(user_add_cmd)
+        accounts = self._facts and self._facts['accounts']
+        with self.ssh.batch() as batch:
+            if gid:
+                batch.execute('groupadd -o -g %s %s' % (gid, name))
+            batch.execute(user_add_cmd)
+            if accounts:
+                # fetch the new entries in the same round-trip to keep the
+                # cached passwd/group index current
+                pw = batch.execute('getent passwd %s' % name)
+                gr = batch.execute('getent group %s' % name,
+                                   ignore_exit_status=True)
+        if accounts:
+            for user in self._parse_passwd(pw.stdout):
+                accounts.add_user(user)
+            for group in self._parse_group(gr.stdout):
+                accounts.add_group(group)
 
     def generate_key_for_user(self, username, ignore_existing=False,
                               auth_new_key=False, auth_conn_key=False):
@@ -560,23 +860,40 @@ class Node(object):
         auth_keys.close()
         return key
 
-    def add_to_known_hosts(self, username, nodes, add_self=True):
+    @property
+    def host_key(self):
         """
-        Populate user's known_hosts file with pub keys from hosts in nodes list
+        The node's SSH host key. Fetched once and cached on this Node which
+        the Cluster keeps for its lifetime.
+        """
+        if self._host_key is None:
+            self._host_key = self.ssh.get_server_public_key()
+        return self._host_key
 
-        username - name of the user to add to known hosts for
-        nodes - the nodes to add to the user's known hosts file
-        add_self - add this Node to known_hosts in addition to nodes
+    def get_host_keys(self, nodes, pool=None):
+        """
+        Returns a dictionary mapping each node in nodes to its SSH host key.
+        Keys that aren't cached yet are fetched in parallel if a threadpool
+        is given.
         """
         nodes = list(nodes)
-        user = self.getpwnam(username)
-        known_hosts_file = posixpath.join(user.pw_dir, '.ssh', 'known_hosts')
+        missing = [n for n in nodes if n._host_key is None]
+        if pool and len(missing) > 1:
+            futures = [pool.submit(lambda n: n.host_key, (node,),
+                                   jobid=node.alias) for node in missing]
+            excs = [[f.exception(), f.traceback, f.jobid] for f in futures
+                    if f.exception()]
+            if excs:
+                raise exception.ThreadPoolException(
+                    "Failed to fetch host keys from %d of %d node(s)" %
+                    (len(excs), len(missing)), excs)
+        return dict([(node, node.host_key) for node in nodes])
+
+    def _get_known_hosts_entries(self, nodes, pool=None):
         khosts = []
-        if add_self and self not in nodes:
-            nodes.append(self)
-        self.remove_from_known_hosts(username, nodes)
+        host_keys = self.get_host_keys(nodes, pool=pool)
         for node in nodes:
-            server_pkey = node.ssh.get_server_public_key()
+            server_pkey = host_keys[node]
             node_names = {}.fromkeys([node.alias, node.private_dns_name,
                                       node.private_dns_name_short],
                                      node.private_ip_address)
@@ -585,29 +902,93 @@ class Node(object):
                 name_ip = "%s,%s" % (name, ip)
                 khosts.append(' '.join([name_ip, server_pkey.get_name(),
                                         server_pkey.get_base64()]))
-        khostsf = self.ssh.remote_file(known_hosts_file, 'a')
-        khostsf.write('\n'.join(khosts) + '\n')
-        khostsf.chown(user.pw_uid, user.pw_gid)
-        khostsf.close()
-
-    def remove_from_known_hosts(self, username, nodes):
-        """
-        Remove all network names for nodes from username's known_hosts file
-        on this Node
+        return khosts
+
+    def _get_users(self, usernames):
+        if isinstance(usernames, six.string_types):
+            usernames = [usernames]
+        users = []
+        for username in usernames:
+            user = self.getpwnam(username)
+            if not user:
+                raise exception.BaseException("user %s does not exist" %
+                                              username)
+            users.append(user)
+        return users
+
+    def add_to_known_hosts(self, usernames, nodes, add_self=True, pool=None):
+        """
+        Populate users' known_hosts files with pub keys from hosts in nodes
+        list
+
+        usernames - name, or list of names, of the users to add to known hosts
+                    for. All users' files are updated in one remote command.
+        nodes - the nodes to add to the users' known hosts files
+        add_self - add this Node to known_hosts in addition to nodes
+        pool - optional threadpool used to fetch uncached host keys
         """
-        user = self.getpwnam(username)
-        known_hosts_file = posixpath.join(user.pw_dir, '.ssh', 'known_hosts')
+        nodes = list(nodes)
+        users = self._get_users(usernames)
+        if add_self and self not in nodes:
+            nodes.append(self)
+        khosts = self._get_known_hosts_entries(nodes, pool=pool)
+        regex = self._get_known_hosts_regex(nodes)
+        # the entries and the patterns matching stale entries are uploaded
+        # once over SFTP and applied to each user's file from the temporary
+        # copies: passed on the command line they'd exceed the remote
+        # shell's argument size limit on large clusters
+        prefix = '/tmp/.starcluster-known_hosts-%s' % uuid.uuid4().hex
+        payload = prefix + '.entries'
+        patterns = prefix + '.patterns'
+        try:
+            for path, lines in [(payload, khosts), (patterns, [regex])]:
+                rfile = self.ssh.remote_file(path, 'w')
+                rfile.write(''.join([line + '\n' for line in lines]))
+                rfile.close()
+            with self.ssh.batch() as batch:
+                for user in users:
+                    known_hosts_file = posixpath.join(user.pw_dir, '.ssh',
+                                                      'known_hosts')
+                    khostsf = self.ssh.edit_file(known_hosts_file)
+                    khostsf.remove_lines_in_file(patterns)
+                    khostsf.append_file(payload)
+                    khostsf.chown(user.pw_uid, user.pw_gid)
+                    batch.edit(khostsf, log_output=False)
+                batch.execute('rm -f %s %s' % (payload, patterns))
+        except Exception:
+            self.ssh.execute('rm -f %s %s' % (payload, patterns),
+                             ignore_exit_status=True)
+            raise
+
+    def _get_known_hosts_regex(self, nodes):
         hostnames = []
         for node in nodes:
             hostnames += [node.alias, node.private_dns_name,
                           node.private_dns_name_short, node.public_dns_name]
-        if self.ssh.isfile(known_hosts_file):
-            regex = '|'.join(hostnames)
-            self.ssh.remove_lines_from_file(known_hosts_file, regex)
+        return '|'.join(hostnames)
+
+    def remove_from_known_hosts(self, usernames, nodes):
+        """
+        Remove all network names for nodes from the known_hosts files of
+        usernames (a name or list of names) on this Node
+        """
+        regex = self._get_known_hosts_regex(nodes)
+        with self.ssh.batch() as batch:
+            for user in self._get_users(usernames):
+                known_hosts_file = posixpath.join(user.pw_dir, '.ssh',
+                                                  'known_hosts')
+                khostsf = self.ssh.edit_file(known_hosts_file)
+                khostsf.remove_lines(regex)
+                batch.edit(khostsf)
 
-    def enable_passwordless_ssh(self, username, nodes):
+    def enable_passwordless_ssh(self, username, nodes, pool=None,
+                                width=None, progress_bar=None):
         """
         Configure passwordless ssh for user between this Node and nodes
+
+        The user's keys, authorized_keys and known_hosts files are sent to
+        all nodes in a single pass. See copy_remote_files_to_nodes for the
+        pool, width and progress_bar options.
         """
         user = self.getpwnam(username)
         ssh_folder = posixpath.join(user.pw_dir, '.ssh')
@@ -615,15 +996,14 @@ class Node(object):
         pub_key_file = priv_key_file + '.pub'
         known_hosts_file = posixpath.join(ssh_folder, 'known_hosts')
         auth_key_file = posixpath.join(ssh_folder, 'authorized_keys')
-        self.add_to_known_hosts(username, nodes)
+        self.add_to_known_hosts(username, nodes, pool=pool)
         # exclude this node from copying
         nodes = filter(lambda n: n.id != self.id, nodes)
-        # copy private key and public key to node
-        self.copy_remote_file_to_nodes(priv_key_file, nodes)
-        self.copy_remote_file_to_nodes(pub_key_file, nodes)
-        # copy authorized_keys and known_hosts to node
-        self.copy_remote_file_to_nodes(auth_key_file, nodes)
-        self.copy_remote_file_to_nodes(known_hosts_file, nodes)
+        # copy private/public keys, authorized_keys and known_hosts to nodes
+        self.copy_remote_files_to_nodes([priv_key_file, pub_key_file,
+                                         auth_key_file, known_hosts_file],
+                                        nodes, pool=pool, width=width,
+                                        progress_bar=progress_bar)
 
     def copy_remote_file_to_node(self, remote_file, node, dest=None):
         return self.copy_remote_file_to_nodes(remote_file, [node], dest=dest)
@@ -635,39 +1015,161 @@ class Node(object):
 
         dest - path to store the data in on the node (defaults to remote_file)
         """
-        if not dest:
-            dest = remote_file
-        rf = self.ssh.remote_file(remote_file, 'r')
-        contents = rf.read()
-        sts = rf.stat()
-        mode = stat.S_IMODE(sts.st_mode)
-        uid = sts.st_uid
-        gid = sts.st_gid
-        rf.close()
+        return self.copy_remote_files_to_nodes([(remote_file, dest)], nodes)
+
+    def copy_remote_files_to_nodes(self, remote_files, nodes, pool=None,
+                                   width=None, progress_bar=None):
+        """
+        Copies several remote files from this Node instance to other Node
+        instances in one pass without passwordless ssh between them.
+
+        Each file is read from this node once and then written, together with
+        its ownership and permissions, to every node over that node's own SFTP
+        session. If a threadpool is given up to width nodes (defaults to the
+        pool's size) are updated at the same time, otherwise the nodes are
+        updated one after another. Every node is attempted even if some of
+        them fail, after which a ThreadPoolException listing the failed nodes
+        is raised.
+
+        remote_files - list of paths or (path, dest) tuples where dest is the
+                       path to store the data in on the nodes (defaults to
+                       path)
+        progress_bar - optional progressbar.ProgressBar updated as nodes finish
+        """
+        files = []
+        for remote_file in remote_files:
+            if isinstance(remote_file, (list, tuple)):
+                remote_file, dest = remote_file
+            else:
+                dest = None
+            rf = self.ssh.remote_file(remote_file, 'r')
+            contents = rf.read()
+            sts = rf.stat()
+            rf.close()
+            files.append((remote_file, dest or remote_file, contents,
+                          stat.S_IMODE(sts.st_mode), sts.st_uid, sts.st_gid))
+        nodes = list(nodes)
+        if pool:
+            width = width or pool.size()
+        slots = threading.BoundedSemaphore(max(width or 1, 1))
+        lock = threading.Lock()
+        finished = [0]
+
+        def _copy(node):
+            with slots:
+                for remote_file, dest, contents, mode, uid, gid in files:
+                    if self.id == node.id and remote_file == dest:
+                        log.warn("src and destination are the same: %s, "
+                                 "skipping" % remote_file)
+                        continue
+                    nrf = node.ssh.remote_file(dest, 'w')
+                    nrf.write(contents)
+                    nrf.chown(uid, gid)
+                    nrf.chmod(mode)
+                    nrf.close()
+
+        def _done(future):
+            with lock:
+                finished[0] += 1
+                if progress_bar:
+                    progress_bar.update(finished[0])
+
+        if progress_bar:
+            progress_bar.maxval = len(nodes)
+            progress_bar.update(0)
+        futures = []
         for node in nodes:
-            if self.id == node.id and remote_file == dest:
-                log.warn("src and destination are the same: %s, skipping" %
-                         remote_file)
-                continue
-            nrf = node.ssh.remote_file(dest, 'w')
-            nrf.write(contents)
-            nrf.chown(uid, gid)
-            nrf.chmod(mode)
-            nrf.close()
+            if pool:
+                future = pool.submit(_copy, (node,), jobid=node.alias)
+            else:
+                future = threadpool.Future(jobid=node.alias)
+                try:
+                    threadpool.SimpleJob(_copy, (node,), future=future).run()
+                except Exception:
+                    pass
+            future.add_done_callback(_done)
+            futures.append(future)
+        excs = [[f.exception(), f.traceback, f.jobid] for f in futures
+                if f.exception() is not None]
+        if progress_bar and nodes:
+            progress_bar.finish()
+        for e, tb_msg, alias in excs:
+            log.error("Failed to copy files to %s: %s" % (alias, e))
+        if excs:
+            raise exception.ThreadPoolException(
+                "Failed to copy files to %d of %d node(s)" %
+                (len(excs), len(nodes)), excs)
 
     def remove_user(self, name):
         """
         Remove a user from the remote system
         """
-        self.ssh.execute('userdel %s' % name)
-        self.ssh.execute('groupdel %s' % name)
+        with self.ssh.batch() as batch:
+            batch.execute('userdel %s' % name)
+            batch.execute('groupdel %s' % name)
+        if self._facts:
+            self._facts['accounts'].remove_user(name)
+            self._facts['accounts'].remove_group(name)
+
+    @property
+    def subnet_cidr(self):
+        """
+        The CIDR block of the node's VPC subnet or None if the node isn't in
+        a VPC
+        """
+        if self._subnet_cidr is None and self.subnet_id:
+            self._subnet_cidr = self.ec2.get_subnet(self.subnet_id).cidr_block
+        return self._subnet_cidr
 
-    def export_fs_to_nodes(self, nodes, export_paths):
+    def _load_subnet_cidrs(self, nodes):
+        """
+        Looks up the subnet CIDR blocks of all nodes that don't have them
+        cached yet with a single API call
+        """
+        todo = [n for n in nodes if n._subnet_cidr is None and n.subnet_id]
+        subnet_ids = sorted(set([n.subnet_id for n in todo]))
+        if not subnet_ids:
+            return
+        subnets = self.ec2.get_subnets(filters={'subnet_id': subnet_ids})
+        cidrs = dict([(subnet.id, subnet.cidr_block) for subnet in subnets])
+        for node in todo:
+            if node.subnet_id not in cidrs:
+                raise exception.SubnetDoesNotExist(node.subnet_id)
+            node._subnet_cidr = cidrs[node.subnet_id]
+
+    def _get_export_clients(self, nodes, by_subnet=False):
+        """
+        Returns the NFS clients to export paths to for nodes: the nodes'
+        aliases or, if by_subnet is True and all nodes are in a VPC, the CIDR
+        blocks of the nodes' subnets
+        """
+        if by_subnet and nodes and all([n.subnet_id for n in nodes]):
+            self._load_subnet_cidrs(nodes)
+            cidrs = sorted(set([n.subnet_cidr for n in nodes]))
+            new = [cidr for cidr in cidrs if cidr not in self._subnet_exports]
+            if new:
+                log.warn("Exporting NFS shares read-write with "
+                         "no_root_squash to every host in subnet(s) %s: "
+                         "access is restricted only by the cluster's "
+                         "security group" % ', '.join(new))
+                self._subnet_exports.update(new)
+            return cidrs
+        return [n.alias for n in nodes]
+
+    def export_fs_to_nodes(self, nodes, export_paths, by_subnet=False):
         """
         Export each path in export_paths to each node in nodes via NFS
 
+        If by_subnet is True and the nodes are in a VPC the paths are exported
+        to the nodes' whole subnets instead (see _get_export_clients). This
+        keeps /etc/exports small and covers nodes added later, but grants
+        access to any host in those subnets that the cluster's security group
+        lets in. Small changes are applied to the running NFS server with
+        'exportfs -o' instead of reloading all exports.
+
         nodes - list of nodes to export each path to
         export_paths - list of paths on this remote host to export to each node
+        by_subnet - export to the nodes' subnets rather than to each node
 
         Example:
         # export /home and /opt/sge6 to each node in nodes
@@ -675,61 +1177,87 @@ class Node(object):
         $ node.export_fs_to_nodes(nodes=[node1,node2],
                                   export_paths=['/home', '/opt/sge6'])
         """
-        log.debug("Cleaning up potentially stale NFS entries")
-        self.stop_exporting_fs_to_nodes(nodes, paths=export_paths)
         log.info("Configuring NFS exports path(s):\n%s" %
                  ' '.join(export_paths))
-        nfs_export_settings = "(async,no_root_squash,no_subtree_check,rw)"
-        etc_exports = self.ssh.remote_file('/etc/exports', 'r')
-        contents = etc_exports.read()
-        etc_exports.close()
-        etc_exports = self.ssh.remote_file('/etc/exports', 'a')
-        for node in nodes:
-            for path in export_paths:
-                export_line = ' '.join(
-                    [path, node.alias + nfs_export_settings + '\n'])
-                if export_line not in utils.to_str(contents):
-                    etc_exports.write(export_line)
-        etc_exports.close()
-        self.ssh.execute('exportfs -fra')
+        clients = self._get_export_clients(nodes, by_subnet=by_subnet)
+        etc_exports = self.ssh.edit_file('/etc/exports')
+        # clean up potentially stale NFS entries
+        etc_exports.remove_lines(self._get_exports_regex(clients,
+                                                         export_paths))
+        exports = [(path, client) for client in clients
+                   for path in export_paths]
+        for path, client in exports:
+            etc_exports.append('%s %s(%s)' % (path, client,
+                                              self.NFS_EXPORT_OPTIONS))
+        start = time.time()
+        with self.ssh.batch() as batch:
+            batch.edit(etc_exports)
+            if len(exports) <= self.EXPORTFS_INCREMENTAL_MAX:
+                for path, client in exports:
+                    batch.execute('exportfs -o %s %s:%s' %
+                                  (self.NFS_EXPORT_OPTIONS, client, path))
+            else:
+                batch.execute('exportfs -ra')
+        log.debug("exported %d path(s) to %d client(s) in %.2fs" %
+                  (len(export_paths), len(clients), time.time() - start))
+
+    def _get_exports_regex(self, clients, paths=None):
+        # match whole client names so that node001 doesn't match node0010
+        clients = '(%s)\\(' % '|'.join(map(utils.ere_escape, clients))
+        if paths:
+            return '^(%s)[[:space:]]+%s' % (
+                '|'.join(map(utils.ere_escape, paths)), clients)
+        return '[[:space:]]' + clients
 
     def stop_exporting_fs_to_nodes(self, nodes, paths=None):
         """
-        Removes nodes from this node's /etc/exportfs
+        Removes nodes from this node's /etc/exportfs. Exports to whole
+        subnets (see export_fs_to_nodes) are left in place.
 
         nodes - list of nodes to stop
 
         Example:
         $ node.remove_export_fs_to_nodes(nodes=[node1,node2])
         """
-        if paths:
-            regex = '|'.join([' '.join([path, node.alias]) for path in paths
-                              for node in nodes])
-        else:
-            regex = '|'.join([n.alias for n in nodes])
-        self.ssh.remove_lines_from_file('/etc/exports', regex)
-        self.ssh.execute('exportfs -fra')
+        regex = self._get_exports_regex([n.alias for n in nodes], paths)
+        etc_exports = self.ssh.edit_file('/etc/exports')
+        etc_exports.remove_lines(regex)
+        start = time.time()
+        with self.ssh.batch() as batch:
+            if len(nodes) <= self.EXPORTFS_INCREMENTAL_MAX:
+                # unexport the matching entries from the running server
+                batch.execute(
+                    "grep -E %s /etc/exports | while read path client; do "
+                    "exportfs -u \"${client%%%%(*}:$path\"; done" %
+                    shlex_quote(regex))
+                batch.edit(etc_exports)
+            else:
+                batch.edit(etc_exports)
+                batch.execute('exportfs -ra')
+        log.debug("stopped exporting to %d node(s) in %.2fs" %
+                  (len(nodes), time.time() - start))
 
     def start_nfs_server(self):
         log.info("Starting NFS server on %s" % self.alias)
-        self.ssh.execute('service rpcbind start', ignore_exit_status=True)
-        self.ssh.execute('mount -t rpc_pipefs sunrpc /var/lib/nfs/rpc_pipefs/',
-                         ignore_exit_status=True)
         EXPORTSD = '/etc/exports.d'
         DUMMY_EXPORT_DIR = '/dummy_export_for_broken_init_script'
         DUMMY_EXPORT_LINE = ' '.join([DUMMY_EXPORT_DIR,
                                       '127.0.0.1(ro,no_subtree_check)'])
         DUMMY_EXPORT_FILE = posixpath.join(EXPORTSD, 'dummy.exports')
-        # Hack to get around broken debian nfs-kernel-server script
-        # http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=679274
-        self.ssh.execute("mkdir -p %s" % EXPORTSD)
-        self.ssh.execute("mkdir -p %s" % DUMMY_EXPORT_DIR)
-        with self.ssh.remote_file(DUMMY_EXPORT_FILE, 'w') as dummyf:
-            dummyf.write(DUMMY_EXPORT_LINE)
-        self.ssh.execute('/etc/init.d/nfs start')
-        self.ssh.execute('rm -f %s' % DUMMY_EXPORT_FILE)
-        self.ssh.execute('rm -rf %s' % DUMMY_EXPORT_DIR)
-        self.ssh.execute('exportfs -fra')
+        with self.ssh.batch() as batch:
+            batch.execute('service rpcbind start', ignore_exit_status=True)
+            batch.execute('mount -t rpc_pipefs sunrpc '
+                          '/var/lib/nfs/rpc_pipefs/', ignore_exit_status=True)
+            # Hack to get around broken debian nfs-kernel-server script
+            # http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=679274
+            batch.execute("mkdir -p %s" % EXPORTSD)
+            batch.execute("mkdir -p %s" % DUMMY_EXPORT_DIR)
+            batch.execute("echo '%s' > %s" % (DUMMY_EXPORT_LINE,
+                                              DUMMY_EXPORT_FILE))
+            batch.execute('/etc/init.d/nfs start')
+            batch.execute('rm -f %s' % DUMMY_EXPORT_FILE)
+            batch.execute('rm -rf %s' % DUMMY_EXPORT_DIR)
+            batch.execute('exportfs -fra')
 
     def mount_nfs_shares(self, server_node, remote_paths):
         """
@@ -756,53 +1284,38 @@ class Node(object):
         remote_paths = mount_paths
         remote_paths_regex = '|'.join(map(lambda x: x.center(len(x) + 2),
                                           remote_paths))
-        self.ssh.remove_lines_from_file('/etc/fstab', remote_paths_regex)
-        fstab = self.ssh.remote_file('/etc/fstab', 'a')
         mount_opts = 'rw,exec,noauto'
-        for path in remote_paths:
-            fstab.write('%s:%s %s nfs %s 0 0\n' %
-                        (server_node.alias, path, path, mount_opts))
-        fstab.close()
+        with self.ssh.edit_file('/etc/fstab') as fstab:
+            fstab.remove_lines(remote_paths_regex)
+            for path in remote_paths:
+                fstab.append('%s:%s %s nfs %s 0 0' %
+                             (server_node.alias, path, path, mount_opts))
         for path in remote_paths:
             if not self.ssh.path_exists(path):
                 self.ssh.makedirs(path)
             self.ssh.execute('mount %s' % path)
+        self.invalidate_facts()
 
-    def get_mount_map(self):
+    def _parse_mount_map(self, mount_lines):
         mount_map = {}
-        mount_lines = self.ssh.execute('mount')
         for line in mount_lines:
             dev, on_label, path, type_label, fstype, options = line.split()
             mount_map[dev] = [path, fstype, options]
         return mount_map
 
-    def get_device_map(self):
-        """
-        Returns a dictionary mapping devices->(# of blocks) based on
-        'fdisk -l' and /proc/partitions
-        """
+    def _parse_device_map(self, fdiskout, proc_parts):
         dev_regex = '/dev/[A-Za-z0-9/]+'
         r = re.compile('Disk (%s):' % dev_regex)
-        fdiskout = utils.join(self.ssh.execute("fdisk -l 2>/dev/null"), '\n')
-        if isinstance(fdiskout, bytes):
-            fdiskout = fdiskout.decode('utf-8')
-        proc_parts = utils.join(self.ssh.execute("cat /proc/partitions"), '\n')
-        if isinstance(proc_parts, bytes):
-            fdiskout = proc_parts.decode('utf-8')
         devmap = {}
         for dev in r.findall(fdiskout):
             short_name = dev.replace('/dev/', '')
-            r = re.compile("(\d+)\s+%s(?:\s+|$)" % short_name)
-            devmap[dev] = int(r.findall(proc_parts)[0])
+            r = re.compile("(\d+)\s+%s(?:\s+|$)" % short_name, re.M)
+            blocks = r.findall(proc_parts)
+            if blocks:
+                devmap[dev] = int(blocks[0])
         return devmap
 
-    def get_partition_map(self, device=None):
-        """
-        Returns a dictionary mapping partitions->(start, end, blocks, id) based
-        on 'fdisk -l'
-        """
-        fdiskout = utils.join(self.ssh.execute("fdisk -l %s 2>/dev/null" %
-                                              (device or '')), '\n')
+    def _parse_partition_map(self, fdiskout):
         part_regex = '/dev/[A-Za-z0-9/]+'
         r = re.compile('(%s)\s+\*?\s+'
                        '(\d+)(?:[-+])?\s+'
@@ -815,37 +1328,82 @@ class Node(object):
             partmap[part] = [int(start), int(end), int(blocks), sys_id]
         return partmap
 
+    def get_mount_map(self):
+        """
+        Returns a dictionary mapping devices->[path, fstype, options] based on
+        'mount'
+        """
+        return dict(self.facts['mounts'])
+
+    def get_device_map(self):
+        """
+        Returns a dictionary mapping devices->(# of blocks) based on
+        'fdisk -l' and /proc/partitions
+        """
+        return dict(self.facts['devices'])
+
+    def get_partition_map(self, device=None):
+        """
+        Returns a dictionary mapping partitions->(start, end, blocks, id) based
+        on 'fdisk -l'. If device is specified only the partitions on that
+        device are returned.
+        """
+        partmap = self.facts['partitions']
+        if device:
+            r = re.compile('%sp?\d+$' % re.escape(device))
+            partmap = dict([(part, info) for part, info in partmap.items()
+                            if r.match(part)])
+        return dict(partmap)
+
     def mount_device(self, device, path):
         """
         Mount device to path
         """
-        self.ssh.remove_lines_from_file('/etc/fstab',
-                                        path.center(len(path) + 2))
-        master_fstab = self.ssh.remote_file('/etc/fstab', mode='a')
-        master_fstab.write("%s %s auto noauto,defaults 0 0\n" %
-                           (device, path))
-        master_fstab.close()
+        with self.ssh.edit_file('/etc/fstab') as fstab:
+            fstab.remove_lines(path.center(len(path) + 2))
+            fstab.append("%s %s auto noauto,defaults 0 0" % (device, path))
         if not self.ssh.path_exists(path):
             self.ssh.makedirs(path)
         self.ssh.execute('mount %s' % path)
+        self.invalidate_facts()
+
+    def _get_etc_hosts_regex(self, aliases):
+        # match whole names only so that node001 doesn't match node0010
+        aliases = [utils.ere_escape(a) for a in aliases]
+        return '[[:space:]](%s)([[:space:]]|$)' % '|'.join(aliases)
+
+    def _edit_etc_hosts(self, remove_aliases, entries, replace=False):
+        with self.ssh.edit_file('/etc/hosts') as host_file:
+            host_file.use_block(static.ETC_HOSTS_BEGIN, static.ETC_HOSTS_END,
+                                replace=replace)
+            if remove_aliases:
+                host_file.remove_lines(
+                    self._get_etc_hosts_regex(remove_aliases))
+            host_file.append(entries)
+
+    def set_etc_hosts(self, entries):
+        """
+        Replaces the StarCluster block in this node's /etc/hosts file with
+        entries in one atomic write. Use render_etc_hosts() to render the
+        entries once for all nodes. Entries for the same hosts outside of the
+        block, e.g. written by older versions of StarCluster, are removed.
+        """
+        aliases = [e.split()[1] for e in entries]
+        self._edit_etc_hosts(aliases, entries, replace=True)
 
     def add_to_etc_hosts(self, nodes):
         """
-        Adds all names for node in nodes arg to this node's /etc/hosts file
+        Adds all names for node in nodes arg to the StarCluster block in this
+        node's /etc/hosts file. Only the entries for nodes are sent.
         """
-        self.remove_from_etc_hosts(nodes)
-        host_file = self.ssh.remote_file('/etc/hosts', 'a')
-        for node in nodes:
-            host_file.write(node.get_hosts_entry() + "\n")
-        host_file.close()
+        self._edit_etc_hosts([n.alias for n in nodes], render_etc_hosts(nodes))
 
     def remove_from_etc_hosts(self, nodes):
         """
         Remove all network names for node in nodes arg from this node's
         /etc/hosts file
         """
-        aliases = map(lambda x: x.alias, nodes)
-        self.ssh.remove_lines_from_file('/etc/hosts', '|'.join(aliases))
+        self._edit_etc_hosts([n.alias for n in nodes], [])
 
     def set_hostname(self, hostname=None):
         """
@@ -1056,6 +1614,15 @@ class Node(object):
         return True
 
     def update(self):
+        """
+        Refreshes the node's instance data and returns its state. If the node
+        belongs to a state refresher (e.g. when loaded via Cluster.nodes) the
+        data is shared with all other nodes of the cluster and refreshed at
+        most once per refresh interval.
+        """
+        if self.state_refresher is not None:
+            self.state_refresher.refresh()
+            return self.state
         res = self.ec2.get_all_instances(filters={'instance-id': self.id})
         self.instance = res[0]
         return self.state
@@ -1146,15 +1713,21 @@ class Node(object):
         etc_hosts_line = etc_hosts_line % self.network_names
         return etc_hosts_line
 
-    def apt_command(self, cmd):
+    def get_apt_command(self, cmd):
         """
-        Run an apt-get command with all the necessary options for
+        Returns an apt-get command line with all the necessary options for
         non-interactive use (DEBIAN_FRONTEND=interactive, -y, --force-yes, etc)
         """
         dpkg_opts = "Dpkg::Options::='--force-confnew'"
         cmd = "apt-get -o %s -y --force-yes %s" % (dpkg_opts, cmd)
-        cmd = "DEBIAN_FRONTEND='noninteractive' " + cmd
-        self.ssh.execute(cmd)
+        return "DEBIAN_FRONTEND='noninteractive' " + cmd
+
+    def apt_command(self, cmd):
+        """
+        Run an apt-get command with all the necessary options for
+        non-interactive use (DEBIAN_FRONTEND=interactive, -y, --force-yes, etc)
+        """
+        self.ssh.execute(self.get_apt_command(cmd))
 
     def apt_install(self, pkgs):
         """
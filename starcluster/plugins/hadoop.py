@@ -143,6 +143,7 @@ class Hadoop(clustersetup.ClusterSetup):
 
     def _setup_hadoop_user(self, node, user):
         node.ssh.execute('gpasswd -a %s hadoop' % user)
+        node.invalidate_facts()
 
     def _install_empty_conf(self, node):
         node.ssh.execute('cp -r %s %s' % (self.empty_conf, self.hadoop_conf))
@@ -153,10 +154,9 @@ class Hadoop(clustersetup.ClusterSetup):
 
     def _configure_env(self, node):
         env_file_sh = posixpath.join(self.hadoop_conf, 'hadoop-env.sh')
-        node.ssh.remove_lines_from_file(env_file_sh, 'JAVA_HOME')
-        env_file = node.ssh.remote_file(env_file_sh, 'a')
-        env_file.write('export JAVA_HOME=%s\n' % self._get_java_home(node))
-        env_file.close()
+        with node.ssh.edit_file(env_file_sh) as env_file:
+            env_file.remove_lines('JAVA_HOME')
+            env_file.append('export JAVA_HOME=%s' % self._get_java_home(node))
 
     def _configure_mapreduce_site(self, node, cfg):
         mapred_site_xml = posixpath.join(self.hadoop_conf, 'mapred-site.xml')
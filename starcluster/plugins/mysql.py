@@ -282,19 +282,12 @@ class MysqlCluster(DefaultClusterSetup):
         mconn.execute('/etc/init.d/mysql-ndb-mgm restart')
         # Start mysqld-ndb on data nodes
         log.info('Restarting mysql-ndb on all data nodes...')
-        for node in self.data_nodes:
-            self.pool.simple_job(node.ssh.execute,
-                                 ('/etc/init.d/mysql-ndb restart'),
-                                 jobid=node.alias)
-        self.pool.wait(len(self.data_nodes))
+        self._execute_all('/etc/init.d/mysql-ndb restart',
+                          nodes=self.data_nodes)
         # Start mysql on query nodes
         log.info('Starting mysql on all query nodes')
-        for node in self.query_nodes:
-            self.pool.simple_job(node.ssh.execute,
-                                 ('/etc/init.d/mysql restart'),
-                                 dict(ignore_exit_status=True),
-                                 jobid=node.alias)
-        self.pool.wait(len(self.query_nodes))
+        self._execute_all('/etc/init.d/mysql restart', nodes=self.query_nodes,
+                          ignore_exit_status=True)
         # Import sql dump
         dump_file = self._dump_file
         dump_dir = '/mnt/mysql-cluster-backup'
@@ -317,10 +310,9 @@ class MysqlCluster(DefaultClusterSetup):
             log.info('No dump file found, not importing.')
         log.info('Adding MySQL dump cronjob to master node')
         cronjob = self.generate_mysqldump_crontab(sc_path)
-        mconn.remove_lines_from_file('/etc/crontab', '#starcluster-mysql')
-        crontab_file = mconn.remote_file('/etc/crontab', 'a')
-        crontab_file.write(cronjob)
-        crontab_file.close()
+        with mconn.edit_file('/etc/crontab') as crontab_file:
+            crontab_file.remove_lines('#starcluster-mysql')
+            crontab_file.append(cronjob)
         log.info('Management Node: %s' % master.alias)
         log.info('Data Nodes: \n%s' % '\n'.join([x.alias for x in
                                                  self.data_nodes]))
@@ -41,9 +41,9 @@ class PackageInstaller(clustersetup.DefaultClusterSetup):
         log.info('Installing the following packages on all nodes:')
         log.info(', '.join(self.packages), extra=dict(__raw__=True))
         pkgs = ' '.join(self.packages)
-        for node in nodes:
-            self.pool.simple_job(node.apt_install, (pkgs), jobid=node.alias)
-        self.pool.wait(len(nodes))
+        cmd = master.get_apt_command('update') + ' && ' + \
+            master.get_apt_command('install %s' % pkgs)
+        self._execute_all(cmd, nodes=nodes)
 
     def on_add_node(self, new_node, nodes, master, user, user_shell, volumes):
         log.info('Installing the following packages on %s:' % new_node.alias)
@@ -63,9 +63,7 @@ class PyPkgInstaller(DefaultClusterSetup):
         for command in commands:
             log.info("$ " + command)
         cmd = "\n".join(commands)
-        for node in nodes:
-            self.pool.simple_job(node.ssh.execute, (cmd,), jobid=node.alias)
-        self.pool.wait(len(nodes))
+        self._execute_all(cmd, nodes=nodes)
 
     def run(self, nodes, master, user, user_shell, volumes):
         self.install_packages(nodes)
@@ -39,6 +39,7 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self.slots_per_host = None
         if slots_per_host is not None:
             self.slots_per_host = int(slots_per_host)
+        self._sge_installed = False
         super(SGEPlugin, self).__init__(**kwargs)
 
     def _add_sge_submit_host(self, node):
@@ -168,11 +169,12 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
 
     def _remove_from_sge(self, node):
         master = self._master
-        master.ssh.execute('qconf -dattr hostgroup hostlist %s @allhosts' %
-                           node.alias)
-        master.ssh.execute('qconf -purge queue slots all.q@%s' % node.alias)
-        master.ssh.execute('qconf -dconf %s' % node.alias)
-        master.ssh.execute('qconf -de %s' % node.alias)
+        with master.ssh.batch() as batch:
+            batch.execute('qconf -dattr hostgroup hostlist %s @allhosts' %
+                          node.alias)
+            batch.execute('qconf -purge queue slots all.q@%s' % node.alias)
+            batch.execute('qconf -dconf %s' % node.alias)
+            batch.execute('qconf -de %s' % node.alias)
         node.ssh.execute('pkill -9 sge_execd')
         nodes = filter(lambda n: n.alias != node.alias, self._nodes)
         self._create_sge_pe(nodes=nodes)
@@ -188,6 +190,34 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self._user_shell = user_shell
         self._volumes = volumes
         self._setup_sge()
+        self._sge_installed = True
+
+    def setup_node(self, node, nodes, master, user, user_shell, volumes):
+        if not self._sge_installed:
+            return
+        self._nodes = nodes
+        self._master = master
+        self._user = user
+        self._user_shell = user_shell
+        self._volumes = volumes
+        log.info("Adding %s to SGE" % node.alias)
+        with self._master_lock:
+            master.export_fs_to_nodes([node], [self.SGE_ROOT],
+                                      by_subnet=self._nfs_subnet_exports)
+            self._add_sge_admin_host(node)
+            self._add_sge_submit_host(node)
+        node.mount_nfs_shares(master, [self.SGE_ROOT])
+        self._add_to_sge(node)
+
+    def finalize_setup(self, nodes, master, user, user_shell, volumes):
+        if not self._sge_installed:
+            return
+        self._nodes = nodes
+        self._master = master
+        self._user = user
+        self._user_shell = user_shell
+        self._volumes = volumes
+        self._create_sge_pe()
 
     def on_add_node(self, node, nodes, master, user, user_shell, volumes):
         self._nodes = nodes
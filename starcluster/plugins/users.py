@@ -68,11 +68,9 @@ class CreateUsers(clustersetup.DefaultClusterSetup):
         log.info("Creating %d cluster users" % self._num_users)
         newusers = self._get_newusers_batch_file(master, self._usernames,
                                                  user_shell)
+        self._execute_all("echo -n '%s' | newusers" % newusers, nodes=nodes)
         for node in nodes:
-            self.pool.simple_job(node.ssh.execute,
-                                 ("echo -n '%s' | newusers" % newusers),
-                                 jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
+            node.invalidate_facts()
         log.info("Configuring passwordless ssh for %d cluster users" %
                  self._num_users)
         pbar = self.pool.progress_bar.reset()
@@ -80,9 +78,9 @@ class CreateUsers(clustersetup.DefaultClusterSetup):
         for i, user in enumerate(self._usernames):
             master.generate_key_for_user(user, auth_new_key=True,
                                          auth_conn_key=True)
-            master.add_to_known_hosts(user, nodes)
             pbar.update(i + 1)
         pbar.finish()
+        master.add_to_known_hosts(self._usernames, nodes, pool=self.pool)
         self._setup_scratch(nodes, self._usernames)
         if self._download_keys:
             self._download_user_keys(master, self._usernames)
@@ -156,14 +154,10 @@ class CreateUsers(clustersetup.DefaultClusterSetup):
         newusers = self._get_newusers_batch_file(master, self._usernames,
                                                  user_shell)
         node.ssh.execute("echo -n '%s' | newusers" % newusers)
+        node.invalidate_facts()
         log.info("Adding %s to known_hosts for %d users" %
                  (node.alias, self._num_users))
-        pbar = self.pool.progress_bar.reset()
-        pbar.maxval = self._num_users
-        for i, user in enumerate(self._usernames):
-            master.add_to_known_hosts(user, [node])
-            pbar.update(i + 1)
-        pbar.finish()
+        master.add_to_known_hosts(self._usernames, [node])
         self._setup_scratch(nodes=[node], users=self._usernames)
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
@@ -21,6 +21,7 @@ from __future__ import unicode_literals
 
 import atexit
 import base64
+import collections
 import fnmatch
 import glob
 import hashlib
@@ -31,10 +32,14 @@ import socket
 import stat
 import string
 import sys
+import time
+import uuid
+import threading
 import warnings
 
 import six
 from six.moves import range
+from six.moves import shlex_quote
 
 import scp
 import paramiko
@@ -51,6 +56,7 @@ except ImportError:
 
 from starcluster import exception
 from starcluster import progressbar
+from starcluster import transfer
 from starcluster import utils
 from starcluster.logger import log
 
@@ -61,7 +67,22 @@ class SSHClient(object):
     private key authentication. Once established, this object allows executing
     commands, copying files to/from the remote host, various file querying
     similar to os.path.*, and much more.
+
+    Commands are run with the remote login environment (/etc/profile) unless
+    source_profile=False is passed. By default the environment /etc/profile
+    sets up is captured once per connection and re-applied to each command as
+    exported variables rather than sourcing /etc/profile for every command.
+    Set cache_profile=False (or SSHClient.cache_profile = False for all
+    clients) to source /etc/profile before each command instead.
     """
+    # variables that differ between shells regardless of /etc/profile
+    _PROFILE_ENV_IGNORE = ['_', 'SHLVL', 'PWD', 'OLDPWD']
+
+    cache_profile = True
+
+    # put()/get() stream directories holding more files than this as a tar
+    # archive rather than creating each file separately
+    tar_threshold = 1000
 
     def __init__(self,
                  host,
@@ -71,7 +92,9 @@ class SSHClient(object):
                  private_key_pass=None,
                  compress=False,
                  port=22,
-                 timeout=30):
+                 timeout=30,
+                 connection_pool=None,
+                 cache_profile=None):
         self._host = host
         self._port = port
         self._pkey = None
@@ -81,6 +104,11 @@ class SSHClient(object):
         self._sftp = None
         self._scp = None
         self._transport = None
+        self._transport_key = None
+        self._conn_pool = connection_pool or get_connection_pool()
+        self._profile_setup = None
+        if cache_profile is not None:
+            self.cache_profile = cache_profile
         self._progress_bar = None
         self._compress = compress
         if private_key:
@@ -117,6 +145,31 @@ class SSHClient(object):
         pkey = self._pkey
         if private_key:
             pkey = self.load_private_key(private_key, private_key_pass)
+        key_id = None
+        if pkey is not None:
+            key_id = pkey.get_fingerprint()
+        conn_key = (host, port, username, key_id, bool(compress))
+        transport = self._conn_pool.acquire(
+            conn_key, lambda: self._open_transport(host, port, username, pkey,
+                                                   password, compress,
+                                                   timeout))
+        self.close()
+        self._transport = transport
+        self._transport_key = conn_key
+        try:
+            assert self.sftp is not None
+        except paramiko.SFTPError as e:
+            if 'Garbage packet received' in e:
+                log.debug("Garbage packet received", exc_info=True)
+                raise exception.SSHAccessDeniedViaAuthKeys(username)
+            raise
+        return self
+
+    def _open_transport(self, host, port, username, pkey, password, compress,
+                        timeout):
+        """
+        Open a new socket to host:port and return an authenticated transport
+        """
         log.debug("connecting to host %s on port %d as user %s" % (host, port,
                                                                    username))
         try:
@@ -141,16 +194,7 @@ class SSHClient(object):
             raise exception.SSHConnectionError(host, port)
         except Exception as e:
             raise exception.SSHError(str(e))
-        self.close()
-        self._transport = transport
-        try:
-            assert self.sftp is not None
-        except paramiko.SFTPError as e:
-            if 'Garbage packet received' in e:
-                log.debug("Garbage packet received", exc_info=True)
-                raise exception.SSHAccessDeniedViaAuthKeys(username)
-            raise
-        return self
+        return transport
 
     @property
     def transport(self):
@@ -214,6 +258,36 @@ class SSHClient(object):
             self._sftp = paramiko.SFTPClient.from_transport(self.transport)
         return self._sftp
 
+    def open_sftp(self, compress=None):
+        """
+        Opens a new SFTP session that is independent of self.sftp, e.g. for use
+        by another thread. The session shares this client's transport unless
+        compress differs from this client's setting, in which case a (pooled)
+        transport with compression enabled or disabled accordingly is used.
+        Close the returned paramiko.SFTPClient when finished with it.
+        """
+        transport = self.transport
+        if compress is None or bool(compress) == bool(self._compress):
+            return paramiko.SFTPClient.from_transport(transport)
+        host, port, username, key_id, _ = self._transport_key
+        conn_key = (host, port, username, key_id, bool(compress))
+        transport = self._conn_pool.acquire(
+            conn_key, lambda: self._open_transport(host, port, username,
+                                                   self._pkey, self._password,
+                                                   compress, self._timeout))
+        try:
+            sftp = paramiko.SFTPClient.from_transport(transport)
+        except Exception:
+            self._conn_pool.release(conn_key, transport)
+            raise
+        close = sftp.close
+
+        def close_and_release():
+            close()
+            self._conn_pool.release(conn_key, transport)
+        sftp.close = close_and_release
+        return sftp
+
     @property
     def scp(self):
         """Initialize the SCP client."""
@@ -305,19 +379,24 @@ class SSHClient(object):
                 lines.append(line)
         return lines
 
+    def edit_file(self, remote_file):
+        """
+        Returns a RemoteFileEditor that collects line removals and appends
+        for remote_file and applies them atomically on the remote host with a
+        single command when committed (or its with-block exits)
+        """
+        return RemoteFileEditor(self, remote_file)
+
     def remove_lines_from_file(self, remote_file, regex):
         """
-        Removes lines matching regex from remote_file
+        Removes lines matching regex (a POSIX extended regular expression)
+        from remote_file on the remote host
         """
         if regex in [None, '']:
             log.debug('no regex supplied...returning')
             return
-        lines = self.get_remote_file_lines(remote_file, regex, matching=False)
-        log.debug("new %s after removing regex (%s) matches:\n%s" %
-                  (remote_file, regex, ''.join(lines)))
-        f = self.remote_file(remote_file)
-        f.writelines(lines)
-        f.close()
+        with self.edit_file(remote_file) as f:
+            f.remove_lines(regex)
 
     def unlink(self, remote_file):
         return self.sftp.unlink(remote_file)
@@ -328,8 +407,100 @@ class SSHClient(object):
         """
         rfile = self.sftp.open(file, mode)
         rfile.name = file
+        if mode != 'r' and self._is_profile_path(file):
+            # the environment may be captured between opening and closing
+            # the file so invalidate the cached environment in both cases
+            self.invalidate_profile_env()
+            close = rfile.close
+
+            def close_and_invalidate():
+                close()
+                self.invalidate_profile_env()
+            rfile.close = close_and_invalidate
         return rfile
 
+    def _is_profile_path(self, path):
+        return posixpath.normpath(path).startswith('/etc/profile')
+
+    def invalidate_profile_env(self):
+        """
+        Discards the cached login environment so that it's captured again
+        before the next command. Call this after modifying /etc/profile or
+        /etc/profile.d/* by means other than remote_file() or put().
+        """
+        self._profile_setup = None
+
+    def _capture_profile_env(self):
+        """
+        Returns a shell snippet that recreates the environment set up by
+        sourcing /etc/profile, or None if the environment could not be
+        captured. Shell functions and aliases defined by the profile are not
+        captured.
+        """
+        marker = '__starcluster_profile_env__'
+        cmd = ("env -0; printf '%s\\0'; source /etc/profile >/dev/null 2>&1; "
+               "env -0" % marker)
+        channel = self.exec_channel(cmd, source_profile=False)
+        data = []
+        chunk = channel.recv(32768)
+        while chunk:
+            data.append(chunk)
+            chunk = channel.recv(32768)
+        status = channel.recv_exit_status()
+        channel.close()
+        entries = utils.to_str(b''.join(data)).split('\0')
+        if status != 0 or marker not in entries:
+            log.debug("unable to capture login environment on %s "
+                      "(status %s)" % (self._host, status))
+            return None
+        idx = entries.index(marker)
+        before, after = [dict([e.split('=', 1) for e in env if '=' in e])
+                         for env in (entries[:idx], entries[idx + 1:])]
+        exports = []
+        for name in sorted(after):
+            if name in self._PROFILE_ENV_IGNORE:
+                continue
+            if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name):
+                continue
+            if before.get(name) != after[name]:
+                value = after[name].replace("'", "'\\''")
+                exports.append("%s='%s'" % (name, value))
+        unsets = [name for name in sorted(before) if name not in after and
+                  name not in self._PROFILE_ENV_IGNORE]
+        setup = []
+        if exports:
+            setup.append('export ' + ' '.join(exports))
+        if unsets:
+            setup.append('unset ' + ' '.join(unsets))
+        log.debug("captured login environment on %s (%d variables)" %
+                  (self._host, len(exports)))
+        return ' && '.join(setup)
+
+    def _get_profile_setup(self):
+        """
+        Returns the shell snippet used to set up the login environment before
+        running a command
+        """
+        if not self.cache_profile:
+            return "source /etc/profile"
+        if self._profile_setup is None:
+            self._profile_setup = self._capture_profile_env()
+            if self._profile_setup is None:
+                return "source /etc/profile"
+        return self._profile_setup
+
+    def _get_command(self, command, source_profile=True):
+        """
+        Returns command prefixed with the login environment setup if
+        source_profile is True
+        """
+        if not source_profile:
+            return command
+        setup = self._get_profile_setup()
+        if not setup:
+            return command
+        return "%s && %s" % (setup, command)
+
     def path_exists(self, path):
         """
         Test whether a remote path exists.
@@ -431,9 +602,22 @@ class SSHClient(object):
             return [obj]
         return obj
 
-    def get(self, remotepaths, localpath=''):
+    def get(self, remotepaths, localpath='', streams=1, resume=False,
+            compress=None, chunk_size=None, tar=None, tar_compression=None):
         """
         Copies one or more files from the remote host to the local host.
+
+        By default the files are copied over a single scp stream. If
+        streams > 1, resume or compress is given the files are copied with a
+        transfer.FileTransfer over several SFTP sessions at once instead (see
+        transfer.FileTransfer for the options).
+
+        If tar is True the files are streamed as a single tar archive
+        (compressed with tar_compression, if given, or with gzip if compress
+        is set) instead. By default
+        (tar=None) this is done automatically when copying directories with
+        more than tar_threshold files in total and none of the SFTP options
+        are given.
         """
         remotepaths = self._make_list(remotepaths)
         localpath = localpath or os.getcwd()
@@ -457,7 +641,20 @@ class SSHClient(object):
             if self.isdir(rpath):
                 recursive = True
                 break
+        sftp = streams > 1 or resume or compress is not None
         try:
+            if tar is None and recursive and not sftp:
+                nfiles = transfer.remote_file_stats(self, remotepaths)[0]
+                tar = nfiles > self.tar_threshold
+            if tar:
+                xfer = self._get_file_transfer(
+                    compress=compress, tar_compression=tar_compression)
+                return xfer.get_tar(remotepaths, localpath)
+            if sftp:
+                xfer = self._get_file_transfer(streams=streams, resume=resume,
+                                               compress=compress,
+                                               chunk_size=chunk_size)
+                return xfer.get(remotepaths, localpath)
             self.scp.get(remotepaths, local_path=localpath,
                          recursive=recursive)
         except Exception as e:
@@ -465,9 +662,22 @@ class SSHClient(object):
                       str(remotepaths), localpath)
             raise exception.SCPException(str(e))
 
-    def put(self, localpaths, remotepath='.'):
+    def _get_file_transfer(self, chunk_size=None, **kwargs):
+        if chunk_size:
+            kwargs['chunk_size'] = chunk_size
+        return transfer.FileTransfer(self, **kwargs)
+
+    def put(self, localpaths, remotepath='.', streams=1, resume=False,
+            compress=None, chunk_size=None, sync=False, delete=False,
+            tar=None, tar_compression=None):
         """
         Copies one or more files from the local host to the remote host.
+
+        See get() for the streams, resume, compress, chunk_size, tar and
+        tar_compression options. If sync is True only new files and the
+        changed parts of modified files are sent (see
+        transfer.FileTransfer.sync) and if delete is True as well remote files
+        that no longer exist locally are removed.
         """
         localpaths = self._make_list(localpaths)
         recursive = False
@@ -475,13 +685,34 @@ class SSHClient(object):
             if os.path.isdir(lpath):
                 recursive = True
                 break
+        sftp = streams > 1 or resume or compress is not None
         try:
+            if sync:
+                xfer = self._get_file_transfer(streams=streams, resume=resume,
+                                               compress=compress,
+                                               chunk_size=chunk_size)
+                return xfer.sync(localpaths, remotepath, delete=delete)
+            if tar is None and recursive and not sftp:
+                tar = transfer.count_local_files(
+                    localpaths, limit=self.tar_threshold) > self.tar_threshold
+            if tar:
+                xfer = self._get_file_transfer(
+                    compress=compress, tar_compression=tar_compression)
+                return xfer.put_tar(localpaths, remotepath)
+            if sftp:
+                xfer = self._get_file_transfer(streams=streams, resume=resume,
+                                               compress=compress,
+                                               chunk_size=chunk_size)
+                return xfer.put(localpaths, remotepath)
             self.scp.put(localpaths, remote_path=remotepath,
                          recursive=recursive)
         except Exception as e:
             log.debug("put failed: localpaths=%s, remotepath=%s",
                       str(localpaths), remotepath)
             raise exception.SCPException(str(e))
+        finally:
+            if self._is_profile_path(remotepath):
+                self.invalidate_profile_env()
 
     def execute_async(self, command, source_profile=True):
         """
@@ -500,36 +731,42 @@ class SSHClient(object):
         """
         Execute a remote command and return the exit status
         """
+        command = self._get_command(command, source_profile)
         channel = self.transport.open_session()
-        if source_profile:
-            command = "source /etc/profile && %s" % command
         channel.exec_command(command)
         self.__last_status = channel.recv_exit_status()
         return self.__last_status
 
+    def exec_channel(self, command, source_profile=True):
+        """
+        Start a remote command and return its channel without waiting for the
+        command to finish
+        """
+        log.debug("executing remote command: %s" % command)
+        command = self._get_command(command, source_profile)
+        channel = self.transport.open_session()
+        channel.exec_command(command)
+        return channel
+
     def _get_output(self, channel, silent=True, only_printable=False):
         """
         Returns the stdout/stderr output from a ssh channel as a list of
         strings (non-interactive only)
         """
-        # stdin = channel.makefile('wb', -1)
-        stdout = channel.makefile('rb', -1)
-        stderr = channel.makefile_stderr('rb', -1)
         if silent:
+            stdout = channel.makefile('rb', -1)
+            stderr = channel.makefile_stderr('rb', -1)
             output = stdout.readlines() + stderr.readlines()
         else:
-            output = []
-            line = None
-            while line != '':
-                line = utils.to_str(stdout.readline())
+            # print stdout and stderr as they arrive but keep returning
+            # stdout followed by stderr
+            output = dict(stdout=[], stderr=[])
+            for stream, line in self._iter_channel(channel):
                 if only_printable:
                     line = ''.join(c for c in line if c in string.printable)
-                if line != '':
-                    output.append(line)
-                    print(line, end="")
-            for line in stderr.readlines():
-                output.append(line)
-                print(line, end="")
+                output[stream].append(line)
+                print(line)
+            output = output['stdout'] + output['stderr']
         if only_printable:
             output = map(lambda line: ''.join(c for c in utils.to_str(line)
                                               if c in string.printable),
@@ -537,6 +774,99 @@ class SSHClient(object):
         output = map(lambda line: line.strip(), output)
         return output
 
+    def _split_chunk(self, stream, data, partial, bufsize):
+        """
+        Splits data received on stream into complete lines, keeping any
+        trailing partial line in partial[stream]. A partial line that grows
+        beyond bufsize bytes is returned as is to keep memory use bounded.
+        """
+        parts = (partial[stream] + data).split(b'\n')
+        partial[stream] = parts.pop()
+        lines = [(stream, utils.to_str(p).rstrip('\r')) for p in parts]
+        if len(partial[stream]) >= bufsize:
+            lines.append((stream, utils.to_str(partial[stream])))
+            partial[stream] = b''
+        return lines
+
+    def _iter_channel(self, channel, lines=True, bufsize=32768,
+                      poll_interval=0.01):
+        """
+        Yields (stream, data) tuples from a channel's output as it arrives
+        where stream is either 'stdout' or 'stderr'. If lines is True data is
+        a line of output (without the line ending), otherwise data is a raw
+        chunk of bytes. Returns when the remote command has exited and all
+        of its output has been read.
+        """
+        streams = [('stdout', channel.recv_ready, channel.recv),
+                   ('stderr', channel.recv_stderr_ready, channel.recv_stderr)]
+        partial = dict(stdout=b'', stderr=b'')
+        finished = False
+        while not finished:
+            got_data = False
+            for stream, ready, recv in streams:
+                while ready():
+                    data = recv(bufsize)
+                    got_data = True
+                    if not lines:
+                        yield stream, data
+                        continue
+                    for item in self._split_chunk(stream, data, partial,
+                                                  bufsize):
+                        yield item
+            if got_data:
+                continue
+            if channel.exit_status_ready():
+                # read whatever arrived after the exit status until EOF
+                for stream, ready, recv in streams:
+                    data = recv(bufsize)
+                    while data:
+                        if not lines:
+                            yield stream, data
+                        else:
+                            for item in self._split_chunk(stream, data,
+                                                          partial, bufsize):
+                                yield item
+                        data = recv(bufsize)
+                finished = True
+            else:
+                time.sleep(poll_interval)
+        for stream, ready, recv in streams:
+            if partial[stream]:
+                yield stream, utils.to_str(partial[stream])
+
+    def execute_iter(self, command, lines=True, ignore_exit_status=False,
+                     source_profile=True, bufsize=32768):
+        """
+        Execute a remote command and yield its output as it arrives instead
+        of collecting all of it in memory first.
+
+        Yields (stream, data) tuples where stream is 'stdout' or 'stderr' in
+        the order the output was received. If lines is True data is a line of
+        output (without the line ending), otherwise a raw chunk of bytes of
+        at most bufsize bytes.
+
+        Once iteration has finished the exit status is available from
+        get_last_status(). Raises exception.RemoteCommandFailed at the end
+        of the iteration if the command failed unless ignore_exit_status is
+        True. Stopping iteration early closes the channel.
+
+        for stream, line in ssh.execute_iter('apt-get -y upgrade'):
+            print(line)
+        """
+        channel = self.exec_channel(command, source_profile=source_profile)
+        self.__last_status = None
+        try:
+            for item in self._iter_channel(channel, lines=lines,
+                                           bufsize=bufsize):
+                yield item
+            exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        self.__last_status = exit_status
+        self._check_exit_status(command, exit_status, [],
+                                ignore_exit_status=ignore_exit_status,
+                                log_output=False)
+
     def execute(self, command, silent=True, only_printable=False,
                 ignore_exit_status=False, log_output=True, detach=False,
                 source_profile=True, raise_on_failure=True):
@@ -554,27 +884,39 @@ class SSHClient(object):
         detach - detach the remote process so that it continues to run even
                  after the SSH connection closes (does NOT return output or
                  check for non-zero exit status if detach=True)
-        source_profile - if True prefix the command with "source /etc/profile"
+        source_profile - if True run the command in the login environment set
+                         up by /etc/profile (see SSHClient)
         raise_on_failure - raise exception.SSHError if command fails
         returns List of output lines
         """
-        channel = self.transport.open_session()
         if detach:
             command = "nohup %s &" % command
-            if source_profile:
-                command = "source /etc/profile && %s" % command
+            command = self._get_command(command, source_profile)
+            channel = self.transport.open_session()
             channel.exec_command(command)
             channel.close()
             self.__last_status = None
             return
-        if source_profile:
-            command = "source /etc/profile && %s" % command
         log.debug("executing remote command: %s" % command)
-        channel.exec_command(command)
+        channel = self.transport.open_session()
+        channel.exec_command(self._get_command(command, source_profile))
         output = self._get_output(channel, silent=silent,
                                   only_printable=only_printable)
         exit_status = channel.recv_exit_status()
         self.__last_status = exit_status
+        self._check_exit_status(command, exit_status, output,
+                                ignore_exit_status=ignore_exit_status,
+                                log_output=log_output,
+                                raise_on_failure=raise_on_failure)
+        return output
+
+    def _check_exit_status(self, command, exit_status, output,
+                           ignore_exit_status=False, log_output=True,
+                           raise_on_failure=True):
+        """
+        Logs the output of a finished remote command and raises
+        exception.RemoteCommandFailed if it failed (see execute)
+        """
         out_str = utils.join(output, '\n')
         if exit_status != 0:
             msg = "remote command '%s' failed with status %d"
@@ -596,7 +938,20 @@ class SSHClient(object):
                 log.debug("output of '%s':\n%s" % (command, out_str))
             else:
                 log.debug("output of '%s' has been hidden" % command)
-        return output
+
+    def batch(self, source_profile=True):
+        """
+        Returns a CommandBatch that collects commands and runs them on the
+        remote host as a single script over one channel when the batch is
+        run (or its with-block exits):
+
+        with ssh.batch() as batch:
+            batch.execute('mkdir -p /data')
+            status = batch.execute('pkill foo', ignore_exit_status=True)
+            batch.execute('chown -R sgeadmin /data')
+        print(status.exit_status, status.output)
+        """
+        return CommandBatch(self, source_profile=source_profile)
 
     def has_required(self, progs):
         """
@@ -634,11 +989,19 @@ class SSHClient(object):
         return env
 
     def close(self):
-        """Closes the connection and cleans up."""
+        """
+        Closes this client's SFTP session and hands the underlying transport
+        back to the connection pool
+        """
         if self._sftp:
             self._sftp.close()
+            self._sftp = None
+        self._scp = None
+        self._profile_setup = None
         if self._transport:
-            self._transport.close()
+            self._conn_pool.release(self._transport_key, self._transport)
+            self._transport = None
+            self._transport_key = None
 
     def _invoke_shell(self, term='screen', cols=80, lines=24):
         chan = self.transport.open_session()
@@ -749,6 +1112,608 @@ class SSHClient(object):
 Connection = SSHClient
 
 
+class _PooledTransport(object):
+    def __init__(self, transport):
+        self.transport = transport
+        self.refs = 0
+        self.last_used = time.time()
+
+
+class SSHConnectionPool(object):
+    """
+    Process-wide pool of authenticated SSH transports shared by all SSHClient
+    objects (and therefore all Node objects, plugins and threads).
+
+    Transports are keyed by (host, port, username, key fingerprint,
+    compression). A pooled transport is probed with an SSH_MSG_IGNORE packet
+    before being handed out again if it has been idle for longer than
+    keepalive_interval and is transparently replaced if the probe fails. At
+    most max_handshakes new connections (socket + key exchange + auth) are
+    negotiated concurrently and transports that have not been used by any
+    client for idle_timeout seconds are closed.
+    """
+    def __init__(self, max_handshakes=20, idle_timeout=300,
+                 keepalive_interval=30):
+        self.max_handshakes = max_handshakes
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self._lock = threading.Lock()
+        self._handshakes = threading.BoundedSemaphore(max_handshakes)
+        self._entries = {}
+        self._key_locks = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _is_healthy(self, entry):
+        transport = entry.transport
+        if not transport.is_active():
+            return False
+        if time.time() - entry.last_used < self.keepalive_interval:
+            return True
+        try:
+            transport.send_ignore()
+        except (socket.error, EOFError, paramiko.SSHException):
+            return False
+        return transport.is_active()
+
+    def acquire(self, key, connect):
+        """
+        Returns a healthy transport for key. If no healthy transport is pooled
+        for key, connect() is called to create one.
+        """
+        self.evict_idle()
+        with self._get_key_lock(key):
+            entry = self._entries.get(key)
+            if entry and not self._is_healthy(entry):
+                log.debug("discarding dead transport for %s@%s:%s" %
+                          (key[2], key[0], key[1]))
+                with self._lock:
+                    self._entries.pop(key, None)
+                entry.transport.close()
+                entry = None
+            if entry is None:
+                with self._handshakes:
+                    transport = connect()
+                if self.keepalive_interval:
+                    transport.set_keepalive(self.keepalive_interval)
+                entry = _PooledTransport(transport)
+                with self._lock:
+                    self._entries[key] = entry
+            with self._lock:
+                entry.refs += 1
+                entry.last_used = time.time()
+            return entry.transport
+
+    def release(self, key, transport):
+        """
+        Hands transport back to the pool. Transports that have since been
+        replaced in the pool are closed immediately.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.transport is transport:
+                entry.refs = max(entry.refs - 1, 0)
+                entry.last_used = time.time()
+                return
+        transport.close()
+
+    def evict_idle(self):
+        """
+        Closes all transports that have not been used by any client for more
+        than idle_timeout seconds
+        """
+        now = time.time()
+        with self._lock:
+            idle = [(k, e) for k, e in self._entries.items()
+                    if e.refs == 0 and now - e.last_used > self.idle_timeout]
+            for k, e in idle:
+                del self._entries[k]
+        for k, e in idle:
+            log.debug("closing idle transport for %s@%s:%s" %
+                      (k[2], k[0], k[1]))
+            e.transport.close()
+
+    def close_all(self):
+        """Closes every pooled transport"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.transport.close()
+
+
+class RemoteCommandResult(object):
+    """
+    Output and exit status of a command run on a single host by
+    execute_parallel
+    """
+    def __init__(self, host, command):
+        self.host = host
+        self.command = command
+        self.stdout = []
+        self.stderr = []
+        self.exit_status = None
+
+    def __repr__(self):
+        return '<RemoteCommandResult: %s (status: %s)>' % (self.host,
+                                                           self.exit_status)
+
+    @property
+    def output(self):
+        return self.stdout + self.stderr
+
+    @property
+    def failed(self):
+        return self.exit_status not in [None, 0]
+
+
+class _CommandChannel(object):
+    def __init__(self, channel, result):
+        self.channel = channel
+        self.result = result
+        self.stdout = []
+        self.stderr = []
+
+    def poll(self, bufsize=32768):
+        """
+        Read any output that is available without blocking. Returns True if
+        any data was read
+        """
+        chan = self.channel
+        got_data = False
+        while chan.recv_ready():
+            self.stdout.append(chan.recv(bufsize))
+            got_data = True
+        while chan.recv_stderr_ready():
+            self.stderr.append(chan.recv_stderr(bufsize))
+            got_data = True
+        return got_data
+
+    def finish(self, bufsize=32768):
+        chan = self.channel
+        for buf, recv in [(self.stdout, chan.recv),
+                          (self.stderr, chan.recv_stderr)]:
+            data = recv(bufsize)
+            while data:
+                buf.append(data)
+                data = recv(bufsize)
+        self.result.exit_status = chan.recv_exit_status()
+        chan.close()
+        for buf, lines in [(self.stdout, self.result.stdout),
+                           (self.stderr, self.result.stderr)]:
+            out = utils.to_str(b''.join(buf))
+            lines.extend([l.strip() for l in out.splitlines()])
+
+
+class CommandBatch(object):
+    """
+    Runs several remote commands as one script to save the network round
+    trip and shell startup of executing each command separately. Each
+    command still runs in its own subshell and gets its own output and exit
+    status. As with consecutive SSHClient.execute calls the batch stops at
+    the first command that fails unless that command was added with
+    ignore_exit_status=True.
+
+    Use SSHClient.batch() to create one.
+    """
+    def __init__(self, ssh, source_profile=True):
+        self.ssh = ssh
+        self.source_profile = source_profile
+        self.commands = []
+        self.staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.run()
+
+    def execute(self, command, ignore_exit_status=False, log_output=True):
+        """
+        Adds command to the batch and returns a RemoteCommandResult that
+        holds the command's output and exit status once the batch has run.
+        The exit status stays None if the command never ran because an
+        earlier command failed.
+        """
+        result = RemoteCommandResult(self.ssh._host, command)
+        self.commands.append((result, ignore_exit_status, log_output))
+        return result
+
+    def edit(self, editor, ignore_exit_status=False, log_output=True):
+        """
+        Adds the command that applies the edits collected by editor (a
+        RemoteFileEditor) to the batch and returns its RemoteCommandResult or
+        None if there is nothing to do. Edits too large to pass inline are
+        uploaded when the batch runs and removed when the batch exits.
+        """
+        command = editor.get_command()
+        if command is None:
+            return None
+        self.staged.extend(editor.get_staged_files())
+        return self.execute(command, ignore_exit_status=ignore_exit_status,
+                            log_output=log_output)
+
+    def _get_script(self, marker):
+        script = []
+        if self.source_profile:
+            script.append(self.ssh._get_profile_setup())
+        if self.staged:
+            script.append("trap 'rm -f %s' EXIT" % ' '.join(
+                [path for path, lines in self.staged]))
+        for i, (result, ignore_exit_status, log_output) in enumerate(
+                self.commands):
+            script.append("(\n%s\n)" % result.command)
+            script.append("s=$?; echo; echo '%s' %d $s; echo >&2; "
+                          "echo '%s' %d $s >&2" % (marker, i, marker, i))
+            if not ignore_exit_status:
+                script.append("[ $s -eq 0 ] || exit $s")
+        return '\n'.join(script)
+
+    def _split_output(self, lines, marker, attr):
+        current = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == marker:
+                # drop the newline added before the marker
+                if current and current[-1] == '':
+                    current.pop()
+                result = self.commands[int(fields[1])][0]
+                getattr(result, attr).extend(current)
+                result.exit_status = int(fields[2])
+                current = []
+            else:
+                current.append(line)
+
+    def run(self):
+        """
+        Runs all commands added so far and returns their results. Raises
+        exception.RemoteCommandFailed for the first command that failed
+        without ignore_exit_status.
+        """
+        if not self.commands:
+            return []
+        marker = '__starcluster_batch_%s__' % uuid.uuid4().hex
+        script = self._get_script(marker)
+        log.debug("executing batch of %d remote commands" %
+                  len(self.commands))
+        uploaded = []
+        try:
+            for path, lines in self.staged:
+                uploaded.append(path)
+                rfile = self.ssh.remote_file(path, 'w')
+                rfile.write(''.join([line + '\n' for line in lines]))
+                rfile.close()
+            # from here on the script's EXIT trap removes the staged files
+            channel = self.ssh.exec_channel(script,
+                                            source_profile=False)
+        except Exception:
+            if uploaded:
+                self.ssh.execute('rm -f %s' % ' '.join(uploaded),
+                                 ignore_exit_status=True,
+                                 raise_on_failure=False)
+            raise
+        cc = _CommandChannel(channel, RemoteCommandResult(self.ssh._host,
+                                                          script))
+        while not channel.exit_status_ready():
+            if not cc.poll():
+                time.sleep(0.01)
+        cc.finish()
+        self._split_output(cc.result.stdout, marker, 'stdout')
+        self._split_output(cc.result.stderr, marker, 'stderr')
+        for result, ignore_exit_status, log_output in self.commands:
+            if result.exit_status is None:
+                break
+            self.ssh._check_exit_status(
+                result.command, result.exit_status, result.output,
+                ignore_exit_status=ignore_exit_status, log_output=log_output)
+        if cc.result.exit_status != 0:
+            # the script itself failed, e.g. due to a syntax error
+            self.ssh._check_exit_status(script, cc.result.exit_status,
+                                        cc.result.output)
+        results = [r for r, ignore, log_output in self.commands]
+        self.commands = []
+        self.staged = []
+        return results
+
+
+class RemoteFileEditor(object):
+    """
+    Collects edits to a remote text file and applies all of them with a
+    single remote command instead of downloading the file, editing it locally
+    and uploading it again.
+
+    The edited file is written to a temporary file next to the original
+    which is given the original's owner and permissions and then renamed over
+    it, so other processes never see a partially written file. Lines matching
+    any of the remove_lines() patterns (POSIX extended regular expressions,
+    as used by grep -E) are dropped from the existing content before the
+    lines passed to append() and the contents of the remote files passed to
+    append_file() are added. Missing files are created if anything is
+    appended, otherwise the edit is a no-op.
+
+    With use_block() the appended lines go into a block delimited by begin
+    and end marker lines instead, which is kept at the end of the file. This
+    lets code manage a set of lines in a shared file, e.g. /etc/hosts,
+    without touching the rest of it.
+
+    Use SSHClient.edit_file() to create one:
+
+    with ssh.edit_file('/etc/hosts') as hosts:
+        hosts.remove_lines('node001|node002')
+        hosts.append(['10.0.0.1 node001', '10.0.0.2 node002'])
+
+    The remote command is passed to the remote shell as a single argument,
+    which Linux limits to 128KB. Appended lines and remove_lines() patterns
+    larger than INLINE_MAX bytes are therefore read from temporary files
+    instead, which are uploaded over SFTP right before the command runs and
+    removed when it exits. Use CommandBatch.edit() rather than
+    CommandBatch.execute() to add the edits to a batch so that this happens.
+    """
+    INLINE_MAX = 16 * 1024
+
+    def __init__(self, ssh, path):
+        self.ssh = ssh
+        self.path = path
+        self.stage_prefix = '/tmp/.starcluster-edit-%s' % uuid.uuid4().hex
+        self.patterns = []
+        self.pattern_files = []
+        self.lines = []
+        self.files = []
+        self.block = None
+        self.replace_block = False
+        self.owner = None
+        self.mode = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+
+    def remove_lines(self, regex):
+        """Removes all lines matching regex (ignored if regex is empty)"""
+        if regex in [None, '']:
+            log.debug('no regex supplied...skipping')
+            return
+        self.patterns.append(regex)
+
+    def append(self, lines):
+        """Appends one or more lines (a string or a list of strings)"""
+        if isinstance(lines, six.string_types):
+            lines = [lines]
+        for line in lines:
+            self.lines.extend(line.splitlines() or [''])
+
+    def append_file(self, path):
+        """
+        Appends the contents of another remote file, e.g. to add the same
+        content to several files without sending it once per file
+        """
+        self.files.append(path)
+
+    def remove_lines_in_file(self, path):
+        """
+        Removes all lines matching any of the patterns listed, one per line,
+        in another remote file
+        """
+        self.pattern_files.append(path)
+
+    def use_block(self, begin, end, replace=False):
+        """
+        Appends lines to the block delimited by the begin and end marker
+        lines, creating the block if needed. remove_lines() patterns apply
+        inside and outside of the block. If replace is True the existing
+        content of the block is dropped.
+        """
+        self.block = (begin, end)
+        self.replace_block = replace
+
+    def chown(self, uid, gid):
+        """Sets the owner of the edited file"""
+        self.owner = (uid, gid)
+
+    def chmod(self, mode):
+        """Sets the permissions of the edited file"""
+        self.mode = mode
+
+    def get_command(self):
+        """
+        Returns the shell command that applies the edits or None if there is
+        nothing to do. The command reads the files returned by
+        get_staged_files() which must be uploaded first.
+        """
+        if not (self.patterns or self.pattern_files or self.lines or
+                self.files or self.block or self.owner or self.mode):
+            return None
+        cmd = ['f=$(readlink -f %s)' % shlex_quote(self.path)]
+        staged = dict(self.get_staged_files())
+        pattern_files = list(self.pattern_files)
+        patterns = []
+        if self.stage_prefix + '.patterns' in staged:
+            pattern_files.append(self.stage_prefix + '.patterns')
+        else:
+            patterns = ['-e %s' % shlex_quote(p) for p in self.patterns]
+        patterns += ['-f %s' % shlex_quote(p) for p in pattern_files]
+        patterns = ' '.join(patterns)
+        lines = ''
+        if self.stage_prefix + '.lines' in staged:
+            lines = 'cat %s' % (self.stage_prefix + '.lines')
+        elif self.lines:
+            lines = 'printf "%%s\\n" %s' % ' '.join(map(shlex_quote,
+                                                        self.lines))
+        if self.lines or self.files or self.block:
+            cmd.append('[ -e "$f" ] || touch "$f"')
+        else:
+            cmd.append('[ -e "$f" ] || exit 0')
+        cmd.append('tmp=$(mktemp "$f.XXXXXX") || exit 1')
+
+        def _filter(source):
+            if not patterns:
+                return '{ %s; }' % source
+            return '{ %s | grep -Ev %s || [ $? -eq 1 ]; }' % (source,
+                                                              patterns)
+
+        parts = []
+        if self.block:
+            begin, end = map(shlex_quote, self.block)
+            awk = ("awk -v b=%s -v e=%s '$0 == b {i = 1; next} "
+                   "$0 == e {i = 0; next} " % (begin, end))
+            # lines outside of the block, then the block itself
+            parts.append(_filter(awk + "!i' \"$f\""))
+            parts.append('printf "%%s\\n" %s' % begin)
+            if not self.replace_block:
+                parts.append(_filter(awk + "i' \"$f\""))
+        else:
+            parts.append(_filter('cat "$f"'))
+        if lines:
+            parts.append(lines)
+        if self.files:
+            parts.append('cat %s' % ' '.join(map(shlex_quote, self.files)))
+        if self.block:
+            parts.append('printf "%%s\\n" %s' % end)
+        edit = '{ %s; }' % ' && '.join(parts)
+        attrs = ['chmod --reference="$f" "$tmp"',
+                 'chown --reference="$f" "$tmp"']
+        if self.mode is not None:
+            attrs.append('chmod %o "$tmp"' % self.mode)
+        if self.owner is not None:
+            attrs.append('chown %d:%d "$tmp"' % self.owner)
+        cmd.append('%s > "$tmp" && %s && mv -f "$tmp" "$f" || '
+                   '{ rm -f "$tmp"; exit 1; }' % (edit, ' && '.join(attrs)))
+        return '(\n%s\n)' % '\n'.join(cmd)
+
+    def _size(self, lines):
+        return sum([len(line) + 1 for line in lines])
+
+    def get_staged_files(self):
+        """
+        Returns a (path, lines) tuple for each temporary file the command
+        returned by get_command() reads the appended lines or remove_lines()
+        patterns from because they're too large to pass inline
+        """
+        staged = []
+        if self._size(self.patterns) > self.INLINE_MAX:
+            staged.append((self.stage_prefix + '.patterns', self.patterns))
+        if self._size(self.lines) > self.INLINE_MAX:
+            staged.append((self.stage_prefix + '.lines', self.lines))
+        return staged
+
+    def commit(self):
+        """Applies all edits with a single remote command"""
+        batch = CommandBatch(self.ssh)
+        if batch.edit(self, log_output=False) is None:
+            return
+        log.debug("editing %s: removing lines matching %s, appending %d "
+                  "line(s)" % (self.path, self.patterns, len(self.lines)))
+        try:
+            batch.run()
+        finally:
+            if self.ssh._is_profile_path(self.path):
+                self.ssh.invalidate_profile_env()
+        self.patterns = []
+        self.pattern_files = []
+        self.lines = []
+        self.files = []
+        self.block = None
+        self.replace_block = False
+        self.owner = self.mode = None
+
+
+def execute_parallel(clients, command, max_concurrency=None, fail_fast=False,
+                     ignore_exit_status=False, source_profile=True,
+                     progress_bar=None, poll_interval=0.05):
+    """
+    Run command on many hosts at once from a single thread by multiplexing one
+    SSH channel per host and return an ordered dictionary mapping each host
+    label to a RemoteCommandResult.
+
+    clients - list of (label, SSHClient) tuples
+    max_concurrency - maximum number of channels open at any time
+                      (default: all)
+    fail_fast - stop at the first failure: close all open channels, skip the
+                remaining hosts and raise exception.RemoteCommandsFailed
+    ignore_exit_status - never raise on non-zero exit status, callers inspect
+                         the returned results instead. Otherwise all hosts are
+                         run and exception.RemoteCommandsFailed is raised at
+                         the end if the command failed on any of them
+    progress_bar - optional progressbar.ProgressBar updated as hosts finish
+    """
+    pending = list(clients)
+    pending.reverse()
+    results = collections.OrderedDict()
+    for label, ssh in clients:
+        results[label] = RemoteCommandResult(label, command)
+    max_concurrency = max_concurrency or len(pending)
+    if progress_bar:
+        progress_bar.maxval = len(pending)
+        progress_bar.update(0)
+    running = []
+    finished = 0
+    try:
+        while pending or running:
+            while pending and len(running) < max_concurrency:
+                label, ssh = pending.pop()
+                chan = ssh.exec_channel(command,
+                                        source_profile=source_profile)
+                running.append(_CommandChannel(chan, results[label]))
+            active = False
+            for cc in running[:]:
+                active = cc.poll() or active
+                if not cc.channel.exit_status_ready():
+                    continue
+                cc.finish()
+                running.remove(cc)
+                finished += 1
+                active = True
+                if progress_bar:
+                    progress_bar.update(finished)
+                result = cc.result
+                if result.failed:
+                    log.debug("remote command '%s' failed on %s with status "
+                              "%d:\n%s" % (command, result.host,
+                                           result.exit_status,
+                                           '\n'.join(result.output)))
+                    if fail_fast and not ignore_exit_status:
+                        raise exception.RemoteCommandsFailed(command, results)
+            if not active:
+                time.sleep(poll_interval)
+    finally:
+        for cc in running:
+            cc.channel.close()
+        if progress_bar and finished:
+            progress_bar.finish()
+    if not ignore_exit_status:
+        if any(r.failed for r in results.values()):
+            raise exception.RemoteCommandsFailed(command, results)
+    return results
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """
+    Returns the process-wide SSHConnectionPool
+    """
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = SSHConnectionPool()
+            atexit.register(_connection_pool.close_all)
+        return _connection_pool
+
+
 class SSHGlob(object):
 
     def __init__(self, ssh_client):
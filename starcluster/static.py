@@ -101,6 +101,10 @@ UD_PLUGINS_FNAME = "_sc_plugins.txt"
 UD_VOLUMES_FNAME = "_sc_volumes.txt"
 UD_ALIASES_FNAME = "_sc_aliases.txt"
 
+# markers of the block of /etc/hosts managed by StarCluster
+ETC_HOSTS_BEGIN = "# BEGIN STARCLUSTER HOSTS"
+ETC_HOSTS_END = "# END STARCLUSTER HOSTS"
+
 INSTANCE_METADATA_URI = "http://169.254.169.254/latest"
 INSTANCE_STATES = ['pending', 'running', 'shutting-down',
                    'terminated', 'stopping', 'stopped']
@@ -228,6 +232,7 @@ GLOBAL_SETTINGS = {
     'enable_experimental': (bool, False, False, None, None),
     'refresh_interval': (int, False, 30, None, None),
     'web_browser': (str, False, None, None, None),
+    'cache_profile_env': (bool, False, True, None, None),
     'include': (list, False, [], None, None),
 }
 
@@ -301,5 +306,7 @@ CLUSTER_SETTINGS = {
     'disable_queue': (bool, False, False, None, None),
     'force_spot_master': (bool, False, False, None, None),
     'disable_cloudinit': (bool, False, False, None, None),
+    'streaming_setup': (bool, False, False, None, None),
+    'nfs_subnet_exports': (bool, False, False, None, None),
     'dns_prefix': (bool, False, False, None, None),
 }
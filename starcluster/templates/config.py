@@ -28,6 +28,9 @@ config_template = """\
 DEFAULT_TEMPLATE=smallcluster
 # enable experimental features for this release
 #ENABLE_EXPERIMENTAL=True
+# Uncomment to source /etc/profile before every remote command instead of
+# capturing the login environment once per connection
+#CACHE_PROFILE_ENV=False
 # number of seconds to wait when polling instances (default: 30s)
 #REFRESH_INTERVAL=15
 # specify a web browser to launch when viewing spot history plots
@@ -126,6 +129,14 @@ NODE_INSTANCE_TYPE = m1.small
 # Uncomment to disable installing/configuring a queueing system on the
 # cluster (SGE)
 #DISABLE_QUEUE=True
+# Uncomment to configure each node as soon as it comes up rather than waiting
+# for the entire cluster to come up first (useful for large spot clusters)
+#STREAMING_SETUP=True
+# Uncomment to NFS-share /home, volumes and SGE to the cluster's whole VPC
+# subnet(s) rather than to each node (VPC-ONLY) (OPTIONAL)
+# WARNING: any host in the subnet(s) that the cluster's security group lets
+# in can then mount the shares read-write as root
+#NFS_SUBNET_EXPORTS=True
 # Uncomment to specify a different instance type for the master node (OPTIONAL)
 # (defaults to NODE_INSTANCE_TYPE if not specified)
 #MASTER_INSTANCE_TYPE = m1.small
@@ -0,0 +1,222 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local stand-ins for SSH clients shared by the test modules
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import threading
+import subprocess
+
+from starcluster import node
+from starcluster import sshutils
+
+
+class FakeChannel(object):
+    def __init__(self, stdout=b'', stderr=b'', status=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.status = status
+        self.closed = False
+
+    def _read(self, attr, bufsize):
+        data = getattr(self, attr)
+        setattr(self, attr, data[bufsize:])
+        return data[:bufsize]
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv(self, bufsize):
+        return self._read('stdout', bufsize)
+
+    def recv_stderr(self, bufsize):
+        return self._read('stderr', bufsize)
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return self.status
+
+    def close(self):
+        self.closed = True
+
+
+class LocalShellClient(sshutils.SSHClient):
+    """SSHClient stand-in that runs commands in a local bash shell"""
+    def __init__(self):
+        self._host = 'localhost'
+        self._profile_setup = None
+        self._sftp = None
+        self._scp = None
+        self._transport = None
+        self._transport_key = None
+        self.scripts = []
+
+    def exec_channel(self, command, source_profile=True):
+        self.scripts.append(command)
+        proc = subprocess.Popen(['bash', '-c', command],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        return FakeChannel(stdout=stdout, stderr=stderr,
+                           status=proc.returncode)
+
+    def remote_file(self, file, mode='w'):
+        return open(file, mode)
+
+
+class LocalSFTPFile(object):
+    def __init__(self, path, mode):
+        self._f = open(path, {'r': 'rb', 'w': 'wb', 'r+': 'r+b'}[mode])
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def seek(self, offset):
+        self._f.seek(offset)
+
+    def write(self, data):
+        self._f.write(data)
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            self._f.seek(offset)
+            yield self._f.read(length)
+
+    def chmod(self, mode):
+        os.chmod(self._f.name, mode)
+
+    def close(self):
+        self._f.close()
+
+
+class LocalSFTP(object):
+    def __init__(self, ssh):
+        self.ssh = ssh
+
+    def open(self, path, mode='r'):
+        return LocalSFTPFile(path, mode)
+
+    def truncate(self, path, size):
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def close(self):
+        with self.ssh.lock:
+            self.ssh.sessions -= 1
+
+
+class LocalChannel(object):
+    def __init__(self, command):
+        self.proc = subprocess.Popen(['bash', '-c', command],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def sendall(self, data):
+        self.proc.stdin.write(data)
+
+    def shutdown_write(self):
+        self.proc.stdin.close()
+
+    def makefile(self, mode='rb'):
+        return self.proc.stdout
+
+    def makefile_stderr(self, mode='rb'):
+        return self.proc.stderr
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+
+
+class LocalSSH(object):
+    """SSHClient stand-in whose 'remote' host is the local filesystem"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.peak_sessions = 0
+        self.commands = []
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def execute(self, command, log_output=True):
+        self.commands.append(command)
+        out = subprocess.check_output(['bash', '-c', command])
+        return out.decode('utf-8').splitlines()
+
+    def exec_channel(self, command, source_profile=True):
+        self.commands.append(command)
+        return LocalChannel(command)
+
+    def open_sftp(self, compress=None):
+        with self.lock:
+            self.sessions += 1
+            self.peak_sessions = max(self.peak_sessions, self.sessions)
+        return LocalSFTP(self)
+
+
+class StubConnection(object):
+    aws_access_key_id = 'AKIDSTUB'
+    aws_secret_access_key = 'SECRETSTUB'
+
+
+class StubInstance(object):
+    """Stand-in for a boto Instance with the attributes Node reads"""
+    def __init__(self, name, **kwargs):
+        self.id = name
+        self.connection = StubConnection()
+        self.state = 'running'
+        self.ip_address = self.private_ip_address = '10.0.0.1'
+        self.private_dns_name = name + '.ec2.internal'
+        self.public_dns_name = name + '.compute.amazonaws.com'
+        self.vpc_id = None
+        self.subnet_id = None
+        self.__dict__.update(kwargs)
+
+
+class StubNode(node.Node):
+    """
+    Node backed by a StubInstance and, optionally, a local SSH stand-in.
+    Instance attributes (ip_address, subnet_id, ...) can be overridden via
+    kwargs. Nothing talks to EC2 unless a test uses a method that does.
+    """
+    def __init__(self, alias='localhost', ssh=None, **kwargs):
+        node.Node.__init__(self, StubInstance(alias, **kwargs), None,
+                           alias=alias)
+        self._ssh = ssh
+
+    def __del__(self):
+        # the SSH stand-ins have no connections to close
+        pass
@@ -0,0 +1,581 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from starcluster import node
+from starcluster import utils
+from starcluster import static
+from starcluster import sshutils
+from starcluster import exception
+from starcluster import threadpool
+from starcluster import clustersetup
+from starcluster.cluster import Cluster
+from starcluster.tests import StarClusterTest
+from starcluster.tests.fakes import StubNode, LocalShellClient
+
+
+class FakeInstance(object):
+    def __init__(self, id, state):
+        self.id = id
+        self.state = state
+
+
+class FakeEC2(object):
+    def __init__(self, states):
+        self.states = states
+        self.calls = []
+
+    def get_all_instances(self, instance_ids=[], filters={}):
+        self.calls.append(filters)
+        return [FakeInstance(i, self.states[i])
+                for i in filters['instance-id']]
+
+
+class FakeNode(object):
+    update = node.Node.__dict__['update']
+    state = node.Node.state
+
+    def __init__(self, id):
+        self.instance = FakeInstance(id, 'pending')
+        self.state_refresher = None
+
+    @property
+    def id(self):
+        return self.instance.id
+
+
+class TestInstanceStateRefresher(StarClusterTest):
+
+    def test_single_call_per_interval(self):
+        ids = ['i-%d' % i for i in range(10)]
+        ec2 = FakeEC2(dict([(i, 'running') for i in ids]))
+        refresher = node.InstanceStateRefresher(ec2, max_age=60)
+        nodes = [FakeNode(i) for i in ids]
+        refresher.register(nodes)
+        assert [n.update() for n in nodes] == ['running'] * len(nodes)
+        assert len(ec2.calls) == 1
+        assert sorted(ec2.calls[0]['instance-id']) == sorted(ids)
+        ec2.states['i-0'] = 'terminated'
+        assert nodes[0].update() == 'running'
+        refresher.refresh(force=True)
+        assert nodes[0].state == 'terminated'
+        assert len(ec2.calls) == 2
+
+    def test_mark_fresh_and_unregister(self):
+        ec2 = FakeEC2({'i-1': 'running'})
+        refresher = node.InstanceStateRefresher(ec2, max_age=60)
+        n = FakeNode('i-1')
+        refresher.register([n])
+        refresher.mark_fresh()
+        assert n.update() == 'pending'
+        assert ec2.calls == []
+        refresher.unregister([n])
+        assert n.state_refresher is None
+        refresher.refresh(force=True)
+        assert ec2.calls == []
+
+
+class FakeStat(object):
+    st_mode = 0o100600
+    st_uid = 1000
+    st_gid = 1001
+
+
+class FakeRemoteFile(object):
+    def __init__(self, ssh, path, mode):
+        self.ssh = ssh
+        self.path = path
+        self.data = ssh.files.get(path)
+        self.writable = mode != 'r'
+
+    def read(self):
+        self.ssh.reads.append(self.path)
+        return self.data
+
+    def stat(self):
+        return FakeStat()
+
+    def write(self, data):
+        if self.ssh.broken:
+            raise IOError("connection lost")
+        if self.ssh.on_write:
+            self.ssh.on_write()
+        self.data = data
+
+    def chown(self, uid, gid):
+        self.owner = (uid, gid)
+
+    def chmod(self, mode):
+        self.mode = mode
+
+    def close(self):
+        if self.writable:
+            self.ssh.files[self.path] = (self.data, self.owner, self.mode)
+
+
+class FakeSSH(object):
+    def __init__(self, files=None, broken=False):
+        self.files = files or {}
+        self.reads = []
+        self.broken = broken
+        self.on_write = None
+
+    def remote_file(self, path, mode='r'):
+        return FakeRemoteFile(self, path, mode)
+
+
+class TestCopyRemoteFiles(StarClusterTest):
+
+    def _nodes(self, broken=[]):
+        master = StubNode('master', FakeSSH({'/a': 'A', '/b': 'B'}))
+        nodes = [StubNode(alias, FakeSSH(broken=alias in broken))
+                 for alias in ['node001', 'node002', 'node003']]
+        return master, nodes
+
+    def test_broadcast(self):
+        master, nodes = self._nodes()
+        pool = threadpool.get_thread_pool(size=3, disable_threads=False)
+        master.copy_remote_files_to_nodes(['/a', ('/b', '/c')],
+                                          nodes + [master], pool=pool)
+        # each file is read from the source only once
+        assert master.ssh.reads == ['/a', '/b']
+        for n in nodes:
+            assert n.ssh.files == {'/a': ('A', (1000, 1001), 0o600),
+                                   '/c': ('B', (1000, 1001), 0o600)}
+        assert master.ssh.files['/c'] == ('B', (1000, 1001), 0o600)
+        assert master.ssh.files['/a'] == 'A'
+
+    def test_width(self):
+        master, nodes = self._nodes()
+        lock = threading.Lock()
+        state = dict(current=0, peak=0)
+
+        def on_write():
+            with lock:
+                state['current'] += 1
+                state['peak'] = max(state['peak'], state['current'])
+            time.sleep(0.05)
+            with lock:
+                state['current'] -= 1
+        for n in nodes:
+            n.ssh.on_write = on_write
+        pool = threadpool.get_thread_pool(size=3, disable_threads=False)
+        master.copy_remote_files_to_nodes(['/a'], nodes, pool=pool, width=1)
+        assert state['peak'] == 1
+
+    def test_failures_reported(self):
+        master, nodes = self._nodes(broken=['node002'])
+        try:
+            master.copy_remote_files_to_nodes(['/a'], nodes)
+        except exception.ThreadPoolException as e:
+            assert [jobid for exc, tb, jobid in e.exceptions] == ['node002']
+        else:
+            raise AssertionError("ThreadPoolException not raised")
+        assert '/a' in nodes[0].ssh.files and '/a' in nodes[2].ssh.files
+
+
+class FakeResult(object):
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+
+class FakeBatch(object):
+    def __init__(self, ssh):
+        self.ssh = ssh
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, command, ignore_exit_status=False):
+        self.ssh.commands.append(command)
+        return FakeResult(self.ssh.responses.get(command, []))
+
+    def edit(self, editor, ignore_exit_status=False, log_output=True):
+        command = editor.get_command()
+        if command is not None:
+            return self.execute(command, ignore_exit_status)
+
+
+class LocalShell(object):
+    def __init__(self):
+        self.commands = []
+        self.responses = {}
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def execute(self, command, log_output=True):
+        self.commands.append(command)
+        out = subprocess.check_output(['bash', '-c', command])
+        return out.decode('utf-8').splitlines()
+
+
+class TestNodeFacts(StarClusterTest):
+
+    def test_facts_gathered_once(self):
+        n = StubNode(ssh=LocalShell())
+        assert n.num_processors > 0
+        assert n.memory > 0
+        assert n.getpwnam('root').pw_uid == 0
+        assert n.getgrgid(0).gr_name == n.get_group_map(key_by_gid=True)[0][0]
+        assert '/' in [m[0] for m in n.get_mount_map().values()]
+        assert n.facts['arch']
+        assert len(n.ssh.commands) == 1
+        n.invalidate_facts()
+        assert n.getpwnam('root').pw_dir
+        assert len(n.ssh.commands) == 2
+
+    def test_parse_partition_map(self):
+        fdiskout = """
+Disk /dev/xvdf: 10.7 GB, 10737418240 bytes
+    Device Boot      Start         End      Blocks   Id  System
+/dev/xvdf1   *        2048    20971519    10484736   83  Linux
+/dev/xvdg1            2048    20971519    10484736+  83  Linux
+"""
+        n = StubNode(ssh=LocalShell())
+        n._facts = dict(partitions=n._parse_partition_map(fdiskout))
+        assert n.facts['partitions'] == {
+            '/dev/xvdf1': [2048, 20971519, 10484736, '83'],
+            '/dev/xvdg1': [2048, 20971519, 10484736, '83']}
+        partmap = n.get_partition_map('/dev/xvdf')
+        assert list(partmap) == ['/dev/xvdf1']
+
+    def test_partition_map_exact_device(self):
+        n = StubNode(ssh=LocalShell())
+        parts = ['/dev/sda1', '/dev/sdaa1', '/dev/xvdf1', '/dev/xvdf10',
+                 '/dev/xvdfa2', '/dev/nvme0n1p1', '/dev/nvme0n10p1']
+        n._facts = dict(partitions=dict([(p, []) for p in parts]))
+        assert list(n.get_partition_map('/dev/sda')) == ['/dev/sda1']
+        assert sorted(n.get_partition_map('/dev/xvdf')) == ['/dev/xvdf1',
+                                                            '/dev/xvdf10']
+        assert list(n.get_partition_map('/dev/nvme0n1')) == ['/dev/nvme0n1p1']
+
+    def test_facts_without_python(self):
+        n = StubNode(ssh=LocalShell())
+        output = n.ssh.execute(node.FACTS_SHELL_SCRIPT)
+        raw = n._parse_facts(output)
+        assert int(raw['cpus']) > 0 and int(raw['memory']) > 0
+        assert 'root:x:0:0:' in raw['passwd']
+        try:
+            n._parse_facts(['sh: 1: : Permission denied'])
+        except exception.BaseException as e:
+            assert 'unable to gather facts' in e.msg
+        else:
+            raise AssertionError("BaseException not raised")
+
+    def test_accounts_kept_current(self):
+        n = StubNode(ssh=LocalShell())
+        n._facts = dict(accounts=node.PasswdIndex(
+            users=n._parse_passwd(['root:x:0:0:root:/root:/bin/bash',
+                                   'old:x:1000:1000::/home/old:/bin/sh']),
+            groups=n._parse_group(['root:x:0:', 'old:x:1000:'])))
+        n.ssh.responses = {
+            'getent passwd sgeadmin': [
+                'sgeadmin:x:1000:1000::/home/sgeadmin:/bin/bash'],
+            'getent group sgeadmin': ['sgeadmin:x:1000:']}
+        n.remove_user('old')
+        assert n.getpwuid(1000) is None and n.getgrnam('old') is None
+        n.add_user('sgeadmin', 1000, 1000)
+        assert n.getpwuid(1000).pw_name == 'sgeadmin'
+        assert n.getgrgid(1000).gr_name == 'sgeadmin'
+        assert n.getpwnam('root').pw_dir == '/root'
+        # no reads of /etc/passwd or /etc/group
+        assert not [c for c in n.ssh.commands if 'EOF' in c]
+
+
+class TestPasswdIndex(StarClusterTest):
+
+    def test_shared_ids(self):
+        pw = utils.struct_passwd
+        index = node.PasswdIndex(users=[
+            pw(['a', 'x', 1000, 1000, '', '/home/a', '/bin/sh']),
+            pw(['b', 'x', 1000, 1000, '', '/home/b', '/bin/sh'])])
+        assert index.getpwuid(1000).pw_name == 'b'
+        index.remove_user('b')
+        assert index.getpwuid(1000).pw_name == 'a'
+        index.remove_user('a')
+        assert index.getpwuid(1000) is None and not index.users
+
+    def test_add_group_member(self):
+        index = node.PasswdIndex(groups=[utils.struct_group(
+            ['utmp', 'x', 43, ['']])])
+        index.add_group_member('utmp', 'sgeadmin')
+        index.add_group_member('utmp', 'sgeadmin')
+        assert index.getgrgid(43).gr_mem == ['sgeadmin']
+
+
+class FakeHostKey(object):
+    def __init__(self, name, padding=''):
+        self.name = name
+        self.padding = padding
+
+    def get_name(self):
+        return 'ssh-rsa'
+
+    def get_base64(self):
+        return 'KEY' + self.name + self.padding
+
+
+class FakeKeySSH(object):
+    def __init__(self, node):
+        self.node = node
+        self.fetches = 0
+
+    def get_server_public_key(self):
+        self.fetches += 1
+        return FakeHostKey(self.node.alias)
+
+
+class LocalNoProfileClient(LocalShellClient):
+    def _get_profile_setup(self):
+        return 'true'
+
+
+class TestKnownHosts(StarClusterTest):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        users = []
+        for name in ['root', 'sgeadmin', 'user001']:
+            home = os.path.join(self.tmp, name)
+            os.makedirs(os.path.join(home, '.ssh'))
+            users.append(utils.struct_passwd([name, 'x', os.getuid(),
+                                              os.getgid(), '', home, '']))
+        self.master = StubNode('master', LocalNoProfileClient())
+        self.master._host_key = FakeHostKey('master')
+        self.master._facts = dict(accounts=node.PasswdIndex(users=users))
+        self.nodes = [StubNode('node%.3d' % i) for i in range(1, 4)]
+        for n in self.nodes:
+            n._ssh = FakeKeySSH(n)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _read(self, user):
+        path = os.path.join(self.tmp, user, '.ssh', 'known_hosts')
+        with open(path) as f:
+            return f.read().splitlines()
+
+    def test_many_users_one_command(self):
+        users = ['root', 'sgeadmin', 'user001']
+        pool = threadpool.get_thread_pool(size=3, disable_threads=False)
+        self.master.add_to_known_hosts(users, self.nodes, pool=pool)
+        self.master.add_to_known_hosts(users, self.nodes[:1])
+        assert len(self.master.ssh.scripts) == 2
+        # host keys are only fetched once
+        assert [n.ssh.fetches for n in self.nodes] == [1, 1, 1]
+        for user in users:
+            lines = self._read(user)
+            # alias, private and public names for 4 hosts
+            assert len(lines) == 12
+            assert len([l for l in lines if 'node001' in l]) == 3
+            assert 'master,10.0.0.1 ssh-rsa KEYmaster' in lines
+        self.master.remove_from_known_hosts(['root', 'user001'],
+                                            self.nodes[1:])
+        assert len(self._read('root')) == 6
+        assert len(self._read('sgeadmin')) == 12
+        assert not [f for f in os.listdir('/tmp')
+                    if f.startswith('.starcluster-known_hosts')]
+
+    def test_large_cluster(self):
+        users = ['root', 'sgeadmin', 'user001']
+        nodes = [StubNode('node%.3d' % i) for i in range(1, 201)]
+        for n in nodes:
+            # about the size of a 2048 bit RSA host key
+            n._host_key = FakeHostKey(n.alias, 'A' * 370)
+        self.master.add_to_known_hosts(users, nodes)
+        # the entries aren't part of the remote command
+        assert len(self.master.ssh.scripts[-1]) < 16 * 1024
+        for user in users:
+            lines = self._read(user)
+            assert len(lines) == 201 * 3
+            assert ('node200,10.0.0.1 ssh-rsa KEYnode200' + 'A' * 370 in
+                    lines)
+        assert not [f for f in os.listdir('/tmp')
+                    if f.startswith('.starcluster-known_hosts')]
+
+
+class LocalHostsClient(LocalNoProfileClient):
+    def __init__(self, path):
+        LocalNoProfileClient.__init__(self)
+        self.path = path
+
+    def edit_file(self, path):
+        assert path == '/etc/hosts'
+        return sshutils.RemoteFileEditor(self, self.path)
+
+    def execute(self, command, log_output=True):
+        with self.batch() as batch:
+            result = batch.execute(command)
+        return result.stdout
+
+
+class TestEtcHosts(StarClusterTest):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'hosts')
+        with open(self.path, 'w') as f:
+            f.write('127.0.0.1 localhost\n10.0.0.1 node001\n'
+                    '10.0.0.10 node0010\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_managed_block(self):
+        nodes = [StubNode('node%.3d' % i,
+                          private_ip_address='10.0.1.%d' % i)
+                 for i in [2, 1]]
+        master = StubNode('master', LocalHostsClient(self.path),
+                          private_ip_address='10.0.1.0')
+        master.set_etc_hosts(node.render_etc_hosts(nodes + [master]))
+        # the stale node001 entry is replaced, node0010 is left alone
+        assert self._read() == (
+            '127.0.0.1 localhost\n10.0.0.10 node0010\n'
+            '%s\n10.0.1.0 master\n10.0.1.1 node001\n10.0.1.2 node002\n'
+            '%s\n' % (static.ETC_HOSTS_BEGIN, static.ETC_HOSTS_END))
+        new = StubNode('node003', private_ip_address='10.0.1.3')
+        master.add_to_etc_hosts([new])
+        # only the new entry was sent
+        assert '10.0.1.2' not in master.ssh.scripts[-1]
+        master.remove_from_etc_hosts([nodes[1]])
+        assert self._read() == (
+            '127.0.0.1 localhost\n10.0.0.10 node0010\n'
+            '%s\n10.0.1.0 master\n10.0.1.2 node002\n10.0.1.3 node003\n'
+            '%s\n' % (static.ETC_HOSTS_BEGIN, static.ETC_HOSTS_END))
+
+
+class RecordingBatch(FakeBatch):
+    def execute(self, command, ignore_exit_status=False):
+        if command.startswith('('):
+            # apply file edits locally
+            subprocess.check_call(['bash', '-c', command])
+        return FakeBatch.execute(self, command, ignore_exit_status)
+
+
+class FakeExportsSSH(object):
+    def __init__(self, path):
+        self.path = path
+        self.commands = []
+        self.responses = {}
+
+    def edit_file(self, path):
+        assert path == '/etc/exports'
+        return sshutils.RemoteFileEditor(self, self.path)
+
+    def batch(self):
+        return RecordingBatch(self)
+
+
+class FakeSubnet(object):
+    def __init__(self, id, cidr_block):
+        self.id = id
+        self.cidr_block = cidr_block
+
+
+class FakeSubnetEC2(object):
+    def __init__(self, cidrs):
+        self.cidrs = cidrs
+        self.calls = []
+
+    def get_subnets(self, filters=None):
+        self.calls.append(filters['subnet_id'])
+        return [FakeSubnet(id, self.cidrs[id]) for id in filters['subnet_id']]
+
+
+class TestNFSExports(StarClusterTest):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'exports')
+        open(self.path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _read(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def _node(self, alias, subnet_id=None, ssh=None):
+        n = StubNode(alias, ssh, subnet_id=subnet_id)
+        n.EXPORTFS_INCREMENTAL_MAX = 2
+        return n
+
+    def test_exports_by_host(self):
+        master = self._node('master', ssh=FakeExportsSSH(self.path))
+        # VPC nodes are exported to one by one unless by_subnet is passed
+        nodes = [self._node('node%.3d' % i, 'subnet-1') for i in [1, 10, 2]]
+        master.export_fs_to_nodes(nodes, ['/home', '/opt/sge6'])
+        assert len(self._read()) == 6
+        # too many changes for exportfs -o, reload everything
+        assert master.ssh.commands[-1] == 'exportfs -ra'
+        master.ssh.commands = []
+        master.stop_exporting_fs_to_nodes(nodes[:1])
+        assert [l.split()[1].split('(')[0] for l in self._read()] == [
+            'node010', 'node010', 'node002', 'node002']
+        assert 'exportfs -u' in master.ssh.commands[0]
+        assert 'exportfs -ra' not in master.ssh.commands
+
+    def test_exports_by_subnet(self):
+        master = self._node('master', 'subnet-1', FakeExportsSSH(self.path))
+        master.ec2 = FakeSubnetEC2({'subnet-1': '10.0.0.0/24',
+                                    'subnet-2': '10.0.1.0/24'})
+        nodes = [self._node('node%.3d' % i, 'subnet-%d' % (i % 2 + 1))
+                 for i in range(1, 501)]
+        master.export_fs_to_nodes(nodes, ['/home'], by_subnet=True)
+        # both subnets were looked up with a single call
+        assert master.ec2.calls == [['subnet-1', 'subnet-2']]
+        master.export_fs_to_nodes(nodes[:1], ['/home'], by_subnet=True)
+        assert len(master.ec2.calls) == 1
+        opts = node.Node.NFS_EXPORT_OPTIONS
+        assert self._read() == ['/home 10.0.0.0/24(%s)' % opts,
+                                '/home 10.0.1.0/24(%s)' % opts]
+        assert master.ssh.commands[-1] == (
+            'exportfs -o %s 10.0.1.0/24:/home' % opts)
+
+
+class TestExecuteAll(StarClusterTest):
+
+    def test_empty_node_list(self):
+        setup = clustersetup.DefaultClusterSetup(disable_threads=True)
+        master = StubNode('master', ssh=LocalShellClient())
+        setup._nodes = [master]
+        # e.g. the data nodes of a single-node cluster
+        assert setup._execute_all('true', nodes=[]) == {}
+        assert master.ssh.scripts == []
+        assert list(setup._execute_all('true')) == ['master']
+        assert len(master.ssh.scripts) == 1
+        assert Cluster().execute_all('true', nodes=[]) == {}
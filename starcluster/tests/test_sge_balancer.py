@@ -15,13 +15,23 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import shutil
 import iso8601
 import datetime
+import tempfile
 
 from starcluster import utils
 from starcluster.balancers import sge
+from starcluster.balancers.sge import jobstats
 from starcluster.tests import StarClusterTest
 from starcluster.tests.templates import sge_balancer
+from starcluster.tests.fakes import LocalSSH
+
+
+def accounting_record(job_id, queued, start, end):
+    return ('all.q:node001:root:root:sleep:%d:sge:0:%d:%d:%d:0:0:60:0.0:0.0'
+            '\n' % (job_id, queued, start, end)).encode('utf-8')
 
 
 class TestSGELoadBalancer(StarClusterTest):
@@ -76,6 +86,190 @@ class TestSGELoadBalancer(StarClusterTest):
         stat.parse_qhost(sge_balancer.loaded_qhost_xml)
         assert stat.slots_per_host() == 8
 
+    def test_large_qstat_parser(self):
+        head, pending = sge_balancer.qstat_xml.split('<job_info>\n')
+        job = pending.split('</job_list>')[0] + '</job_list>\n'
+        xml = head + '<job_info>\n' + job * 5000 + '</job_info>\n</job_info>'
+        stat = sge.SGEStats()
+        stat_hash = stat.parse_qstat(xml)
+        assert len(stat_hash) == 5003
+        assert len(stat.get_queued_jobs()) == 5000
+        assert len(stat.get_running_jobs()) == 3
+        assert len(stat.queues) == 3
+
+    def test_parsers_discard_elements(self):
+        stat = sge.SGEStats()
+        roots = []
+        iterparse = stat._iterparse
+
+        def _iterparse(xml_out, events=('end',)):
+            for event, elem in iterparse(xml_out, events):
+                if not roots:
+                    # the first event is the start of the root element
+                    roots.append(elem)
+                yield event, elem
+        stat._iterparse = _iterparse
+        assert len(stat.parse_qstat(sge_balancer.loaded_qstat_xml)) == 192
+        root = roots[0]
+        assert root.tag == 'job_info'
+        assert not list(root.iter('job_list'))
+        assert not list(root.iter('Queue-List'))
+        del roots[:]
+        assert len(stat.parse_qhost(sge_balancer.loaded_qhost_xml)) == 10
+        assert not list(roots[0].iter('host'))
+
+    def test_task_array_qstat_parser(self):
+        xml = sge_balancer.qstat_xml.replace(
+            '<JB_job_number>4</JB_job_number>',
+            '<JB_job_number>4</JB_job_number><tasks>1-100000:1</tasks>')
+        xml = xml.replace(
+            '<JB_job_number>5</JB_job_number>',
+            '<JB_job_number>5</JB_job_number><tasks>1-10:2,15</tasks>')
+        stat = sge.SGEStats()
+        stat_hash = stat.parse_qstat(xml)
+        # array jobs are stored once
+        assert len(stat_hash) == 23
+        assert len(stat.get_queued_jobs()) == 20
+        job4 = [j for j in stat.jobs if j['JB_job_number'] == '4'][0]
+        assert job4['num_tasks'] == 100000
+        assert job4['task_ranges'] == [(1, 100000, 1)]
+        job5 = [j for j in stat.jobs if j['JB_job_number'] == '5'][0]
+        assert job5['num_tasks'] == 6
+        assert job5['task_ranges'] == [(1, 10, 2), (15, 15, 1)]
+        assert stat.count_queued_jobs() == 18 + 100000 + 6
+        assert stat.count_running_jobs() == 3
+        assert stat.count_slots(stat.get_queued_jobs()) == 18 + 100000 + 6
+
     def test_node_working(self):
-        # TODO : FINISH THIS
-        pass
+        class FakeNode(object):
+            def __init__(self, alias):
+                self.alias = self.id = alias
+        xml = sge_balancer.qstat_xml.replace('ip-10-196-142-180', 'node0010')
+        stat = sge.SGEStats()
+        stat.parse_qstat(xml)
+        assert stat.is_node_working(FakeNode('node0010'))
+        assert not stat.is_node_working(FakeNode('node001'))
+        assert stat.is_node_working(FakeNode('ip-10-196-214-162'))
+        assert stat.slots_by_queue['all.q@node0010.ec2.internal'] == 1
+        assert stat.count_used_slots() == 3
+        assert stat.count_queued_slots() == 20
+        assert stat.num_slots_for_job(4) == 1
+        assert stat.num_slots_for_job(1000) is None
+
+    def test_accounting_parser(self):
+        stat = sge.SGEStats()
+        records = b''.join([
+            b'# Version: 6.2u5\n',
+            accounting_record(1, 1000, 1010, 1070),
+            # never started
+            accounting_record(2, 1000, 0, 1100),
+            # times in milliseconds
+            accounting_record(3, 1500000000000, 1500000010000,
+                              1500000040000),
+        ])
+        stat.parse_accounting(records.decode('utf-8'))
+        assert stat.max_job_id == 3
+        # job 2 never started
+        assert len(stat.jobstats) == 2
+        assert stat.avg_job_duration() == 45
+        assert stat.avg_wait_time() == 10
+        stat = sge.SGEStats()
+        since = datetime.datetime(2000, 1, 1, tzinfo=iso8601.iso8601.UTC)
+        stat.parse_accounting(records.decode('utf-8'), since=since)
+        assert len(stat.jobstats) == 1
+        assert stat.avg_job_duration() == 30
+
+    def test_read_accounting(self):
+        class FakeMaster(object):
+            ssh = LocalSSH()
+        tmp = tempfile.mkdtemp()
+        try:
+            acct = os.path.join(tmp, 'accounting')
+            lb = sge.SGELoadBalancer()
+            lb.accounting_file = acct
+            master = FakeMaster()
+            assert lb._read_accounting(master) == ('', True)
+            first = accounting_record(1, 1000, 1010, 1070)
+            second = accounting_record(2, 1000, 1010, 1070)
+            with open(acct, 'wb') as f:
+                f.write(first + second[:10])
+            data, seeded = lb._read_accounting(master)
+            assert seeded
+            assert data.encode('utf-8') == first
+            assert lb._accounting_offset == len(first)
+            # only the rest of the partial record and new ones are read
+            third = accounting_record(3, 1000, 1010, 1070)
+            with open(acct, 'ab') as f:
+                f.write(second[10:] + third)
+            data, seeded = lb._read_accounting(master)
+            assert not seeded
+            assert data.encode('utf-8') == second + third
+            assert lb._read_accounting(master) == ('', False)
+            # a rotated file is read again from the seed
+            os.rename(acct, acct + '.1')
+            with open(acct, 'wb') as f:
+                f.write(first + second + third)
+            lb.accounting_seed_bytes = len(third) + 5
+            data, seeded = lb._read_accounting(master)
+            assert seeded
+            assert data.encode('utf-8') == third
+            assert lb._accounting_offset == len(first + second + third)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_jobstats_capacity(self):
+        class FakeCluster(object):
+            class master_node(object):
+                ssh = LocalSSH()
+        lb = sge.SGELoadBalancer(jobstats_capacity=1000)
+        lb._cluster = FakeCluster()
+        assert lb.stat.jobstats.capacity == 1000
+        assert sge.SGELoadBalancer().jobstats_capacity == 200
+
+
+class TestJobStats(StarClusterTest):
+
+    def _check_stats(self):
+        stats = jobstats.JobStats(capacity=4)
+        assert len(stats) == 0
+        assert jobstats.mean(stats.wait_times()) == 0
+        assert jobstats.percentile(stats.wait_times(), 90) == 0
+        for i in range(6):
+            # job i waits i * 10 seconds and runs for 100 seconds
+            stats.append(1000 * i, 1000 * i + 10 * i, 1000 * i + 10 * i + 100)
+        # only the last 4 jobs are kept
+        assert len(stats) == 4
+        assert list(stats.wait_times()) == [20, 30, 40, 50]
+        assert list(stats.durations()) == [100] * 4
+        assert jobstats.mean(stats.wait_times()) == 35
+        assert jobstats.percentile(stats.wait_times(), 50) == 35
+        assert abs(jobstats.percentile(stats.wait_times(), 90) - 47) < 1e-9
+        assert jobstats.percentile(stats.wait_times(), 100) == 50
+        assert jobstats.ewma([20, 30], alpha=0.5) == (10 + 30) / 1.5
+        # the most recent jobs weigh the most
+        assert 35 < jobstats.ewma(stats.wait_times(), alpha=0.5) < 50
+        stats.clear()
+        assert len(stats) == 0
+
+    def test_stats(self):
+        self._check_stats()
+
+    def test_stats_without_numpy(self):
+        has_numpy = jobstats.HAS_NUMPY
+        jobstats.HAS_NUMPY = False
+        try:
+            self._check_stats()
+        finally:
+            jobstats.HAS_NUMPY = has_numpy
+
+    def test_large_capacity(self):
+        if not jobstats.HAS_NUMPY:
+            return
+        stats = jobstats.JobStats(capacity=10 ** 6)
+        for i in range(10 ** 6 + 10):
+            stats.append(i, i + i % 100, i + 200)
+        assert len(stats) == 10 ** 6
+        waits = stats.wait_times()
+        assert len(waits) == 10 ** 6
+        assert jobstats.mean(waits) == 49.5
+        assert abs(jobstats.percentile(waits, 90) - 89.1) < 1e-6
@@ -0,0 +1,437 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from starcluster import sshutils
+from starcluster import exception
+from starcluster.tests import StarClusterTest
+from starcluster.tests.fakes import FakeChannel, LocalShellClient
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+        self.closed = False
+        self.keepalive = None
+        self.probes = 0
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        self.probes += 1
+        if not self.active:
+            raise EOFError()
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+    def close(self):
+        self.active = False
+        self.closed = True
+
+
+class FakeClient(object):
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.commands = []
+
+    def exec_channel(self, command, source_profile=True):
+        self.commands.append(command)
+        return FakeChannel(**self.kwargs)
+
+
+class TestSSHConnectionPool(StarClusterTest):
+
+    key = ('node001', 22, 'root', None, False)
+
+    def _connect(self):
+        self.connects += 1
+        return FakeTransport()
+
+    def setUp(self):
+        self.connects = 0
+
+    def test_reuse(self):
+        pool = sshutils.SSHConnectionPool()
+        t1 = pool.acquire(self.key, self._connect)
+        t2 = pool.acquire(self.key, self._connect)
+        assert t1 is t2
+        assert self.connects == 1
+        assert t1.keepalive == pool.keepalive_interval
+        other = pool.acquire(('node002', 22, 'root', None, False),
+                             self._connect)
+        assert other is not t1
+        assert self.connects == 2
+        assert len(pool) == 2
+
+    def test_dead_transport_replaced(self):
+        pool = sshutils.SSHConnectionPool()
+        t1 = pool.acquire(self.key, self._connect)
+        t1.active = False
+        t2 = pool.acquire(self.key, self._connect)
+        assert t2 is not t1
+        assert t1.closed
+        assert self.connects == 2
+        # releasing the stale transport must not affect the pooled one
+        pool.release(self.key, t1)
+        assert not t2.closed
+
+    def test_keepalive_probe(self):
+        pool = sshutils.SSHConnectionPool(keepalive_interval=0)
+        t1 = pool.acquire(self.key, self._connect)
+        pool.release(self.key, t1)
+        t2 = pool.acquire(self.key, self._connect)
+        assert t1 is t2
+        assert t1.probes == 1
+
+    def test_idle_eviction(self):
+        pool = sshutils.SSHConnectionPool(idle_timeout=0)
+        t1 = pool.acquire(self.key, self._connect)
+        pool.evict_idle()
+        assert not t1.closed
+        pool.release(self.key, t1)
+        time.sleep(0.01)
+        pool.evict_idle()
+        assert t1.closed
+        assert len(pool) == 0
+
+    def test_close_all(self):
+        pool = sshutils.SSHConnectionPool()
+        t1 = pool.acquire(self.key, self._connect)
+        pool.close_all()
+        assert t1.closed
+        assert len(pool) == 0
+
+    def test_handshake_limit(self):
+        pool = sshutils.SSHConnectionPool(max_handshakes=2)
+        lock = threading.Lock()
+        state = dict(current=0, peak=0)
+
+        def slow_connect():
+            with lock:
+                state['current'] += 1
+                state['peak'] = max(state['peak'], state['current'])
+            time.sleep(0.05)
+            with lock:
+                state['current'] -= 1
+            return FakeTransport()
+
+        threads = []
+        for i in range(6):
+            key = ('node%.3d' % i, 22, 'root', None, False)
+            t = threading.Thread(target=pool.acquire, args=(key, slow_connect))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        assert len(pool) == 6
+        assert state['peak'] <= 2
+
+
+class TestExecuteParallel(StarClusterTest):
+
+    def test_collect_output(self):
+        clients = [('node%.3d' % i, FakeClient(stdout=b'a\nb\n'))
+                   for i in range(5)]
+        results = sshutils.execute_parallel(clients, 'true',
+                                            max_concurrency=2)
+        assert list(results.keys()) == [label for label, c in clients]
+        for label, client in clients:
+            assert client.commands == ['true']
+            assert results[label].stdout == ['a', 'b']
+            assert results[label].exit_status == 0
+
+    def test_collect_all_failures(self):
+        clients = [('master', FakeClient()),
+                   ('node001', FakeClient(stderr=b'oops', status=2)),
+                   ('node002', FakeClient(status=1))]
+        try:
+            sshutils.execute_parallel(clients, 'false')
+        except exception.RemoteCommandsFailed as e:
+            assert 'node001' in e.msg and 'node002' in e.msg
+            assert e.results['node001'].stderr == ['oops']
+        else:
+            raise AssertionError("RemoteCommandsFailed not raised")
+        assert all(c.commands for label, c in clients)
+        results = sshutils.execute_parallel(clients, 'false',
+                                            ignore_exit_status=True)
+        assert [r.failed for r in results.values()] == [False, True, True]
+
+    def test_fail_fast(self):
+        clients = [('master', FakeClient(status=1)),
+                   ('node001', FakeClient())]
+        try:
+            sshutils.execute_parallel(clients, 'false', max_concurrency=1,
+                                      fail_fast=True)
+        except exception.RemoteCommandsFailed as e:
+            assert e.results['node001'].exit_status is None
+        else:
+            raise AssertionError("RemoteCommandsFailed not raised")
+        assert clients[1][1].commands == []
+
+
+class TestCommandBatch(StarClusterTest):
+
+    def test_batch(self):
+        ssh = LocalShellClient()
+        with ssh.batch(source_profile=False) as batch:
+            r1 = batch.execute('echo one; echo two')
+            r2 = batch.execute('echo err >&2; false', ignore_exit_status=True)
+            r3 = batch.execute('printf "no newline"')
+            r4 = batch.execute('cd /; exit 3', ignore_exit_status=True)
+            r5 = batch.execute('pwd')
+        assert len(ssh.scripts) == 1
+        assert (r1.stdout, r1.stderr, r1.exit_status) == (['one', 'two'],
+                                                          [], 0)
+        assert (r2.stdout, r2.stderr, r2.exit_status) == ([], ['err'], 1)
+        assert (r3.stdout, r3.exit_status) == (['no newline'], 0)
+        assert r4.exit_status == 3
+        # each command runs in its own subshell
+        assert r5.stdout != ['/'] and r5.exit_status == 0
+
+    def test_batch_stops_on_failure(self):
+        ssh = LocalShellClient()
+        batch = ssh.batch(source_profile=False)
+        r1 = batch.execute('echo failing; exit 2')
+        r2 = batch.execute('echo never')
+        try:
+            batch.run()
+        except exception.RemoteCommandFailed as e:
+            assert e.exit_status == 2
+            assert e.output == 'failing'
+        else:
+            raise AssertionError("RemoteCommandFailed not raised")
+        assert r1.exit_status == 2
+        assert r2.exit_status is None and r2.stdout == []
+
+    def test_batch_syntax_error(self):
+        ssh = LocalShellClient()
+        batch = ssh.batch(source_profile=False)
+        batch.execute('echo ok')
+        batch.execute('if then')
+        self.assertRaises(exception.RemoteCommandFailed, batch.run)
+
+
+class TestProfileEnvCache(StarClusterTest):
+
+    def _env(self, command):
+        proc = subprocess.Popen(['bash', '-c', command],
+                                stdout=subprocess.PIPE)
+        out = proc.communicate()[0].decode('utf-8')
+        env = dict([l.split('=', 1) for l in out.split('\0') if '=' in l])
+        for name in sshutils.SSHClient._PROFILE_ENV_IGNORE:
+            env.pop(name, None)
+        return env
+
+    def test_cached_env_matches_profile(self):
+        ssh = LocalShellClient()
+        command = ssh._get_command('env -0')
+        assert 'source /etc/profile' not in command
+        assert len(ssh.scripts) == 1
+        ssh._get_command('env -0')
+        assert len(ssh.scripts) == 1
+        expected = self._env('source /etc/profile >/dev/null 2>&1; env -0')
+        assert self._env(command) == expected
+        ssh.invalidate_profile_env()
+        ssh._get_command('true')
+        assert len(ssh.scripts) == 2
+
+    def test_disabled(self):
+        ssh = LocalShellClient()
+        ssh.cache_profile = False
+        assert ssh._get_command('true') == 'source /etc/profile && true'
+        assert ssh._get_command('true', source_profile=False) == 'true'
+        assert ssh.scripts == []
+
+
+class TestExecuteIter(StarClusterTest):
+
+    def test_lines(self):
+        ssh = LocalShellClient()
+        output = list(ssh.execute_iter(
+            'echo one; echo two >&2; printf "three"', source_profile=False))
+        assert sorted(output) == [('stderr', 'two'), ('stdout', 'one'),
+                                  ('stdout', 'three')]
+        assert ssh.get_last_status() == 0
+
+    def test_chunks_and_long_lines(self):
+        ssh = LocalShellClient()
+        cmd = 'head -c 100000 /dev/zero | tr "\\0" x'
+        chunks = list(ssh.execute_iter(cmd, lines=False, bufsize=4096,
+                                       source_profile=False))
+        assert all(len(data) <= 4096 for stream, data in chunks)
+        assert sum(len(data) for stream, data in chunks) == 100000
+        lines = list(ssh.execute_iter(cmd, bufsize=4096,
+                                      source_profile=False))
+        assert all(len(line) <= 8192 for stream, line in lines)
+        assert ''.join(line for stream, line in lines) == 'x' * 100000
+
+    def test_exit_status(self):
+        ssh = LocalShellClient()
+        it = ssh.execute_iter('echo out; exit 3', source_profile=False)
+        assert next(it) == ('stdout', 'out')
+        self.assertRaises(exception.RemoteCommandFailed, list, it)
+        assert ssh.get_last_status() == 3
+        output = list(ssh.execute_iter('exit 3', ignore_exit_status=True,
+                                       source_profile=False))
+        assert output == []
+        assert ssh.get_last_status() == 3
+
+
+class TestRemoteFileEditor(StarClusterTest):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'hosts')
+        with open(self.path, 'w') as f:
+            f.write('127.0.0.1 localhost\n10.0.0.1 node001\n'
+                    '10.0.0.2 node002\n10.0.0.10 node0010\n')
+        os.chmod(self.path, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _apply(self, editor):
+        ssh = LocalShellClient()
+        with ssh.batch(source_profile=False) as batch:
+            batch.edit(editor)
+        return ssh
+
+    def _read(self, path=None):
+        with open(path or self.path) as f:
+            return f.read()
+
+    def test_remove_and_append(self):
+        editor = sshutils.RemoteFileEditor(None, self.path)
+        editor.remove_lines(r'node001$')
+        editor.remove_lines('node002')
+        editor.append(['10.0.0.3 node003', 'it\'s "$HOME" \\n'])
+        editor.append('last')
+        inode = os.stat(self.path).st_ino
+        ssh = self._apply(editor)
+        assert len(ssh.scripts) == 1
+        assert self._read() == ('127.0.0.1 localhost\n10.0.0.10 node0010\n'
+                                '10.0.0.3 node003\nit\'s "$HOME" \\n\n'
+                                'last\n')
+        # the file was replaced atomically and kept its permissions
+        assert os.stat(self.path).st_ino != inode
+        assert os.stat(self.path).st_mode & 0o777 == 0o640
+        assert os.listdir(self.tmp) == ['hosts']
+
+    def test_large_edit(self):
+        ssh = LocalShellClient()
+        editor = sshutils.RemoteFileEditor(ssh, self.path)
+        nodes = ['node%.4d' % i for i in range(1, 5001)]
+        editor.remove_lines('|'.join(nodes + ['localhost']))
+        editor.append(['10.0.%d.%d %s %s' % (i // 256, i % 256, n, 'x' * 64)
+                       for i, n in enumerate(nodes)])
+        # building the command doesn't upload anything
+        editor.get_command()
+        assert not [f for f in os.listdir('/tmp')
+                    if f.startswith('.starcluster-edit-')]
+        with ssh.batch(source_profile=False) as batch:
+            batch.edit(editor)
+        # the lines and patterns were uploaded rather than sent as arguments
+        assert len(ssh.scripts[0]) < editor.INLINE_MAX
+        lines = self._read().splitlines()
+        assert len(lines) == 5002
+        assert lines[:3] == ['10.0.0.1 node001', '10.0.0.2 node002',
+                             '10.0.0.0 node0001 %s' % ('x' * 64)]
+        assert not [f for f in os.listdir('/tmp')
+                    if f.startswith('.starcluster-edit-')]
+
+    def test_large_edit_not_run(self):
+        ssh = LocalShellClient()
+        editor = sshutils.RemoteFileEditor(ssh, self.path)
+        editor.append(['x' * 64] * 1000)
+        try:
+            with ssh.batch(source_profile=False) as batch:
+                batch.execute('exit 1')
+                batch.edit(editor)
+            raise AssertionError("batch didn't fail")
+        except exception.RemoteCommandFailed:
+            pass
+        # the edit never ran but its staged lines were still removed
+        assert 'x' * 64 not in self._read()
+        assert not [f for f in os.listdir('/tmp')
+                    if f.startswith('.starcluster-edit-')]
+
+    def test_remove_all_lines(self):
+        editor = sshutils.RemoteFileEditor(None, self.path)
+        editor.remove_lines('.')
+        self._apply(editor)
+        assert self._read() == ''
+
+    def test_missing_file(self):
+        path = os.path.join(self.tmp, 'missing')
+        editor = sshutils.RemoteFileEditor(None, path)
+        editor.remove_lines('foo')
+        self._apply(editor)
+        assert not os.path.exists(path)
+        editor.append('foo')
+        editor.chmod(0o600)
+        self._apply(editor)
+        assert self._read(path) == 'foo\n'
+        assert os.stat(path).st_mode & 0o777 == 0o600
+
+    def test_symlink(self):
+        link = os.path.join(self.tmp, 'link')
+        os.symlink(self.path, link)
+        editor = sshutils.RemoteFileEditor(None, link)
+        editor.remove_lines('localhost')
+        self._apply(editor)
+        assert os.path.islink(link)
+        assert 'localhost' not in self._read()
+
+    def test_block(self):
+        begin, end = '# BEGIN TEST', '# END TEST'
+        editor = sshutils.RemoteFileEditor(None, self.path)
+        editor.use_block(begin, end)
+        editor.remove_lines('node002')
+        editor.append(['10.0.0.3 node003', '10.0.0.4 node004'])
+        self._apply(editor)
+        assert self._read() == ('127.0.0.1 localhost\n10.0.0.1 node001\n'
+                                '10.0.0.10 node0010\n# BEGIN TEST\n'
+                                '10.0.0.3 node003\n10.0.0.4 node004\n'
+                                '# END TEST\n')
+        # removals apply inside the block, appends go into the block
+        editor = sshutils.RemoteFileEditor(None, self.path)
+        editor.use_block(begin, end)
+        editor.remove_lines('node003')
+        editor.append('10.0.0.5 node005')
+        self._apply(editor)
+        assert self._read().endswith('# BEGIN TEST\n10.0.0.4 node004\n'
+                                     '10.0.0.5 node005\n# END TEST\n')
+        editor = sshutils.RemoteFileEditor(None, self.path)
+        editor.use_block(begin, end, replace=True)
+        editor.append('10.0.0.6 node006')
+        self._apply(editor)
+        assert self._read() == ('127.0.0.1 localhost\n10.0.0.1 node001\n'
+                                '10.0.0.10 node0010\n# BEGIN TEST\n'
+                                '10.0.0.6 node006\n# END TEST\n')
@@ -19,7 +19,9 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import time
 import logging
+import threading
 import tempfile
 logging.disable(logging.WARN)
 
@@ -141,3 +143,155 @@ class TestThreadPool(tests.StarClusterTest):
         except exception.ThreadPoolException as e:
             assert len(e.exceptions) == r
             assert self.pool._exception_queue.qsize() == 0
+
+    def test_wait_returns_promptly(self):
+        pool = self.pool
+        start = time.time()
+        for i in range(3):
+            pool.map(lambda x: x, range(self._jobs))
+        assert time.time() - start < 1
+
+    def test_submit(self):
+        pool = self.pool
+        futures = [pool.submit(self._args_and_kwargs, i,
+                               kwargs=dict(mykw=self._mykw), jobid=i)
+                   for i in range(self._jobs)]
+        for i, f in enumerate(futures):
+            assert f.result(timeout=5) == (i, dict(mykw=self._mykw))
+            assert f.done() and f.jobid == i
+            assert f.wait_time >= 0 and f.run_time >= 0
+        failed = pool.submit(lambda x: x ** 2, '2', jobid='bad')
+        assert isinstance(failed.exception(timeout=5), TypeError)
+        assert 'TypeError' in failed.traceback
+        assert pool._exception_queue.qsize() == 0
+        assert pool.wait() == []
+
+    def test_done_callback(self):
+        done = []
+        f = self.pool.submit(self._args_only, 1, jobid='cb')
+        f.add_done_callback(lambda fut: done.append(fut.jobid))
+        self.pool.wait()
+        f.add_done_callback(lambda fut: done.append(fut.result()))
+        assert done == ['cb', 1]
+
+    def test_map_ordered(self):
+        def slow_square(x):
+            time.sleep(0.01 * (10 - x))
+            return x ** 2
+        r = 10
+        ref = [x ** 2 for x in range(r)]
+        assert self.pool.map(slow_square, range(r)) == ref
+        calc = self.pool.map(slow_square, range(r),
+                             jobid_fn=lambda x: 'job%d' % x, keyed=True)
+        assert list(calc.keys()) == ['job%d' % x for x in range(r)]
+        assert list(calc.values()) == ref
+
+
+class TestTaskGraph(tests.StarClusterTest):
+
+    def setUp(self):
+        self.pool = threadpool.get_thread_pool(10, disable_threads=False)
+        self.pool.progress_bar.fd = tempfile.TemporaryFile()
+        self.events = []
+
+    def _task(self, name, delay=0):
+        self.events.append(('start', name))
+        time.sleep(delay)
+        self.events.append(('end', name))
+        return name
+
+    def _index(self, event, name):
+        return self.events.index((event, name))
+
+    def test_dependencies(self):
+        graph = threadpool.TaskGraph(self.pool)
+        graph.add_task('a', self._task, ('a', 0.05))
+        graph.add_task('b', self._task, ('b',), deps=['a'])
+        graph.add_task('c', self._task, ('c',))
+        graph.add_task('d', self._task, ('d',), deps=['b', 'c'])
+        graph.run()
+        assert self._index('end', 'a') < self._index('start', 'b')
+        assert self._index('end', 'b') < self._index('start', 'd')
+        assert self._index('end', 'c') < self._index('start', 'd')
+        # c doesn't depend on a so it shouldn't wait for it
+        assert self._index('end', 'c') < self._index('end', 'a')
+        assert graph.result('d') == 'd'
+        path = [name for name, f in graph.critical_path()]
+        assert path == ['a', 'b', 'd']
+
+    def test_groups(self):
+        graph = threadpool.TaskGraph(self.pool)
+        for i in range(4):
+            graph.add_task('t%d' % i, self._task, ('t%d' % i, 0.01),
+                           group='node001')
+        graph.run()
+        kinds = [kind for kind, name in self.events]
+        assert kinds == ['start', 'end'] * 4
+
+    def test_failure_skips_dependents(self):
+        graph = threadpool.TaskGraph(self.pool)
+        graph.add_task('bad', lambda: 1 / 0)
+        graph.add_task('child', self._task, ('child',), deps=['bad'])
+        graph.add_task('grandchild', self._task, ('grandchild',),
+                       deps=['child'])
+        graph.add_task('other', self._task, ('other',))
+        try:
+            graph.run()
+        except exception.ThreadPoolException as e:
+            assert [jobid for exc, tb, jobid in e.exceptions] == ['bad']
+        else:
+            raise AssertionError("ThreadPoolException not raised")
+        assert self.events == [('start', 'other'), ('end', 'other')]
+
+    def _run_failing(self, graph):
+        """Runs graph in another thread and returns the failed task names"""
+        errors = []
+
+        def run():
+            try:
+                graph.run()
+            except exception.ThreadPoolException as e:
+                errors.extend([jobid for exc, tb, jobid in e.exceptions])
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        assert not thread.is_alive(), "TaskGraph.run() hung"
+        return errors
+
+    def test_submit_failure(self):
+        submit = self.pool.submit
+
+        def _submit(method, args=[], kwargs={}, jobid=None):
+            if jobid == 'child':
+                raise RuntimeError("pool is shutting down")
+            return submit(method, args, kwargs, jobid=jobid)
+        self.pool.submit = _submit
+        graph = threadpool.TaskGraph(self.pool)
+        graph.add_task('parent', self._task, ('parent',))
+        graph.add_task('child', self._task, ('child',), deps=['parent'])
+        graph.add_task('grandchild', self._task, ('grandchild',),
+                       deps=['child'])
+        assert self._run_failing(graph) == ['child']
+        assert self.events == [('start', 'parent'), ('end', 'parent')]
+
+    def test_scheduling_error(self):
+        graph = threadpool.TaskGraph(self.pool)
+        graph.add_task('a', self._task, ('a',), group='node001')
+        graph.add_task('b', self._task, ('b',), deps=['a'])
+
+        def _release_group(name):
+            raise KeyError(name)
+        graph._release_group = _release_group
+        assert self._run_failing(graph) == ['a']
+        assert ('start', 'b') not in self.events
+
+    def test_invalid_graphs(self):
+        graph = threadpool.TaskGraph(self.pool)
+        graph.add_task('a', self._task, ('a',), deps=['b'])
+        graph.add_task('b', self._task, ('b',), deps=['a'])
+        self.assertRaises(ValueError, graph.run)
+        graph = threadpool.TaskGraph(self.pool)
+        graph.add_task('a', self._task, ('a',), deps=['missing'])
+        self.assertRaises(ValueError, graph.run)
+        self.assertRaises(ValueError, graph.add_task, 'a', self._task)
@@ -0,0 +1,239 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+
+from starcluster import transfer
+from starcluster.tests import StarClusterTest
+from starcluster import exception
+from starcluster.tests.fakes import LocalSSH, LocalChannel
+
+MB = transfer.MB
+
+
+class TestFileTransfer(StarClusterTest):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        os.makedirs(os.path.join(self.src, 'sub'))
+        self.files = {
+            'big': os.urandom(3 * MB + 12345),
+            'empty': b'',
+            os.path.join('sub', 'small'): b'small file\n',
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.src, name), 'wb') as f:
+                f.write(data)
+        os.chmod(os.path.join(self.src, 'big'), 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _check_copy(self, dest):
+        for name, data in self.files.items():
+            with open(os.path.join(dest, name), 'rb') as f:
+                assert f.read() == data
+        assert os.stat(os.path.join(dest, 'big')).st_mode & 0o777 == 0o640
+
+    def test_put_chunked(self):
+        ssh = LocalSSH()
+        xfer = transfer.FileTransfer(ssh, streams=3, chunk_size=MB,
+                                     progress=False)
+        files = xfer.put([self.src], self.tmp + '/dest')
+        self._check_copy(self.tmp + '/dest')
+        big = [f for f in files if f.src.endswith('big')][0]
+        assert len(big.chunks) == 4
+        assert ssh.peak_sessions <= 4
+
+    def test_get_into_dir(self):
+        ssh = LocalSSH()
+        os.makedirs(self.tmp + '/dest')
+        xfer = transfer.FileTransfer(ssh, streams=3, chunk_size=MB,
+                                     progress=False)
+        xfer.get([self.src], self.tmp + '/dest')
+        self._check_copy(self.tmp + '/dest/src')
+
+    def test_resume(self):
+        ssh = LocalSSH()
+        os.makedirs(self.tmp + '/dest')
+        xfer = transfer.FileTransfer(ssh, streams=2, chunk_size=MB,
+                                     resume=True, progress=False)
+        xfer.put([self.src], self.tmp + '/dest')
+        dest = self.tmp + '/dest/src'
+        # corrupt one chunk and append garbage
+        with open(os.path.join(dest, 'big'), 'r+b') as f:
+            f.seek(MB + 10)
+            f.write(b'garbage')
+            f.seek(0, os.SEEK_END)
+            f.write(b'trailing data')
+        xfer = transfer.FileTransfer(ssh, streams=2, chunk_size=MB,
+                                     resume=True, progress=False)
+        ncommands = len(ssh.commands)
+        files = xfer.put([self.src], self.tmp + '/dest')
+        self._check_copy(dest)
+        big = [x for x in files if x.src.endswith('big')][0]
+        # only the corrupted and the (extended) last chunk are sent again
+        assert big.chunks == [(MB, MB), (3 * MB, 12345)]
+        assert xfer._sent == MB + 12345
+        assert all(not x.chunks for x in files if x is not big)
+        # mkdir + one checksum command
+        assert len(ssh.commands) - ncommands == 2
+
+    def test_sync(self):
+        ssh = LocalSSH()
+        os.makedirs(self.tmp + '/dest')
+        dest = self.tmp + '/dest/src'
+        xfer = transfer.FileTransfer(ssh, chunk_size=MB, progress=False)
+        xfer.sync([self.src], self.tmp + '/dest')
+        self._check_copy(dest)
+        # nothing changed: only mkdir and the manifest command run
+        xfer = transfer.FileTransfer(ssh, chunk_size=MB, progress=False)
+        ncommands = len(ssh.commands)
+        files = xfer.sync([self.src], self.tmp + '/dest')
+        assert all(not f.chunks for f in files)
+        assert xfer._sent == 0
+        assert len(ssh.commands) - ncommands == 2
+        # change one block of the big file, add a file and remove another
+        big = os.path.join(self.src, 'big')
+        with open(big, 'r+b') as f:
+            f.seek(2 * MB)
+            f.write(b'changed')
+        with open(big, 'rb') as f:
+            self.files['big'] = f.read()
+        os.utime(big, (1000000000, 1000000000))
+        with open(os.path.join(self.src, 'new'), 'wb') as f:
+            f.write(b'new file')
+        self.files['new'] = b'new file'
+        os.unlink(os.path.join(self.src, 'sub', 'small'))
+        del self.files[os.path.join('sub', 'small')]
+        os.makedirs(os.path.join(dest, 'stale', 'dir'))
+        xfer = transfer.FileTransfer(ssh, chunk_size=MB, progress=False)
+        xfer.sync([self.src], self.tmp + '/dest', delete=True)
+        self._check_copy(dest)
+        assert xfer._sent == MB + len(b'new file')
+        assert os.stat(os.path.join(dest, 'big')).st_mtime == 1000000000
+        assert not os.path.exists(os.path.join(dest, 'sub', 'small'))
+        assert not os.path.exists(os.path.join(dest, 'stale'))
+        assert os.path.isdir(os.path.join(dest, 'sub'))
+
+    def test_tar_stream(self):
+        ssh = LocalSSH()
+        os.makedirs(self.tmp + '/dest')
+        for compression in [None, 'gzip', 'bzip2']:
+            xfer = transfer.FileTransfer(ssh, progress=False,
+                                         tar_compression=compression)
+            xfer.put_tar([self.src], self.tmp + '/dest')
+            self._check_copy(self.tmp + '/dest/src')
+            assert xfer._sent == sum(len(d) for d in self.files.values())
+            # copy back to a new local path, renaming the top-level dir
+            xfer.get_tar([self.tmp + '/dest/src'], self.tmp + '/back')
+            self._check_copy(self.tmp + '/back')
+            shutil.rmtree(self.tmp + '/dest/src')
+            shutil.rmtree(self.tmp + '/back')
+
+    def test_tar_compress(self):
+        # the tar stream doesn't use the compressed SFTP transport
+        xfer = transfer.FileTransfer(LocalSSH(), compress=True)
+        assert xfer.tar_compression == 'gzip'
+        xfer = transfer.FileTransfer(LocalSSH(), compress=True,
+                                     tar_compression='bzip2')
+        assert xfer.tar_compression == 'bzip2'
+        assert transfer.FileTransfer(LocalSSH()).tar_compression is None
+
+    def _get_archive(self, members):
+        """Runs get_tar on an archive containing (TarInfo, data) members"""
+        archive = os.path.join(self.tmp, 'evil.tar')
+        with tarfile.open(archive, 'w') as tar:
+            for info, data in members:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        ssh = LocalSSH()
+        ssh.exec_channel = lambda cmd, **kw: LocalChannel('cat ' + archive)
+        dest = os.path.join(self.tmp, 'dest')
+        os.makedirs(dest)
+        xfer = transfer.FileTransfer(ssh, progress=False)
+        xfer.get_tar([self.src], dest)
+        return dest
+
+    def _link(self, name, linkname, type=tarfile.SYMTYPE):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.linkname = linkname
+        return info, b''
+
+    def test_tar_links(self):
+        os.symlink('../empty', os.path.join(self.src, 'sub', 'link'))
+        os.link(os.path.join(self.src, 'big'),
+                os.path.join(self.src, 'hard'))
+        ssh = LocalSSH()
+        xfer = transfer.FileTransfer(ssh, progress=False)
+        xfer.get_tar([self.src], self.tmp + '/back')
+        self._check_copy(self.tmp + '/back')
+        link = os.path.join(self.tmp, 'back', 'sub', 'link')
+        assert os.readlink(link) == '../empty'
+        hard = os.stat(os.path.join(self.tmp, 'back', 'hard'))
+        assert hard.st_ino == os.stat(self.tmp + '/back/big').st_ino
+
+    def test_tar_unsafe_links(self):
+        outside = os.path.join(self.tmp, 'outside')
+        unsafe = [
+            [self._link('src/etc', '/etc')],
+            [self._link('src/up', '../..')],
+            [self._link('src/hard', '/etc/passwd', tarfile.LNKTYPE)],
+            [self._link('src/hard', '../outside', tarfile.LNKTYPE)],
+            # a safe looking link followed by a member written through it
+            [self._link('src/here', '.'),
+             self._link('src/here/up', '../../outside'),
+             (tarfile.TarInfo('src/here/up/x'), b'x')],
+            [self._link('src/sub/up', '..'),
+             self._link('src/sub/up/up', '..'),
+             self._link('src/sub/up/up/up', '..'),
+             (tarfile.TarInfo('src/sub/up/up/up/outside'), b'x')],
+        ]
+        for members in unsafe:
+            try:
+                self._get_archive(members)
+                raise AssertionError("unsafe archive extracted")
+            except exception.SCPException as e:
+                assert 'unsafe path' in str(e)
+            assert not os.path.exists(outside)
+            shutil.rmtree(os.path.join(self.tmp, 'dest'))
+
+    def test_tar_special_files(self):
+        fifo = tarfile.TarInfo('src/fifo')
+        fifo.type = tarfile.FIFOTYPE
+        dest = self._get_archive([(fifo, b''),
+                                  (tarfile.TarInfo('src/f'), b'data')])
+        assert not os.path.exists(os.path.join(dest, 'src', 'fifo'))
+        with open(os.path.join(dest, 'src', 'f'), 'rb') as f:
+            assert f.read() == b'data'
+
+    def test_count_local_files(self):
+        assert transfer.count_local_files([self.src]) == 3
+        assert transfer.count_local_files([self.src, self.src]) == 6
+        # counting stops as soon as the limit is exceeded
+        assert 3 < transfer.count_local_files([self.src] * 10, limit=3) < 30
@@ -20,6 +20,7 @@ ThreadPool module for StarCluster based on WorkerPool
 """
 import time
 import threading
+import collections
 import traceback
 import workerpool
 
@@ -50,6 +51,9 @@ class DaemonWorker(workerpool.workers.Worker):
             except workerpool.exceptions.TerminationNotice:
                 break
             except Exception as e:
+                if getattr(job, 'future', None) is not None:
+                    # submitted jobs report errors through their future
+                    continue
                 tb_msg = traceback.format_exc()
                 thread = threading.local()
                 jid = job.jobid or str(thread.ident)
@@ -62,16 +66,136 @@ def _worker_factory(parent):
     return DaemonWorker(parent)
 
 
+class Future(object):
+    """
+    Handle to the eventual result of a job submitted via ThreadPool.submit
+
+    Also records when the job was queued, started and finished so that slow
+    (straggler) jobs can be identified via wait_time and run_time.
+    """
+    def __init__(self, jobid=None):
+        self.jobid = jobid
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._result = None
+        self._exception = None
+        self._traceback = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def __repr__(self):
+        state = 'finished' if self.done() else 'pending'
+        return '<Future: %s (%s)>' % (self.jobid, state)
+
+    @property
+    def wait_time(self):
+        """Seconds the job spent in the queue before a worker picked it up"""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.queued_at
+
+    @property
+    def run_time(self):
+        """Seconds the job spent running"""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """
+        Returns the job's return value, blocking until the job has finished.
+        Re-raises the job's exception if the job failed.
+        """
+        if not self.wait(timeout):
+            raise exception.ThreadPoolTimeout(self.jobid, timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Returns the exception raised by the job (or None), blocking until the
+        job has finished
+        """
+        if not self.wait(timeout):
+            raise exception.ThreadPoolTimeout(self.jobid, timeout)
+        return self._exception
+
+    @property
+    def traceback(self):
+        return self._traceback
+
+    def add_done_callback(self, fn):
+        """
+        Calls fn(future) once the job has finished. If the job has already
+        finished fn is called immediately in the calling thread, otherwise it
+        is called from the worker thread that ran the job.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_running(self):
+        self.started_at = time.time()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc, tb_msg=None):
+        self._exception = exc
+        self._traceback = tb_msg
+        self._finish()
+
+    def _finish(self):
+        self.finished_at = time.time()
+        if self.started_at is None:
+            self.started_at = self.finished_at
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.error("error in done callback for job %s" % self.jobid,
+                          exc_info=True)
+
+
 class SimpleJob(workerpool.jobs.SimpleJob):
     def __init__(self, method, args=[], kwargs={}, jobid=None,
-                 results_queue=None):
+                 results_queue=None, future=None):
         self.method = method
         self.args = args
         self.kwargs = kwargs
         self.jobid = jobid
         self.results_queue = results_queue
+        self.future = future
 
     def run(self):
+        if self.future is None:
+            return self._run()
+        self.future.set_running()
+        try:
+            r = self._run()
+        except Exception as e:
+            self.future.set_exception(e, traceback.format_exc())
+            raise
+        self.future.set_result(r)
+        return r
+
+    def _run(self):
         if isinstance(self.args, list) or isinstance(self.args, tuple):
             if isinstance(self.kwargs, dict):
                 r = self.method(*self.args, **self.kwargs)
@@ -99,6 +223,7 @@ class ThreadPool(workerpool.WorkerPool):
         if self.disable_threads:
             size = 0
         workerpool.WorkerPool.__init__(self, size, maxjobs, worker_factory)
+        self._task_finished = threading.Condition(self.mutex)
 
     @property
     def progress_bar(self):
@@ -121,6 +246,24 @@ class ThreadPool(workerpool.WorkerPool):
         else:
             return job.run()
 
+    def submit(self, method, args=[], kwargs={}, jobid=None):
+        """
+        Schedules method(*args, **kwargs) to run in the pool and returns a
+        Future for its result. Unlike simple_job, results and exceptions of
+        submitted jobs are only reported through the returned Future and
+        never show up in get_results() or wait().
+        """
+        future = Future(jobid=jobid)
+        job = SimpleJob(method, args, kwargs, jobid, future=future)
+        if not self.disable_threads:
+            self.put(job)
+        else:
+            try:
+                job.run()
+            except Exception:
+                pass
+        return future
+
     def get_results(self):
         results = []
         for i in range(self._results_queue.qsize()):
@@ -136,20 +279,57 @@ class ThreadPool(workerpool.WorkerPool):
         sequence is given with different lengths the argument list will be
         truncated to the length of the smallest sequence.
 
+        Results are returned in the same order as the input sequence(s).
+
         If the kwarg jobid_fn is specified then each threadpool job will be
         assigned a jobid based on the return value of jobid_fn(item) for each
-        item in the map.
+        item in the map. Passing keyed=True in addition returns an ordered
+        dictionary mapping each jobid to its result instead of a list.
         """
-        if self._results_queue.qsize() > 0:
-            self.get_results()
         args = list(zip(*seq))
         jobid_fn = kwargs.get('jobid_fn')
+        futures = []
         for seq in args:
             jobid = None
             if jobid_fn:
                 jobid = jobid_fn(*seq)
-            self.simple_job(fn, seq, jobid=jobid)
-        return self.wait(numtasks=len(args))
+            futures.append(self.submit(fn, seq, jobid=jobid))
+        self.wait(numtasks=len(args), return_results=False)
+        excs = [[f.exception(), f.traceback, f.jobid] for f in futures
+                if f.exception() is not None]
+        if excs:
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", excs)
+        self.log_stragglers(futures)
+        if kwargs.get('keyed'):
+            return collections.OrderedDict([(f.jobid, f.result())
+                                            for f in futures])
+        return [f.result() for f in futures]
+
+    def log_stragglers(self, futures, factor=2):
+        """
+        Logs (at debug level) the jobs whose run time is more than factor
+        times the median run time of the given futures
+        """
+        futures = [f for f in futures if f.run_time is not None]
+        if len(futures) < 2:
+            return
+        times = sorted(f.run_time for f in futures)
+        median = times[len(times) // 2]
+        for f in futures:
+            if f.run_time > max(factor * median, 1):
+                log.debug("straggler job %s: ran %.2fs (median %.2fs), "
+                          "queued %.2fs" % (f.jobid, f.run_time, median,
+                                            f.wait_time))
+
+    def task_done(self):
+        """
+        Marks a job as done and wakes up anyone blocked in wait() so that
+        progress is reported as soon as each job finishes
+        """
+        workerpool.WorkerPool.task_done(self)
+        with self._task_finished:
+            self._task_finished.notify_all()
 
     def store_exception(self, e):
         self._exception_queue.put(e)
@@ -164,11 +344,16 @@ class ThreadPool(workerpool.WorkerPool):
         pbar.maxval = self.unfinished_tasks
         if numtasks is not None:
             pbar.maxval = max(numtasks, self.unfinished_tasks)
-        while self.unfinished_tasks != 0:
-            finished = pbar.maxval - self.unfinished_tasks
-            pbar.update(finished)
-            log.debug("unfinished_tasks = %d" % self.unfinished_tasks)
-            time.sleep(1)
+        unfinished = self.unfinished_tasks
+        while unfinished != 0:
+            pbar.update(pbar.maxval - unfinished)
+            log.debug("unfinished_tasks = %d" % unfinished)
+            with self._task_finished:
+                if self.unfinished_tasks == unfinished:
+                    # use a timeout so that KeyboardInterrupt is still
+                    # delivered to the main thread while waiting
+                    self._task_finished.wait(1)
+                unfinished = self.unfinished_tasks
         if pbar.maxval != 0:
             pbar.finish()
         self.join()
@@ -186,6 +371,245 @@ class ThreadPool(workerpool.WorkerPool):
         self.join()
 
 
+class TaskGraph(object):
+    """
+    Runs a set of interdependent tasks on a ThreadPool
+
+    Each task is submitted to the pool as soon as all of the tasks it depends
+    on have finished successfully, so independent chains of tasks (e.g. the
+    setup steps of different nodes) progress without waiting on each other.
+    Tasks in the same group (e.g. tasks that use the same node's SSH
+    connection, which can't be shared by concurrent SFTP operations) never run
+    at the same time. Tasks that depend on a failed task are skipped. Once all
+    tasks have finished the critical path (the chain of dependent tasks that
+    determined the total run time) is logged.
+
+    Example:
+        graph = TaskGraph(pool)
+        graph.add_task('mkfs', node.ssh.execute, ('mkfs.ext4 /dev/xvdf',),
+                       group=node.alias)
+        graph.add_task('mount', node.ssh.execute, ('mount /dev/xvdf /data',),
+                       deps=['mkfs'], group=node.alias)
+        graph.run()
+    """
+    def __init__(self, pool, name='tasks'):
+        self.pool = pool
+        self.name = name
+        self._tasks = collections.OrderedDict()
+        self._futures = {}
+        self._errors = {}
+        self._skipped = []
+        self._busy_groups = {}
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._remaining = None
+        self._outstanding = 0
+        self._start_time = None
+        self._end_time = None
+
+    def __len__(self):
+        return len(self._tasks)
+
+    @property
+    def tasks(self):
+        """Names of all tasks in the order they were added"""
+        return list(self._tasks.keys())
+
+    def add_task(self, name, method, args=[], kwargs={}, deps=[],
+                 group=None):
+        """
+        Adds a task that calls method(*args, **kwargs) once all tasks named in
+        deps have finished and no other task in the same group is running
+        """
+        if name in self._tasks:
+            raise ValueError("duplicate task name: %s" % name)
+        self._tasks[name] = (method, args, kwargs, list(deps), group)
+        return name
+
+    def result(self, name):
+        """Returns the return value of a finished task"""
+        return self._futures[name].result()
+
+    def _check(self):
+        dependents = dict([(name, []) for name in self._tasks])
+        remaining = {}
+        for name, (method, args, kwargs, deps, group) in self._tasks.items():
+            for dep in deps:
+                if dep not in self._tasks:
+                    raise ValueError("task %s depends on unknown task %s" %
+                                     (name, dep))
+                dependents[dep].append(name)
+            remaining[name] = len(deps)
+        # make sure the graph has no cycles
+        counts = dict(remaining)
+        ready = [name for name in counts if counts[name] == 0]
+        visited = 0
+        while ready:
+            name = ready.pop()
+            visited += 1
+            for child in dependents[name]:
+                counts[child] -= 1
+                if counts[child] == 0:
+                    ready.append(child)
+        if visited != len(self._tasks):
+            raise ValueError("dependency cycle in %s" % self.name)
+        return dependents, remaining
+
+    def _schedule(self, name):
+        """
+        Returns the name of the task to submit now, if any. Tasks whose group
+        is busy are queued until the running task of that group finishes.
+        Must be called with self._lock held.
+        """
+        group = self._tasks[name][4]
+        if group is None:
+            return name
+        if group in self._busy_groups:
+            self._busy_groups[group].append(name)
+            return None
+        self._busy_groups[group] = []
+        return name
+
+    def _release_group(self, name):
+        """
+        Marks name's group as idle and returns the next queued task of that
+        group, if any. Must be called with self._lock held.
+        """
+        group = self._tasks[name][4]
+        if group is None:
+            return None
+        queued = self._busy_groups[group]
+        if queued:
+            return queued.pop(0)
+        del self._busy_groups[group]
+        return None
+
+    def _submit(self, name):
+        method, args, kwargs, deps, group = self._tasks[name]
+        try:
+            future = self.pool.submit(method, args, kwargs, jobid=name)
+        except Exception as e:
+            # count the task as failed so that run() doesn't wait for it
+            self._errors[name] = (e, traceback.format_exc())
+            self._task_finished(name)
+            return
+        self._futures[name] = future
+        future.add_done_callback(lambda f: self._task_finished(name, f))
+
+    def _skip(self, name):
+        if name in self._skipped:
+            return 0
+        self._skipped.append(name)
+        count = 1
+        for child in self._dependents[name]:
+            count += self._skip(child)
+        return count
+
+    def _task_finished(self, name, future=None):
+        """
+        Submits the tasks that are ready to run once name has finished (or
+        failed to be submitted if future is None). This runs as a done
+        callback of name's future, where exceptions are only logged, so any
+        error is recorded as name's failure and stops run() from waiting for
+        the tasks that can no longer be accounted for.
+        """
+        try:
+            ready = []
+            with self._lock:
+                self._outstanding -= 1
+                ready.append(self._release_group(name))
+                if future is None or future.exception() is not None:
+                    for child in self._dependents[name]:
+                        self._outstanding -= self._skip(child)
+                else:
+                    for child in self._dependents[name]:
+                        if child in self._skipped:
+                            continue
+                        self._remaining[child] -= 1
+                        if self._remaining[child] == 0:
+                            ready.append(self._schedule(child))
+                if self._outstanding == 0:
+                    self._finished.set()
+            for child in ready:
+                if child is not None:
+                    self._submit(child)
+        except Exception as e:
+            self._errors.setdefault(name, (e, traceback.format_exc()))
+            self._finished.set()
+
+    def run(self):
+        """
+        Runs all tasks and blocks until they've all finished. Raises
+        exception.ThreadPoolException if any task failed.
+        """
+        self._dependents, self._remaining = self._check()
+        self._futures = {}
+        self._errors = {}
+        self._skipped = []
+        self._busy_groups = {}
+        self._finished.clear()
+        self._outstanding = len(self._tasks)
+        self._start_time = time.time()
+        if self._tasks:
+            with self._lock:
+                roots = [self._schedule(n) for n in self._tasks
+                         if self._remaining[n] == 0]
+            for name in roots:
+                if name is not None:
+                    self._submit(name)
+            # use a timeout so that KeyboardInterrupt is still delivered to
+            # the main thread while waiting
+            while not self._finished.wait(1):
+                pass
+        self._end_time = time.time()
+        excs = []
+        for name in self._tasks:
+            future = self._futures.get(name)
+            if name in self._errors:
+                exc, tb_msg = self._errors[name]
+                excs.append([exc, tb_msg, name])
+            elif future is not None and future.exception() is not None:
+                excs.append([future.exception(), future.traceback, name])
+        if self._skipped:
+            log.debug("skipped tasks due to failed dependencies: %s" %
+                      ', '.join(self._skipped))
+        if excs:
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", excs)
+        self.log_critical_path()
+
+    def critical_path(self):
+        """
+        Returns the chain of tasks that finished last, i.e. the tasks that
+        determined the total run time, as a list of (name, future) tuples
+        """
+        futures = self._futures
+        done = [n for n in futures if futures[n].finished_at is not None]
+        if not done:
+            return []
+        name = max(done, key=lambda n: futures[n].finished_at)
+        path = [(name, futures[name])]
+        while True:
+            deps = [d for d in self._tasks[name][3] if d in futures]
+            if not deps:
+                break
+            name = max(deps, key=lambda n: futures[n].finished_at)
+            path.insert(0, (name, futures[name]))
+        return path
+
+    def log_critical_path(self):
+        path = self.critical_path()
+        if not path:
+            return
+        total = self._end_time - self._start_time
+        steps = ' -> '.join(['%s (%.2fs)' % (name, f.run_time)
+                             for name, f in path])
+        log.info("Ran %d %s in %.2fs, critical path: %s" %
+                 (len(self._tasks), self.name, total, steps),
+                 extra=dict(__textwrap__=True))
+        self.pool.log_stragglers(list(self._futures.values()))
+
+
 def get_thread_pool(size=10, worker_factory=_worker_factory,
                     disable_threads=False):
     return ThreadPool(size=size, worker_factory=_worker_factory,
@@ -0,0 +1,823 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Parallel, chunked and resumable file transfers over SFTP
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import stat
+import time
+import uuid
+import hashlib
+import tarfile
+import threading
+import posixpath
+
+from six.moves import queue as Queue
+from six.moves import shlex_quote
+
+from starcluster import exception
+from starcluster import progressbar
+from starcluster.logger import log
+
+MB = 1024 ** 2
+
+# size of the pieces each chunk is read and written in
+PIECE_SIZE = MB
+
+
+class TransferFile(object):
+    """
+    A single file to copy: its source and destination path, size and
+    permissions as well as the chunks that still need to be sent
+    """
+    def __init__(self, src, dest, size, mode, mtime=None):
+        self.src = src
+        self.dest = dest
+        self.size = size
+        self.mode = mode
+        self.mtime = mtime
+        self.chunks = []
+        # True if (part of) the file already exists at the destination
+        self.partial = False
+
+    def __repr__(self):
+        return '<TransferFile: %s -> %s (%d bytes)>' % (
+            self.src, self.dest, self.size)
+
+    def get_chunks(self, chunk_size):
+        """
+        Returns the (offset, length) ranges of chunk_size bytes the file is
+        split into. Empty files consist of a single empty chunk.
+        """
+        if not self.size:
+            return [(0, 0)]
+        return [(offset, min(chunk_size, self.size - offset))
+                for offset in range(0, self.size, chunk_size)]
+
+    @property
+    def multipart(self):
+        """
+        True if the file is sent in several pieces that have to be written at
+        their offset into an existing file
+        """
+        return len(self.chunks) != 1 or self.chunks[0][1] != self.size
+
+
+def md5_local_chunks(path, chunks):
+    """
+    Returns the md5 hex digests of the given (offset, length) ranges of a
+    local file
+    """
+    digests = []
+    with open(path, 'rb') as f:
+        for offset, length in chunks:
+            f.seek(offset)
+            md5 = hashlib.md5()
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(PIECE_SIZE, remaining))
+                if not data:
+                    break
+                md5.update(data)
+                remaining -= len(data)
+            digests.append(md5.hexdigest())
+    return digests
+
+
+# tarfile stream mode suffix and tar flag for each supported compression
+TAR_COMPRESSION = {
+    None: ('', ''),
+    'gzip': ('gz', 'z'),
+    'bzip2': ('bz2', 'j'),
+}
+
+
+class _ChannelWriter(object):
+    """File-like object that writes to a paramiko channel"""
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        self.channel.sendall(data)
+
+
+class _ProgressReader(object):
+    """Wraps a file object and reports the number of bytes read"""
+    def __init__(self, fileobj, callback):
+        self.fileobj = fileobj
+        self.callback = callback
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.callback(len(data))
+        return data
+
+
+def count_local_files(paths, limit=None):
+    """
+    Returns the number of regular files within the local paths. Stops
+    counting once more than limit files have been found.
+    """
+    count = 0
+    for path in paths:
+        if not os.path.isdir(path):
+            count += 1
+            continue
+        for root, dirnames, filenames in os.walk(path):
+            count += len(filenames)
+            if limit is not None and count > limit:
+                return count
+    return count
+
+
+def remote_file_stats(ssh, paths):
+    """
+    Returns the number and total size of the regular files within paths on
+    the remote host using a single command
+    """
+    cmd = ("find %s -type f -printf '%%s\\n' | "
+           "awk '{n++; s+=$1} END {print n+0, s+0}'" %
+           ' '.join(map(shlex_quote, paths)))
+    count, size = ssh.execute(cmd, log_output=False)[-1].split()
+    return int(count), int(float(size))
+
+
+class FileTransfer(object):
+    """
+    Copies files and directories between the local host and the remote host
+    of an SSHClient over several SFTP sessions at once.
+
+    Files larger than chunk_size are split into ranges of chunk_size bytes and
+    all ranges of all files are handed out to `streams` worker threads, each
+    with its own SFTP session. Large files are therefore sent over several
+    channels concurrently and many small files are transferred concurrently
+    rather than one after another.
+
+    resume - compare md5 checksums of each chunk on both hosts (computed on
+             the remote host with a single command) and only send the chunks
+             that differ, so that an interrupted transfer picks up where it
+             left off
+    compress - send the data over a compressed SSH transport
+    progress - show a progress bar with the overall throughput
+    tar_compression - compression used by put_tar/get_tar (None, 'gzip' or
+                      'bzip2'). put_tar/get_tar stream over a plain exec
+                      channel, so if compress is set and tar_compression is
+                      not the archive is compressed with gzip instead
+
+    Example:
+        xfer = FileTransfer(node.ssh, streams=8, resume=True)
+        xfer.put(['/data/genome.fa', '/data/reads'], '/scratch')
+    """
+    def __init__(self, ssh, streams=4, chunk_size=64 * MB, resume=False,
+                 compress=None, progress=True, tar_compression=None):
+        if tar_compression not in TAR_COMPRESSION:
+            raise exception.BaseException(
+                "invalid tar compression: %s (options: %s)" %
+                (tar_compression, ', '.join(sorted(
+                    [c for c in TAR_COMPRESSION if c]))))
+        self.ssh = ssh
+        self.streams = max(int(streams), 1)
+        # chunks are checksummed remotely in whole PIECE_SIZE blocks
+        self.chunk_size = max(int(chunk_size) // PIECE_SIZE, 1) * PIECE_SIZE
+        self.resume = resume
+        self.compress = compress
+        self.progress = progress
+        self.tar_compression = tar_compression
+        if compress and not tar_compression:
+            self.tar_compression = 'gzip'
+        self._lock = threading.Lock()
+        self._pbar = None
+        self._sent = 0
+
+    @property
+    def progress_bar(self):
+        if not self._pbar:
+            widgets = ['FileTransfer: ', ' ', progressbar.Percentage(), ' ',
+                       progressbar.Bar(marker=progressbar.RotatingMarker()),
+                       ' ', progressbar.ETA(), ' ',
+                       progressbar.FileTransferSpeed()]
+            self._pbar = progressbar.ProgressBar(widgets=widgets, maxval=1,
+                                                 force_update=True)
+        return self._pbar
+
+    def _update_progress(self, nbytes):
+        with self._lock:
+            self._sent += nbytes
+            if self.progress:
+                self.progress_bar.update(self._sent)
+
+    def put(self, localpaths, remotepath='.'):
+        """
+        Copies local files and directories (recursively) to remotepath on the
+        remote host. Works like scp: if remotepath is an existing directory
+        the paths are copied into it, otherwise the single local path is
+        copied to remotepath.
+        """
+        roots, dirs, files = self._plan_put(localpaths, remotepath)
+        self._remote_makedirs(dirs)
+        if self.resume:
+            self._split(files, self._local_md5_chunks,
+                        self._remote_md5_chunks)
+        else:
+            self._split(files)
+        self._run(files, self._put_chunk, self._remote_prepare,
+                  self._remote_finalize)
+        return files
+
+    def get(self, remotepaths, localpath='.'):
+        """
+        Copies remote files and directories (recursively) to localpath on the
+        local host. Works like scp: if localpath is an existing directory the
+        paths are copied into it, otherwise the single remote path is copied
+        to localpath.
+        """
+        dirs, files = self._plan_get(remotepaths, localpath)
+        for d in dirs:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        if self.resume:
+            self._split(files, self._remote_md5_chunks,
+                        self._local_md5_chunks)
+        else:
+            self._split(files)
+        self._run(files, self._get_chunk, self._local_prepare,
+                  self._local_finalize)
+        return files
+
+    def sync(self, localpaths, remotepath='.', delete=False):
+        """
+        Same as put() but only sends what changed since the last sync, like
+        rsync.
+
+        A manifest of the local files (size and mtime) is compared against the
+        remote files by a single remote command, which also returns the md5
+        checksums of the chunks of each remote file whose size or mtime
+        differs. Only new files and the chunks of changed files whose checksum
+        differs are sent, after which the remote mtimes are set to the local
+        ones. If delete is True remote files and directories within the
+        copied directories that don't exist locally are removed.
+        """
+        roots, dirs, files = self._plan_put(localpaths, remotepath)
+        self._remote_makedirs(dirs)
+        unchanged, dest_digests, remote_paths = self._remote_manifest(
+            files, roots if delete else [])
+        self._split([f for f in files if f not in unchanged],
+                    self._local_md5_chunks, lambda files, attr: dest_digests)
+        for f in unchanged:
+            f.chunks = []
+        self._run(files, self._put_chunk, self._remote_prepare,
+                  self._remote_finalize)
+        self._remote_set_mtimes([f for f in files if f not in unchanged])
+        if delete:
+            local_paths = set(dirs + [f.dest for f in files])
+            self._remote_delete([p for p in remote_paths
+                                 if p not in local_paths])
+        return files
+
+    def _start_progress(self, total):
+        self._sent = 0
+        if self.progress:
+            self.progress_bar.reset()
+            self.progress_bar.maxval = max(total, 1)
+            self.progress_bar.update(0)
+        return time.time()
+
+    def _finish_progress(self, total, start):
+        if self.progress:
+            self.progress_bar.finish()
+        elapsed = max(time.time() - start, 1e-6)
+        log.info("Transferred %.1f MB in %.1fs (%.1f MB/s)" %
+                 (total / MB, elapsed, total / MB / elapsed))
+
+    def _finish_tar_channel(self, channel, cmd):
+        status = channel.recv_exit_status()
+        if status != 0:
+            err = channel.makefile_stderr('rb').read().decode('utf-8',
+                                                              'replace')
+            raise exception.SCPException(
+                "remote command failed (exit status %d): %s\n%s" %
+                (status, cmd, err.strip()))
+
+    def put_tar(self, localpaths, remotepath='.'):
+        """
+        Same as put() but streams a tar archive of the local paths into
+        `tar -x` on the remote host over a single channel instead of creating
+        each file over SFTP. This avoids one or more round trips per file and
+        is much faster for trees of many small files. The archive is
+        compressed with tar_compression if given.
+        """
+        dest_is_dir = self.ssh.isdir(remotepath)
+        if len(localpaths) > 1 and not dest_is_dir:
+            raise exception.BaseException(
+                "Remote path does not exist or is not a directory: %s" %
+                remotepath)
+        if dest_is_dir:
+            extract_dir = remotepath
+        else:
+            extract_dir = posixpath.dirname(remotepath.rstrip('/')) or '.'
+        members = []
+        for lpath in localpaths:
+            lpath = os.path.normpath(lpath)
+            arcname = posixpath.basename(self._get_target(
+                lpath, remotepath.rstrip('/'), dest_is_dir))
+            members.append((lpath, arcname))
+            for root, dirnames, filenames in os.walk(lpath):
+                rel = os.path.relpath(root, lpath)
+                rdir = posixpath.normpath(posixpath.join(
+                    arcname, *rel.split(os.sep)))
+                for name in dirnames + filenames:
+                    path = os.path.join(root, name)
+                    members.append((path, posixpath.join(rdir, name)))
+        total = sum(os.path.getsize(path) for path, arcname in members
+                    if os.path.isfile(path) and not os.path.islink(path))
+        mode, flag = TAR_COMPRESSION[self.tar_compression]
+        cmd = 'mkdir -p %s && tar -x%sf - --no-same-owner -C %s' % (
+            shlex_quote(extract_dir), flag, shlex_quote(extract_dir))
+        log.info("Streaming %d file(s) and directories (%.1f MB) to %s" %
+                 (len(members), total / MB, remotepath))
+        start = self._start_progress(total)
+        channel = self.ssh.exec_channel(cmd)
+        try:
+            tar = tarfile.open(fileobj=_ChannelWriter(channel),
+                               mode='w|' + mode)
+            for path, arcname in members:
+                info = tar.gettarinfo(path, arcname)
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                if info.isreg():
+                    with open(path, 'rb') as f:
+                        tar.addfile(info, _ProgressReader(
+                            f, self._update_progress))
+                else:
+                    tar.addfile(info)
+            tar.close()
+            channel.shutdown_write()
+            self._finish_tar_channel(channel, cmd)
+        finally:
+            channel.close()
+        self._finish_progress(total, start)
+
+    def get_tar(self, remotepaths, localpath='.'):
+        """
+        Same as get() but streams a tar archive of the remote paths created
+        by `tar -c` on the remote host over a single channel and extracts it
+        locally as it arrives. The archive is compressed with tar_compression
+        if given.
+        """
+        dest_is_dir = os.path.isdir(localpath)
+        if len(remotepaths) > 1 and not dest_is_dir:
+            raise exception.BaseException(
+                "Local path does not exist or is not a directory: %s" %
+                localpath)
+        if dest_is_dir:
+            extract_dir = localpath
+        else:
+            extract_dir = os.path.dirname(os.path.normpath(localpath)) or '.'
+        remotepaths = [posixpath.normpath(p) for p in remotepaths]
+        renames = {}
+        args = []
+        for rpath in remotepaths:
+            name = posixpath.basename(rpath)
+            args.append('-C %s %s' % (shlex_quote(posixpath.dirname(rpath) or
+                                                  '.'), shlex_quote(name)))
+            if not dest_is_dir:
+                renames[name] = os.path.basename(os.path.normpath(localpath))
+        count, total = remote_file_stats(self.ssh, remotepaths)
+        mode, flag = TAR_COMPRESSION[self.tar_compression]
+        cmd = 'tar -c%sf - %s' % (flag, ' '.join(args))
+        log.info("Streaming %d file(s) (%.1f MB) to %s" %
+                 (count, total / MB, localpath))
+        start = self._start_progress(total)
+        channel = self.ssh.exec_channel(cmd)
+        try:
+            tar = tarfile.open(fileobj=channel.makefile('rb'),
+                               mode='r|' + mode)
+            for member in tar:
+                member.name = self._rename_member(member.name, renames)
+                if member.islnk():
+                    member.linkname = self._rename_member(member.linkname,
+                                                          renames)
+                if not self._is_safe_member(member, extract_dir):
+                    continue
+                tar.extract(member, extract_dir)
+                if member.isreg():
+                    self._update_progress(member.size)
+            tar.close()
+            self._finish_tar_channel(channel, cmd)
+        finally:
+            channel.close()
+        self._finish_progress(total, start)
+
+    def _rename_member(self, name, renames):
+        parts = name.split('/')
+        if parts[0] in renames:
+            parts[0] = renames[parts[0]]
+        return posixpath.normpath('/'.join(parts))
+
+    def _is_safe_member(self, member, extract_dir):
+        """
+        Returns True if member can be extracted into extract_dir and False if
+        it should be skipped. Raises SCPException if member (or the target of
+        a symlink or hardlink member) resolves to a path outside extract_dir,
+        including through symlinks extracted earlier from the same archive.
+        """
+        if not (member.isreg() or member.isdir() or member.issym() or
+                member.islnk()):
+            log.warn("skipping special file: %s" % member.name)
+            return False
+        root = os.path.realpath(extract_dir)
+        paths = [member.name]
+        if member.issym():
+            paths.append(posixpath.join(posixpath.dirname(member.name),
+                                        member.linkname))
+        elif member.islnk():
+            paths.append(member.linkname)
+        for path in paths:
+            if posixpath.isabs(path):
+                raise exception.SCPException(
+                    "refusing to extract unsafe path: %s" % member.name)
+            if member.issym() and path == member.name:
+                # the link itself is created, not followed
+                path = posixpath.dirname(path) or '.'
+            real = os.path.realpath(os.path.join(root, *path.split('/')))
+            if real != root and not real.startswith(root + os.sep):
+                raise exception.SCPException(
+                    "refusing to extract unsafe path: %s" % member.name)
+        return True
+
+    def _get_target(self, path, dest, dest_is_dir, join=posixpath.join):
+        if dest_is_dir:
+            return join(dest, os.path.basename(path.rstrip('/')))
+        return dest
+
+    def _plan_put(self, localpaths, remotepath):
+        dest_is_dir = self.ssh.isdir(remotepath)
+        if len(localpaths) > 1 and not dest_is_dir:
+            raise exception.BaseException(
+                "Remote path does not exist or is not a directory: %s" %
+                remotepath)
+        roots = []
+        dirs = []
+        files = []
+        for lpath in localpaths:
+            target = self._get_target(os.path.normpath(lpath), remotepath,
+                                      dest_is_dir)
+            if not os.path.isdir(lpath):
+                st = os.stat(lpath)
+                files.append(TransferFile(lpath, target, st.st_size,
+                                          stat.S_IMODE(st.st_mode),
+                                          int(st.st_mtime)))
+                continue
+            roots.append(posixpath.normpath(target))
+            for root, dirnames, filenames in os.walk(lpath):
+                rel = os.path.relpath(root, lpath)
+                rdir = posixpath.normpath(posixpath.join(
+                    target, *rel.split(os.sep)))
+                dirs.append(rdir)
+                for name in filenames:
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    files.append(TransferFile(path, posixpath.join(rdir, name),
+                                              st.st_size,
+                                              stat.S_IMODE(st.st_mode),
+                                              int(st.st_mtime)))
+        return roots, dirs, files
+
+    def _plan_get(self, remotepaths, localpath):
+        dest_is_dir = os.path.isdir(localpath)
+        if len(remotepaths) > 1 and not dest_is_dir:
+            raise exception.BaseException(
+                "Local path does not exist or is not a directory: %s" %
+                localpath)
+        dirs = []
+        files = []
+        for rpath in remotepaths:
+            rpath = posixpath.normpath(rpath)
+            target = self._get_target(rpath, localpath, dest_is_dir,
+                                      join=os.path.join)
+            cmd = "find %s -printf '%%y %%s %%m %%p\\n'" % shlex_quote(rpath)
+            for line in self.ssh.execute(cmd, log_output=False):
+                ftype, size, mode, path = line.split(' ', 3)
+                rel = posixpath.relpath(path, rpath)
+                local = os.path.normpath(os.path.join(target,
+                                                      *rel.split('/')))
+                if ftype == 'd':
+                    dirs.append(local)
+                elif ftype == 'f':
+                    files.append(TransferFile(path, local, int(size),
+                                              int(mode, 8)))
+                else:
+                    log.warn("skipping %s (not a regular file)" % path)
+        return dirs, files
+
+    def _split(self, files, get_src_digests=None, get_dest_digests=None):
+        """
+        Splits files into chunks. If the digest functions are given the
+        chunks whose checksum already matches at the destination are dropped.
+        """
+        for f in files:
+            f.chunks = f.get_chunks(self.chunk_size)
+        if get_dest_digests is None:
+            return
+        dest_digests = get_dest_digests(files, 'dest')
+        existing = [f for f in files if f in dest_digests]
+        src_digests = get_src_digests(existing, 'src')
+        for f in existing:
+            dest_size, dest_chunks = dest_digests[f]
+            src_chunks = src_digests[f][1]
+            f.partial = True
+            f.chunks = [chunk for chunk, src, dest in
+                        zip(f.chunks, src_chunks, dest_chunks) if src != dest]
+            if not f.chunks and dest_size != f.size:
+                # only the trailing data needs to be dropped
+                f.chunks = [(f.size, 0)]
+
+    def _local_md5_chunks(self, files, attr):
+        """
+        Returns a dict mapping each file whose path attr exists on the local
+        host to the file's local size and the md5 digests of its chunks
+        """
+        digests = {}
+        for f in files:
+            path = getattr(f, attr)
+            if os.path.isfile(path):
+                chunks = f.get_chunks(self.chunk_size)
+                digests[f] = (os.path.getsize(path),
+                              md5_local_chunks(path, chunks))
+        return digests
+
+    def _remote_md5_chunks(self, files, attr):
+        """
+        Same as _local_md5_chunks for paths on the remote host. All checksums
+        are computed by a single remote command.
+        """
+        script = []
+        count = self.chunk_size // PIECE_SIZE
+        for i, f in enumerate(files):
+            script.append(
+                'f=%(path)s; if [ -f "$f" ]; then '
+                'echo "F %(i)d $(stat -c %%s "$f")"; i=0; '
+                'while [ $i -lt %(n)d ]; do echo "C %(i)d $(dd if="$f" '
+                'bs=%(bs)d skip=$((i*%(count)d)) count=%(count)d 2>/dev/null '
+                '| md5sum | cut -d" " -f1)"; i=$((i+1)); done; fi' %
+                dict(path=shlex_quote(getattr(f, attr)), i=i, bs=PIECE_SIZE,
+                     count=count, n=len(f.get_chunks(self.chunk_size))))
+        digests = {}
+        if not script:
+            return digests
+        for line in self.ssh.execute('\n'.join(script), log_output=False):
+            parts = line.split()
+            if len(parts) != 3 or not parts[1].isdigit():
+                continue
+            f = files[int(parts[1])]
+            if parts[0] == 'F':
+                digests[f] = (int(parts[2]), [])
+            elif parts[0] == 'C' and f in digests:
+                digests[f][1].append(parts[2])
+        return digests
+
+    def _remote_manifest(self, files, roots=[]):
+        """
+        Compares files against their remote copies using a single remote
+        command and returns a tuple of:
+
+        1. the set of files whose remote copy has the same size and mtime
+        2. a dict mapping the other files that exist remotely to the remote
+           size and md5 digests of their chunks (see _remote_md5_chunks)
+        3. the paths of all files and directories within roots on the remote
+           host
+
+        The manifest is uploaded to a temporary file rather than passed on the
+        command line so that it works for any number of files.
+        """
+        count = self.chunk_size // PIECE_SIZE
+        manifest = ''.join(['%d\t%d\t%d\t%s\n' % (i, f.size, f.mtime, f.dest)
+                            for i, f in enumerate(files)])
+        tmpfile = '/tmp/.starcluster-sync-%s' % uuid.uuid4().hex
+        sftp = self.ssh.open_sftp()
+        try:
+            mf = sftp.open(tmpfile, 'w')
+            mf.write(manifest.encode('utf-8'))
+            mf.close()
+        finally:
+            sftp.close()
+        script = [
+            'while IFS=$\'\\t\' read -r i size mtime f; do',
+            '  [ -f "$f" ] || continue',
+            '  set -- $(stat -c "%%s %%Y" "$f")',
+            '  if [ "$1" = "$size" ] && [ "$2" = "$mtime" ]; then',
+            '    echo "S $i"; continue',
+            '  fi',
+            '  echo "F $i $1"; j=0',
+            '  n=$(( (size + %(csize)d - 1) / %(csize)d ))',
+            '  [ $n -gt 0 ] || n=1',
+            '  while [ $j -lt $n ]; do',
+            '    echo "C $i $(dd if="$f" bs=%(bs)d skip=$((j*%(count)d)) '
+            'count=%(count)d 2>/dev/null | md5sum | cut -d" " -f1)"',
+            '    j=$((j+1))',
+            '  done',
+            'done < %(manifest)s',
+            'rm -f %(manifest)s',
+        ]
+        script = '\n'.join(script) % dict(csize=self.chunk_size,
+                                          bs=PIECE_SIZE, count=count,
+                                          manifest=shlex_quote(tmpfile))
+        if roots:
+            script += "\nfind %s -mindepth 1 -printf 'P %%p\\n'" % ' '.join(
+                map(shlex_quote, roots))
+        unchanged = set()
+        digests = {}
+        remote_paths = []
+        for line in self.ssh.execute(script, log_output=False):
+            parts = line.split(' ', 1)
+            if parts[0] == 'P' and len(parts) == 2:
+                remote_paths.append(parts[1])
+                continue
+            parts = line.split()
+            if len(parts) < 2 or not parts[1].isdigit():
+                continue
+            f = files[int(parts[1])]
+            if parts[0] == 'S':
+                unchanged.add(f)
+            elif parts[0] == 'F' and len(parts) == 3:
+                digests[f] = (int(parts[2]), [])
+            elif parts[0] == 'C' and len(parts) == 3 and f in digests:
+                digests[f][1].append(parts[2])
+        log.info("%d of %d file(s) unchanged, %d changed, %d new" %
+                 (len(unchanged), len(files), len(digests),
+                  len(files) - len(unchanged) - len(digests)))
+        return unchanged, digests, remote_paths
+
+    def _remote_set_mtimes(self, files, batch_size=500):
+        for i in range(0, len(files), batch_size):
+            cmds = ['touch -c -m -d @%d %s' % (f.mtime, shlex_quote(f.dest))
+                    for f in files[i:i + batch_size]]
+            self.ssh.execute('; '.join(cmds), log_output=False)
+
+    def _remote_delete(self, paths, batch_size=500):
+        """
+        Removes remote paths (recursively) except for those within a directory
+        that is removed as well
+        """
+        paths = sorted(paths)
+        removed = []
+        for path in paths:
+            if removed and path.startswith(removed[-1] + '/'):
+                continue
+            removed.append(path)
+        if not removed:
+            return
+        log.info("Deleting %d remote path(s) that don't exist locally" %
+                 len(removed))
+        for i in range(0, len(removed), batch_size):
+            batch = removed[i:i + batch_size]
+            log.debug("deleting: %s" % ', '.join(batch))
+            self.ssh.execute('rm -rf -- %s' % ' '.join(map(shlex_quote,
+                                                           batch)))
+
+    def _remote_makedirs(self, dirs, batch_size=500):
+        for i in range(0, len(dirs), batch_size):
+            batch = dirs[i:i + batch_size]
+            self.ssh.execute('mkdir -p %s' % ' '.join(map(shlex_quote,
+                                                          batch)))
+
+    def _remote_prepare(self, sftp, f):
+        # multipart files are written in place, possibly out of order
+        if not f.partial:
+            sftp.open(f.dest, 'w').close()
+
+    def _remote_finalize(self, sftp, f):
+        sftp.truncate(f.dest, f.size)
+        sftp.chmod(f.dest, f.mode)
+
+    def _local_prepare(self, sftp, f):
+        if not f.partial:
+            open(f.dest, 'wb').close()
+
+    def _local_finalize(self, sftp, f):
+        with open(f.dest, 'r+b') as lf:
+            lf.truncate(f.size)
+        os.chmod(f.dest, f.mode)
+
+    def _put_chunk(self, sftp, f, offset, length):
+        if f.multipart:
+            rf = sftp.open(f.dest, 'r+')
+            rf.seek(offset)
+        else:
+            rf = sftp.open(f.dest, 'w')
+        try:
+            rf.set_pipelined(True)
+            with open(f.src, 'rb') as lf:
+                lf.seek(offset)
+                remaining = length
+                while remaining > 0:
+                    data = lf.read(min(PIECE_SIZE, remaining))
+                    if not data:
+                        break
+                    rf.write(data)
+                    remaining -= len(data)
+                    self._update_progress(len(data))
+            if not f.multipart:
+                rf.chmod(f.mode)
+        finally:
+            rf.close()
+
+    def _get_chunk(self, sftp, f, offset, length, batch_size=8):
+        rf = sftp.open(f.src, 'r')
+        try:
+            with open(f.dest, 'r+b' if f.multipart else 'wb') as lf:
+                lf.seek(offset)
+                pieces = [(o, min(PIECE_SIZE, offset + length - o))
+                          for o in range(offset, offset + length, PIECE_SIZE)]
+                # prefetch a bounded number of pieces at a time
+                for i in range(0, len(pieces), batch_size):
+                    for data in rf.readv(pieces[i:i + batch_size]):
+                        lf.write(data)
+                        self._update_progress(len(data))
+            if not f.multipart:
+                os.chmod(f.dest, f.mode)
+        finally:
+            rf.close()
+
+    def _run(self, files, transfer_chunk, prepare, finalize):
+        jobs = Queue.Queue()
+        total = 0
+        for f in files:
+            for offset, length in f.chunks:
+                jobs.put((f, offset, length))
+                total += length
+        multipart = [f for f in files if f.chunks and f.multipart]
+        skipped = len([f for f in files if not f.chunks])
+        if skipped:
+            log.info("%d of %d file(s) are already up to date" %
+                     (skipped, len(files)))
+        if jobs.empty():
+            return
+        nstreams = min(self.streams, jobs.qsize())
+        log.info("Transferring %d chunk(s) of %d file(s) (%.1f MB) over %d "
+                 "stream(s)" % (jobs.qsize(), len(files) - skipped,
+                                total / MB, nstreams))
+        sftp = self.ssh.open_sftp(compress=self.compress)
+        try:
+            for f in multipart:
+                prepare(sftp, f)
+            start = self._start_progress(total)
+            errors = []
+            threads = [threading.Thread(target=self._worker,
+                                        args=(jobs, transfer_chunk, errors))
+                       for i in range(nstreams)]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+            if errors:
+                raise exception.SCPException(
+                    "%d chunk(s) failed to transfer:\n%s" % (
+                        len(errors), '\n'.join(errors)))
+            for f in multipart:
+                finalize(sftp, f)
+        finally:
+            sftp.close()
+        self._finish_progress(total, start)
+
+    def _worker(self, jobs, transfer_chunk, errors):
+        sftp = None
+        try:
+            while True:
+                try:
+                    f, offset, length = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    if sftp is None:
+                        sftp = self.ssh.open_sftp(compress=self.compress)
+                    transfer_chunk(sftp, f, offset, length)
+                except Exception as e:
+                    log.debug("failed to transfer %s (offset=%d)" %
+                              (f.src, offset), exc_info=True)
+                    errors.append("%s (offset=%d): %s" % (f.src, offset, e))
+        finally:
+            if sftp is not None:
+                sftp.close()
@@ -237,6 +237,14 @@ def make_one_liner(script):
     return 'python -c "%s"' % script.strip().replace('\n', ';')
 
 
+def ere_escape(string):
+    """
+    Escapes all characters in string that have a special meaning in POSIX
+    extended regular expressions (e.g. as used by grep -E)
+    """
+    return re.sub(r'([.\[\]()*+?{}|^$\\])', r'\\\1', string)
+
+
 def is_url(url):
     """
     Returns True if the provided string is a valid url
@@ -308,6 +316,13 @@ def iso_to_unix_time(iso):
     return secs
 
 
+def datetime_tuple_to_unix_time(tup):
+    """
+    Converts a timezone-aware datetime tuple to seconds since the epoch
+    """
+    return calendar.timegm(tup.utctimetuple())
+
+
 def iso_to_javascript_timestamp(iso):
     """
     Convert dates to Javascript timestamps (number of milliseconds since
@@ -216,6 +216,7 @@ class VolumeCreator(cluster.Cluster):
 
     def _repartition_volume(self):
         conn = self._instance.ssh
+        self._instance.invalidate_facts()
         partmap = self._instance.get_partition_map()
         part = self._real_device + '1'
         start = partmap.get(part)[0]